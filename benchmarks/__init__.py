@@ -0,0 +1,66 @@
+"""
+Offline benchmarks for the bandwidth scanner.
+
+Each benchmark module can be run with `python -m benchmarks.<name>` and
+prints its results as JSON, optionally also written to a file with
+`--output`, so runs before and after a change can be compared.
+"""
+import json
+import platform
+import random
+import time
+import timeit
+
+
+class SyntheticRelay(object):
+    """
+    The attributes of a txtorcon Router used by the circuit generators.
+    """
+    def __init__(self, index, bandwidth, flags):
+        self.id_hex = '${:040X}'.format(index)
+        self.bandwidth = bandwidth
+        self.flags = flags
+
+
+class SyntheticState(object):
+    """
+    A TorState with `num_relays` relays. Relay bandwidths follow a
+    log-normal distribution like the bandwidths in the consensus and about a
+    third of the relays are exits.
+    """
+    def __init__(self, num_relays, seed=0):
+        rng = random.Random(seed)
+        self.routers = {}
+        for i in range(num_relays):
+            flags = ['fast', 'running', 'valid']
+            if rng.random() < 0.35:
+                flags.append('exit')
+            relay = SyntheticRelay(i, int(rng.lognormvariate(8, 1.5)), flags)
+            self.routers[relay.id_hex] = relay
+
+
+def measure(func, repeat=3, number=1):
+    """
+    Run `func` `number` times, `repeat` times over, and return the best and
+    mean duration of one call in seconds.
+    """
+    durations = [timeit.timeit(func, number=number) / number for _ in range(repeat)]
+    return {'best_s': min(durations), 'mean_s': sum(durations) / len(durations)}
+
+
+def write_results(name, params, results, output=None):
+    """
+    Return the JSON document of a benchmark run and write it to `output`.
+    """
+    document = json.dumps({
+        'benchmark': name,
+        'params': params,
+        'results': results,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+    }, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as output_file:
+            output_file.write(document)
+    return document
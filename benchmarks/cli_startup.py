@@ -0,0 +1,54 @@
+"""
+Measure the startup time of bwscan commands which don't need Tor, each run
+in a new process the way it is used from the shell. Run with:
+
+    python -m benchmarks.cli_startup --output cli_startup.json
+"""
+from __future__ import print_function, division
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from benchmarks import write_results
+
+COMMANDS = ('--help', 'list')
+
+
+def time_command(args, data_dir, repeat):
+    """
+    Return the best and mean wall time of running `bwscan args`.
+    """
+    command = [sys.executable, '-m', 'bwscanner', '--data-dir', data_dir,
+               '--logfile', os.path.join(data_dir, 'bwscanner.log')] + args
+    durations = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(command, stdout=devnull, stderr=devnull)
+            durations.append(time.time() - start)
+    return {'best_s': min(durations), 'mean_s': sum(durations) / len(durations)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of runs of each command.')
+    parser.add_argument('--output', help='Write the JSON results to this file.')
+    args = parser.parse_args(argv)
+
+    data_dir = mkdtemp()
+    try:
+        results = dict((command, time_command(command.split(), data_dir, args.repeat))
+                       for command in COMMANDS)
+    finally:
+        rmtree(data_dir)
+    print(write_results('cli_startup', {'repeat': args.repeat}, results, args.output))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,211 @@
+"""
+Micro-benchmarks of the scanner components on synthetic data: circuit
+generation, result writing, download hashing and loading scan results for
+aggregation. Run with:
+
+    python -m benchmarks.components --output components.json
+
+or a subset of them with e.g. `--only twohop,hashing`.
+"""
+from __future__ import print_function, division
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+from benchmarks import SyntheticState, measure, write_results
+from bwscanner.aggregate import load_measurement_data, mirror_bias
+from bwscanner.circuit import TwoHop
+from bwscanner.fetcher import hashingReadBodyProtocol, blockHashingReadBodyProtocol
+from bwscanner.manifest import DEFAULT_BLOCK_SIZE, sample_blocks
+from bwscanner.writer import ResultSink
+
+BENCHMARKS = ('twohop', 'result_sink', 'hashing', 'aggregation')
+CHUNK = os.urandom(64 * 1024)
+
+
+def fake_result(rng, relay_fp, mirror='https://mirror/'):
+    """
+    A measurement result with the fields BwScan writes.
+    """
+    circ_bw = rng.randint(10000, 10000000)
+    result = {
+        'time_start': 1500000000.0,
+        'time_end': 1500000010.0,
+        'path': [relay_fp, '${:040X}'.format(rng.randint(0, 10 ** 6))],
+        'mirror': mirror,
+    }
+    if rng.random() < 0.1:
+        result['failure'] = 'ResponseNeverReceived()'
+        result['failure_class'] = 'timeout'
+        result['attempt'] = 0
+    else:
+        result['circ_bw'] = circ_bw
+        result['path_bws'] = [circ_bw, circ_bw]
+        result['path_desc_bws'] = [[circ_bw, circ_bw, circ_bw]] * 2
+        result['path_ns_bws'] = [[circ_bw, False]] * 2
+    return result
+
+
+def bench_twohop(sizes):
+    """
+    Time building a TwoHop generator and drawing every circuit of a full
+    scan from it, and the cost of a single exit_by_bw call.
+    """
+    results = {}
+    for num_relays in sizes:
+        state = SyntheticState(num_relays)
+
+        def full_scan():
+            for _ in TwoHop(state):
+                pass
+
+        circuits = TwoHop(state)
+        relays = random.Random(1).sample(circuits.relays, 100)
+
+        def exit_by_bw():
+            for relay in relays:
+                circuits.exit_by_bw(relay)
+
+        results[str(num_relays)] = {
+            'full_scan': measure(full_scan),
+            'exit_by_bw_us': measure(exit_by_bw, number=10)['best_s'] / len(relays) * 1e6,
+        }
+    return results
+
+
+@defer.inlineCallbacks
+def bench_result_sink(sizes):
+    """
+    Measure how many results per second ResultSink writes with its default
+    chunk size, including waiting for the writer threads.
+    """
+    results = {}
+    rng = random.Random(0)
+    for num_results in sizes:
+        items = [fake_result(rng, '${:040X}'.format(i)) for i in range(num_results)]
+        out_dir = mkdtemp()
+        try:
+            sink = ResultSink(out_dir)
+            start = time.time()
+            for item in items:
+                sink.send(item)
+            yield sink.end_flush()
+            duration = time.time() - start
+        finally:
+            rmtree(out_dir)
+        results[str(num_results)] = {'duration_s': duration,
+                                     'results_per_s': num_results / duration}
+    defer.returnValue(results)
+
+
+def feed(protocol, size):
+    for _ in range(size // len(CHUNK)):
+        protocol.dataReceived(CHUNK)
+    protocol.connectionLost(Failure(ResponseDone()))
+
+
+def bench_hashing(size_mb):
+    """
+    Measure the CPU time per MB of hashing a download as a whole, per block
+    and for a sample of the blocks.
+    """
+    size = size_mb * 1024 * 1024
+    num_blocks = -(-size // DEFAULT_BLOCK_SIZE)
+
+    def full():
+        feed(hashingReadBodyProtocol(200, 'OK', defer.Deferred()), size)
+
+    def blocks():
+        feed(blockHashingReadBodyProtocol(206, 'Partial Content', defer.Deferred(),
+                                          DEFAULT_BLOCK_SIZE), size)
+
+    def sampled():
+        feed(blockHashingReadBodyProtocol(206, 'Partial Content', defer.Deferred(),
+                                          DEFAULT_BLOCK_SIZE,
+                                          sample=sample_blocks(num_blocks, 4)), size)
+
+    results = {}
+    for name, func in [('full', full), ('blocks', blocks), ('sampled', sampled)]:
+        results[name] = {'ms_per_mb': measure(func)['best_s'] * 1000 / size_mb}
+    return results
+
+
+def make_scan_dir(num_results, num_relays, chunk_size=1000):
+    """
+    Write a scan directory with `num_results` results for `num_relays`
+    relays measured through two mirrors.
+    """
+    rng = random.Random(0)
+    scan_dir = mkdtemp()
+    relays = ['${:040X}'.format(i) for i in range(num_relays)]
+    mirrors = ['https://mirror-1/', 'https://mirror-2/']
+    for start in range(0, num_results, chunk_size):
+        chunk = [fake_result(rng, rng.choice(relays), rng.choice(mirrors))
+                 for _ in range(min(chunk_size, num_results - start))]
+        with open(os.path.join(scan_dir, '{}-scan.json'.format(start)), 'w') as json_file:
+            json.dump(chunk, json_file)
+    return scan_dir
+
+
+def bench_aggregation(sizes):
+    """
+    Time loading scan directories of increasing size for aggregation and
+    computing the per-mirror bias.
+    """
+    results = {}
+    for num_results in sizes:
+        scan_dir = make_scan_dir(num_results, max(num_results // 5, 1))
+        try:
+            results[str(num_results)] = {
+                'load_measurement_data': measure(lambda: load_measurement_data([scan_dir])),
+                'mirror_bias': measure(lambda: mirror_bias([scan_dir])),
+            }
+        finally:
+            rmtree(scan_dir)
+    return results
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--only', type=lambda value: value.split(','), default=BENCHMARKS,
+                        help='Comma separated benchmarks to run, from: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--relays', type=int_list, default=[1000, 2000, 5000, 10000],
+                        help='Consensus sizes for the twohop benchmark.')
+    parser.add_argument('--results', type=int_list, default=[1000, 10000, 100000],
+                        help='Number of results for the result_sink and aggregation benchmarks.')
+    parser.add_argument('--hash-size', type=int, default=64,
+                        help='Download size in MB for the hashing benchmark.')
+    parser.add_argument('--output', help='Write the JSON results to this file.')
+    args = parser.parse_args(argv)
+
+    results = {}
+    if 'twohop' in args.only:
+        results['twohop'] = bench_twohop(args.relays)
+    if 'result_sink' in args.only:
+        results['result_sink'] = yield bench_result_sink(args.results)
+    if 'hashing' in args.only:
+        results['hashing'] = yield bench_hashing(args.hash_size)
+    if 'aggregation' in args.only:
+        results['aggregation'] = bench_aggregation(args.results)
+
+    params = {'relays': args.relays, 'results': args.results, 'hash_size_mb': args.hash_size}
+    print(write_results('components', params, results, args.output))
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
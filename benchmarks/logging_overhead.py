@@ -0,0 +1,54 @@
+"""
+Measure the time a log call takes on the reactor thread when the log file
+is written synchronously and when it is written by a QueuedLogObserver
+thread. Run with:
+
+    python -m benchmarks.logging_overhead --events 20000 --output logging.json
+"""
+from __future__ import print_function, division
+
+import argparse
+import os
+import sys
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.logger import FileLogObserver, Logger, LogPublisher
+
+from benchmarks import measure, write_results
+from bwscanner.logger import QueuedLogObserver, log_event_format
+
+
+def log_downloads(logger, events):
+    for i in range(events):
+        logger.info("Downloading file '{file_size}' over [{relay_fp}, {exit_fp}].",
+                    file_size='16M', relay_fp='${:040X}'.format(i), exit_fp='$' + 'A' * 40)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=20000,
+                        help='Number of messages logged in each run.')
+    parser.add_argument('--output', help='Write the JSON results to this file.')
+    args = parser.parse_args(argv)
+
+    tmpdir = mkdtemp()
+    results = {}
+    try:
+        with open(os.path.join(tmpdir, 'bwscanner.log'), 'w') as log_file:
+            file_observer = FileLogObserver(log_file, log_event_format)
+            queued_observer = QueuedLogObserver([file_observer])
+            for name, observer in [('synchronous', file_observer), ('queued', queued_observer)]:
+                logger = Logger('bwscanner', observer=LogPublisher(observer))
+                timing = measure(lambda: log_downloads(logger, args.events), repeat=3)
+                results[name] = dict((key.replace('_s', '_us'), 1e6 * value / args.events)
+                                     for key, value in timing.items())
+            queued_observer.stop()
+            results['queued']['dropped'] = queued_observer.dropped
+    finally:
+        rmtree(tmpdir)
+    print(write_results('logging_overhead', {'events': args.events}, results, args.output))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
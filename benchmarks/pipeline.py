@@ -0,0 +1,123 @@
+"""
+Measure the per-measurement overhead of the fetch/measure/report pipeline.
+
+`simulated_scan` runs a full simulated scan with the Deferred callback
+chains of BwScan.fetch and reports the wall time per measurement. The
+other results run a pipeline with the same stages as BwScan.fetch on
+Deferreds which have already fired, so only the cost of chaining the
+stages is measured, written as a callback chain, as an inlineCallbacks
+generator and, on Python 3.5+, as a native coroutine. Run with:
+
+    python -m benchmarks.pipeline --relays 2000 --output pipeline.json
+"""
+from __future__ import print_function, division
+
+import argparse
+import sys
+
+from twisted.internet import defer
+
+from benchmarks import measure, write_results
+from bwscanner.simulation import run_simulation
+
+
+def fetch(path):
+    return defer.succeed(path)
+
+
+def read_response(response):
+    return defer.succeed('body')
+
+
+def bw_lookup(path):
+    return defer.succeed([(1000, 900), (2000, 1800)])
+
+
+def add_dispatch_info(report):
+    report['mirror'] = 'http://mirror/'
+    return report
+
+
+def release_instance(result):
+    return result
+
+
+def send(report):
+    return defer.succeed(None)
+
+
+def callback_chain(path):
+    @defer.inlineCallbacks
+    def get_circuit_bw(body):
+        report = {'circ_bw': 1000, 'path': path}
+        path_bws = yield bw_lookup(path)
+        report['path_bws'] = path_bws
+        defer.returnValue(report)
+
+    d = fetch(path)
+    d.addCallback(read_response)
+    d.addCallbacks(get_circuit_bw)
+    d.addErrback(lambda failure: {'failure': repr(failure)})
+    d.addCallback(add_dispatch_info)
+    d.addBoth(release_instance)
+    d.addCallback(send)
+    return d
+
+
+@defer.inlineCallbacks
+def inline_callbacks(path):
+    try:
+        response = yield fetch(path)
+        yield read_response(response)
+        report = {'circ_bw': 1000, 'path': path}
+        report['path_bws'] = yield bw_lookup(path)
+    except Exception as e:
+        report = {'failure': repr(e)}
+    report = release_instance(add_dispatch_info(report))
+    yield send(report)
+
+
+PIPELINES = [('callback_chain', callback_chain), ('inline_callbacks', inline_callbacks)]
+
+if sys.version_info >= (3, 5):
+    # Compiled from a string so this module still compiles on Python 2
+    exec('''
+async def native_coroutine(path):
+    try:
+        response = await fetch(path)
+        await read_response(response)
+        report = {'circ_bw': 1000, 'path': path}
+        report['path_bws'] = await bw_lookup(path)
+    except Exception as e:
+        report = {'failure': repr(e)}
+    report = release_instance(add_dispatch_info(report))
+    await send(report)
+''')
+    PIPELINES.append(('native_coroutine',
+                      lambda path: defer.ensureDeferred(native_coroutine(path))))  # noqa: F821
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--relays', type=int, default=2000,
+                        help='Number of relays of the simulated scan.')
+    parser.add_argument('--number', type=int, default=20000,
+                        help='Number of runs of each pipeline per repeat.')
+    parser.add_argument('--output', help='Write the JSON results to this file.')
+    args = parser.parse_args(argv)
+
+    summary = run_simulation(args.relays)
+    measurements = summary['measurements'] + sum(summary['failures'].values())
+    results = {'simulated_scan': {'measurements': measurements,
+                                  'us_per_measurement': 1e6 * summary['wall_s'] / measurements}}
+    path = ['$A', '$B']
+    for name, pipeline in PIPELINES:
+        timing = measure(lambda: pipeline(path), repeat=3, number=args.number)
+        results[name] = dict((key.replace('_s', '_us'), 1e6 * value)
+                             for key, value in timing.items())
+    print(write_results('pipeline', {'relays': args.relays, 'number': args.number}, results,
+                        args.output))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
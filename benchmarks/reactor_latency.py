@@ -0,0 +1,136 @@
+"""
+Measure how much hashing concurrent downloads delays the reactor loop when
+the whole bodies are hashed, or when only a sample of the blocks of a range
+download is hashed.
+
+Each simulated download delivers one chunk of its body to a
+hashingReadBodyProtocol per reactor iteration, the way data arrives from
+the network, while a LoopingCall records how late the reactor runs it. Run
+with:
+
+    python -m benchmarks.reactor_latency --size 64 --concurrency 10
+"""
+from __future__ import print_function, division
+
+import argparse
+import os
+import sys
+import time
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+from benchmarks import write_results
+from bwscanner.fetcher import hashingReadBodyProtocol, blockHashingReadBodyProtocol
+from bwscanner.manifest import DEFAULT_BLOCK_SIZE, sample_blocks
+
+SAMPLE_BLOCKS = 4
+
+
+class LagMonitor(object):
+    """
+    Record how late each call of a LoopingCall is.
+    """
+    def __init__(self, clock, interval=0.005):
+        self.clock = clock
+        self.interval = interval
+        self.samples = []
+        self.last = None
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.clock = clock
+
+    def start(self):
+        self.loop.start(self.interval)
+
+    def stop(self):
+        self.loop.stop()
+
+    def tick(self):
+        now = self.clock.seconds()
+        if self.last is not None:
+            self.samples.append(max(0, now - self.last - self.interval))
+        self.last = now
+
+    def summary(self):
+        samples = sorted(self.samples) or [0]
+        return {
+            'samples': len(self.samples),
+            'mean_ms': 1000 * sum(samples) / len(samples),
+            'p99_ms': 1000 * samples[int(len(samples) * 0.99)],
+            'max_ms': 1000 * samples[-1],
+        }
+
+
+def make_protocol(mode, size):
+    d = defer.Deferred()
+    if mode == 'sampled':
+        sample = sample_blocks(-(-size // DEFAULT_BLOCK_SIZE), SAMPLE_BLOCKS)
+        protocol = blockHashingReadBodyProtocol(206, 'Partial Content', d, DEFAULT_BLOCK_SIZE,
+                                                sample=sample)
+    else:
+        protocol = hashingReadBodyProtocol(200, 'OK', d)
+    return protocol, d
+
+
+def download(reactor, chunk, num_chunks, mode):
+    """
+    Deliver `num_chunks` chunks to a hashing protocol, one per reactor
+    iteration, and return the Deferred of the protocol.
+    """
+    protocol, d = make_protocol(mode, len(chunk) * num_chunks)
+    remaining = [num_chunks]
+
+    def deliver():
+        if remaining[0]:
+            remaining[0] -= 1
+            protocol.dataReceived(chunk)
+            reactor.callLater(0, deliver)
+        else:
+            protocol.connectionLost(Failure(ResponseDone()))
+    reactor.callLater(0, deliver)
+    return d
+
+
+@defer.inlineCallbacks
+def run_downloads(reactor, size, chunk_size, concurrency, mode):
+    chunk = os.urandom(chunk_size)
+    num_chunks = size // chunk_size
+    monitor = LagMonitor(reactor)
+    monitor.start()
+    time_start = time.time()
+    cpu_start = time.clock()
+
+    yield defer.gatherResults([download(reactor, chunk, num_chunks, mode)
+                               for _ in range(concurrency)])
+
+    result = monitor.summary()
+    result['duration_s'] = time.time() - time_start
+    result['cpu_s'] = time.clock() - cpu_start
+    monitor.stop()
+    defer.returnValue(result)
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=64, help='Download size in MB.')
+    parser.add_argument('--chunk-size', type=int, default=64,
+                        help='Size of the chunks delivered to the protocol in kB.')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Number of simultaneous downloads.')
+    parser.add_argument('--output', help='Write the JSON results to this file.')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for mode in ['full', 'sampled']:
+        results[mode] = yield run_downloads(
+            reactor, args.size * 1024 * 1024, args.chunk_size * 1024, args.concurrency, mode)
+
+    params = {'size_mb': args.size, 'chunk_kb': args.chunk_size,
+              'concurrency': args.concurrency}
+    print(write_results('reactor_latency', params, results, args.output))
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,3 @@
+from bwscanner.scanner import cli
+
+cli(prog_name='bwscan')
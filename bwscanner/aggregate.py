@@ -3,23 +3,26 @@ import os
 import glob
 import json
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 from txtorcon.torcontrolprotocol import TorProtocolError
 from stem.descriptor.server_descriptor import RelayDescriptor
 from stem.descriptor.router_status_entry import RouterStatusEntryV3
 
 from bwscanner.logger import log
+from bwscanner.relays import load_relay_table
+from bwscanner.sketch import TDigest
+from bwscanner.writer import read_results
+
+# The digests of the measurements of each relay in a completed scan. It is
+# not a .json file so it isn't read as results.
+SKETCHES_FILE = 'bw_sketches'
 
 
 def load_json_measurements(scan_dirs):
     for directory in scan_dirs:
         for name in glob.glob(os.path.join(directory, "*.json")):
-            with open(os.path.join(directory, name), 'r') as json_file:
-                try:
-                    for y in json.load(json_file):
-                        yield dict(y)
-                except ValueError:
-                    log.error("Error reading JSON measurement file")
+            for y in read_results(os.path.join(directory, name)):
+                yield dict(y)
 
 
 def load_measurement_data(scan_dirs):
@@ -36,65 +39,213 @@ def load_measurement_data(scan_dirs):
     return measurements, failures
 
 
-@inlineCallbacks
-def write_aggregate_data(tor, scan_dirs, file_name="aggregate_measurements"):
-    # Get a tor controller connection, to obtain consensus bandwidth values
-    # XXX: Should this data be saved from the consensus at scan time.
+def scan_sketches(scan_dir):
+    """
+    Return the TDigest of the measured bandwidths of each relay in
+    `scan_dir`. The digests of a completed scan are saved in its directory
+    so its results are only read once.
+    """
+    sketches_path = os.path.join(scan_dir, SKETCHES_FILE)
+    if os.path.exists(sketches_path):
+        with open(sketches_path) as sketches_file:
+            return dict((relay, TDigest.from_dict(digest))
+                        for relay, digest in json.load(sketches_file).items())
+
+    sketches = {}
+    for item in load_json_measurements([scan_dir]):
+        if 'failure' in item:
+            continue
+        for relay in item['path']:
+            sketches.setdefault(relay, TDigest()).add(item['circ_bw'])
+
+    # Only completed scans are named with just their time
+    if os.path.basename(os.path.normpath(scan_dir)).isdigit():
+        tmp_path = sketches_path + '.tmp'
+        with open(tmp_path, 'w') as sketches_file:
+            json.dump(dict((relay, digest.to_dict()) for relay, digest in sketches.items()),
+                      sketches_file)
+        os.rename(tmp_path, sketches_path)
+    return sketches
+
+
+def load_sketches(scan_dirs):
+    """
+    Return the TDigest of the measured bandwidths of each relay over all of
+    `scan_dirs`.
+    """
+    sketches = {}
+    for scan_dir in scan_dirs:
+        for relay, digest in scan_sketches(scan_dir).items():
+            if relay in sketches:
+                sketches[relay].merge(digest)
+            else:
+                sketches[relay] = digest
+    return sketches
 
-    # FIXME: how do we know when all these things are downloaded??
-    log.info("Loading JSON measurement files")
-    measurements, failures = load_measurement_data(scan_dirs)
 
-    oldest_timestamp = os.path.basename(scan_dirs[-1])
-    aggregate_filename = os.path.join(scan_dirs[0], file_name)
-    aggregate_file = open(aggregate_filename, 'w')
+def mirror_bias(scan_dirs):
+    """
+    Compare the measurements made with each file server mirror.
 
-    aggregate_file.write("0\n")  # Always use 0 as the slice number
-    aggregate_file.write(oldest_timestamp + "\n")
+    Each successful measurement is divided by the mean bandwidth measured
+    for its relay, so a mirror with a mean `bw_ratio` well below 1 makes
+    relays look slower than the other mirrors do. Only relays measured
+    with more than one mirror are used for the ratio.
+    """
+    samples, stats = {}, {}
+    for item in load_json_measurements(scan_dirs):
+        mirror = item.get('mirror')
+        if mirror is None:
+            continue
+        mirror_stats = stats.setdefault(mirror, {'measurements': 0, 'failures': 0,
+                                                 'bw_ratio': None})
+        if 'failure' in item:
+            mirror_stats['failures'] += 1
+        else:
+            mirror_stats['measurements'] += 1
+            samples.setdefault(item['path'][0], []).append((mirror, item['circ_bw']))
 
-    log.info("Processing the loaded bandwidth measurements")
-    for relay_fp in measurements.keys():
-        log.debug("Aggregating measurements for {relay}", relay=relay_fp)
+    ratios = {}
+    for relay_samples in samples.values():
+        mean_bw = sum(bw for _, bw in relay_samples) / len(relay_samples)
+        if len(set(mirror for mirror, _ in relay_samples)) < 2 or mean_bw <= 0:
+            continue
+        for mirror, bw in relay_samples:
+            ratios.setdefault(mirror, []).append(bw / mean_bw)
+    for mirror, mirror_ratios in ratios.items():
+        stats[mirror]['bw_ratio'] = sum(mirror_ratios) / len(mirror_ratios)
+    return stats
+
+
+def write_mirror_bias(scan_dirs, file_name):
+    stats = mirror_bias(scan_dirs)
+    if len(stats) < 2:
+        return
+    with open(file_name, 'w') as bias_file:
+        json.dump(stats, bias_file, sort_keys=True, indent=2)
+    for mirror, mirror_stats in sorted(stats.items()):
+        log.info("Mirror {mirror}: {measurements} measurements, {failures} failures, "
+                 "bandwidth ratio {bw_ratio}.", mirror=mirror, **mirror_stats)
+
+
+def relay_bandwidths(measurements):
+    """
+    Return the mean and "filtered" bandwidth, the mean of the measurements
+    at or above the mean, of each relay with a valid filtered bandwidth.
+    """
+    bandwidths = {}
+    for relay_fp, bws in measurements.items():
+        mean_bw = int(sum(bws) // len(bws))
+        filtered_bws = [bw for bw in bws if bw >= mean_bw]
+        mean_filtered_bw = int(sum(filtered_bws) // len(filtered_bws)) if filtered_bws else 0
+        if mean_filtered_bw <= 0:
+            log.debug("Could not calculate a valid filtered bandwidth for {relay}, skipping it.",
+                      relay=relay_fp)
+            continue
+        bandwidths[relay_fp] = (mean_bw, mean_filtered_bw)
+    return bandwidths
+
+
+def aggregate_lines(measurements, failures, relay_info, sketches=None):
+    """
+    Return the bandwidth file line of each measured relay.
+
+    measurements: map of relay fingerprint -> list of measured bandwidths
+    failures: map of relay fingerprint -> list of failed measurements
+    relay_info: map of relay fingerprint -> (nickname, descriptor
+    bandwidth, NetworkStatus bandwidth), relays missing from it are not in
+    the consensus and are skipped
+    sketches: optional map of relay fingerprint -> TDigest of its
+    measurements, adds their median and 90th percentile to the lines
+    """
+    line_format = ("node_id={} nick={} strm_bw={} filt_bw={} circ_fail_rate={} "
+                   "desc_bw={} ns_bw={}")
+    lines = []
+    for relay_fp, (mean_bw, mean_filtered_bw) in sorted(relay_bandwidths(measurements).items()):
+        if relay_fp not in relay_info:
+            log.info("Relay {fp} not found in consensus!", fp=relay_fp)
+            continue
+        nickname, desc_bw, ns_bw = relay_info[relay_fp]
 
-        mean_bw = int(sum(measurements[relay_fp]) // len(measurements[relay_fp]))
+        if relay_fp in failures and (len(failures) + len(measurements)) > 5:
+            num_failures = len(failures[relay_fp])
+            num_measurements = len(measurements[relay_fp])
+            circ_fail_rate = num_failures / (num_measurements + num_failures)
+        else:
+            log.debug("Not enough measurements to calculate the circuit fail rate.")
+            circ_fail_rate = 0.0
 
-        # Calculated the "filtered bandwidth"
-        filtered_bws = [bw for bw in measurements[relay_fp] if bw >= mean_bw]
-        if filtered_bws:
-            mean_filtered_bw = int(sum(filtered_bws) // len(filtered_bws))
-        if not filtered_bws or mean_filtered_bw <= 0:
-            log.debug("Could not calculate a valid filtered bandwidth, skipping relay.")
-            continue
+        line = line_format.format(relay_fp, nickname, mean_bw, mean_filtered_bw,
+                                  circ_fail_rate, desc_bw, ns_bw)
+        if sketches is not None and relay_fp in sketches:
+            line += " median_bw={} p90_bw={}".format(int(sketches[relay_fp].quantile(0.5)),
+                                                     int(sketches[relay_fp].quantile(0.9)))
+        lines.append(line + "\n")
+    return lines
+
+
+def write_bandwidth_file(file_name, timestamp, lines):
+    """
+    Write the bandwidth file atomically: readers see either the previous
+    file or the complete new one.
+    """
+    tmp_name = file_name + '.tmp'
+    with open(tmp_name, 'w') as tmp_file:
+        tmp_file.write("0\n")  # Always use 0 as the slice number
+        tmp_file.write("{}\n".format(timestamp))
+        tmp_file.writelines(lines)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.rename(tmp_name, file_name)
 
+
+@inlineCallbacks
+def consensus_relay_info(tor, relays):
+    """
+    Return the relay info aggregate_lines expects for `relays` from the
+    current consensus of a Tor instance.
+    """
+    relay_info = {}
+    for relay_fp in relays:
         try:
             routerstatus_info = yield tor.protocol.get_info_raw('ns/id/' + relay_fp.lstrip("$"))
             descriptor_info = yield tor.protocol.get_info_raw('desc/id/' + relay_fp.lstrip("$"))
         except TorProtocolError:
-            log.info("Relay {fp} not found in consensus!", fp=relay_fp)
             continue
 
         relay_routerstatus = RouterStatusEntryV3(routerstatus_info)
         relay_descriptor = RelayDescriptor(descriptor_info)
+        relay_info[relay_fp] = (relay_descriptor.nickname, relay_descriptor.average_bandwidth,
+                                relay_routerstatus.bandwidth)
+    returnValue(relay_info)
 
-        ns_bw = relay_routerstatus.bandwidth
-        nickname = relay_descriptor.nickname
 
-        if (relay_fp in failures and relay_fp in measurements and
-                (len(failures) + len(measurements)) > 5):
-            num_failures = len(failures[relay_fp])
-            num_measurements = len(measurements[relay_fp])
-            circ_fail_rate = num_failures / (num_measurements + num_failures)
-        else:
-            log.debug("Not enough measurements to calculate the circuit fail rate.")
-            circ_fail_rate = 0.0
-
-        desc_bw = relay_descriptor.average_bandwidth
-        line_format = ("node_id={} nick={} strm_bw={} filt_bw={} circ_fail_rate={} "
-                       "desc_bw={} ns_bw={}\n")
+@inlineCallbacks
+def write_aggregate_data(tor, scan_dirs, file_name="aggregate_measurements", quantiles=False):
+    """
+    Write the bandwidth file of the measurements in `scan_dirs`. The relay
+    bandwidths are read from the relay table stored with the most recent
+    scan, or from the current consensus of `tor` for scans made without
+    one.
+    """
+    # FIXME: how do we know when all these things are downloaded??
+    log.info("Loading JSON measurement files")
+    measurements, failures = load_measurement_data(scan_dirs)
 
-        aggregate_file.write(line_format.format(relay_fp, nickname, mean_bw, mean_filtered_bw,
-                                                circ_fail_rate, desc_bw, ns_bw))
+    oldest_timestamp = os.path.basename(scan_dirs[-1])
+    aggregate_filename = os.path.join(scan_dirs[0], file_name)
 
-    aggregate_file.close()
+    log.info("Processing the loaded bandwidth measurements")
+    relay_table = load_relay_table(scan_dirs[0])
+    if relay_table is not None:
+        relay_info = relay_table.relay_info()
+    else:
+        relay_info = yield consensus_relay_info(tor, relay_bandwidths(measurements))
+
+    sketches = load_sketches(scan_dirs) if quantiles else None
+    write_bandwidth_file(aggregate_filename, oldest_timestamp,
+                         aggregate_lines(measurements, failures, relay_info, sketches))
     log.info("Finished outputting the aggregated measurements to {file}.",
              file=aggregate_filename)
+
+    write_mirror_bias(scan_dirs, os.path.join(scan_dirs[0], "mirror_bias"))
@@ -1,9 +1,58 @@
+import calendar
+import os
+import time
+
 import txtorcon
-from twisted.internet import defer, reactor, endpoints
+from twisted.internet import defer, endpoints
 
 from bwscanner.logger import log
 
 
+# The full (not microdescriptor) consensus in Tor's data directory
+CONSENSUS_FILE = 'cached-consensus'
+
+
+class StartupTimings(object):
+    """
+    Time the consecutive phases of connecting to Tor.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.phases = []
+        self._start = clock.seconds()
+
+    def phase(self, name):
+        """
+        End the phase `name`, which started when the previous one ended.
+        """
+        now = self.clock.seconds()
+        self.phases.append((name, now - self._start))
+        self._start = now
+
+    def summary(self):
+        return ', '.join('{} {:.1f}s'.format(name, duration) for name, duration in self.phases)
+
+
+def cached_consensus_valid_until(data_dir):
+    """
+    Return the valid-until time of the full consensus cached in Tor's
+    `data_dir`, or None if there is no readable one.
+    """
+    try:
+        with open(os.path.join(data_dir, CONSENSUS_FILE)) as consensus:
+            for line in consensus:
+                if line.startswith('valid-until '):
+                    valid_until = time.strptime(line.split(' ', 1)[1].strip(),
+                                                '%Y-%m-%d %H:%M:%S')
+                    return calendar.timegm(valid_until)
+                if line.startswith('dir-source '):
+                    # The header is over
+                    break
+    except (IOError, ValueError):
+        pass
+    return None
+
+
 def options_need_new_consensus(tor_config, new_options):
     """
     Check if we need to wait for a new consensus after updating
@@ -33,20 +82,35 @@ def wait_for_newconsensus(tor_state):
 @defer.inlineCallbacks
 def connect_to_tor(launch_tor, circuit_build_timeout, tor_options,
                    tor_dir=None, control_port=None,
-                   tor_overrides=None):
+                   tor_overrides=None, reactor=None):
     """
     Launch or connect to a Tor instance
 
-    Configure Tor with the passed options and return a Deferred
+    Configure Tor with the passed options and return a Deferred. The global
+    reactor, the one chosen with `bwscan --reactor`, is used by default.
     """
+    if reactor is None:
+        from twisted.internet import reactor
     # FIXME: tor_overrides should probably be removed
     # Options for spawned or running Tor to load the correct descriptors.
     if tor_overrides:
         tor_options.update(tor_overrides)
 
+    timings = StartupTimings(reactor)
     if launch_tor:
         log.info("Spawning a new Tor instance.")
-        tor = yield txtorcon.launch(reactor, data_directory=tor_dir)
+
+        def progress_updates(percent, tag, summary):
+            if not timings.phases:
+                timings.phase('launch')
+            log.debug("Tor bootstrap {percent}%: {summary}", percent=percent, summary=summary)
+
+        # Our options are set below like for a running Tor. With
+        # UseMicroDescriptors off Tor switches to the full consensus cached
+        # in `tor_dir` by a previous run if it is still valid.
+        tor = yield txtorcon.launch(reactor, progress_updates=progress_updates,
+                                    data_directory=tor_dir)
+        timings.phase('bootstrap' if timings.phases else 'launch')
     else:
         log.info("Trying to connect to a running Tor instance.")
         if control_port:
@@ -54,10 +118,12 @@ def connect_to_tor(launch_tor, circuit_build_timeout, tor_options,
         else:
             endpoint = None
         tor = yield txtorcon.connect(reactor, endpoint)
+        timings.phase('connect')
 
     # Get Tor state first to avoid a race conditions where CONF_CHANGED
     # messages are received while Txtorcon is reading the consensus.
     tor_state = yield tor.create_state()
+    timings.phase('create_state')
 
     # Get current TorConfig object
     tor_config = yield tor.get_config()
@@ -67,8 +133,49 @@ def connect_to_tor(launch_tor, circuit_build_timeout, tor_options,
     for key, value in tor_options.items():
         setattr(tor_config, key, value)
     yield tor_config.save()  # Send updated options to Tor
+    timings.phase('config_save')
 
     if wait_for_consensus:
-        yield wait_for_newconsensus(tor_state)
+        # Tor loads the cached full consensus when it starts, it is used
+        # as soon as UseMicroDescriptors is off if it is still valid.
+        valid_until = cached_consensus_valid_until(tor_config.DataDirectory)
+        if valid_until is not None and valid_until > reactor.seconds():
+            log.info("Using the cached consensus, valid until {valid_until}.",
+                     valid_until=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(valid_until)))
+        else:
+            log.info("Waiting for a new consensus, there is no valid cached one.")
+            yield wait_for_newconsensus(tor_state)
+            timings.phase('consensus_wait')
 
+    log.info("Connected to Tor: {timings}.", timings=timings.summary())
     defer.returnValue(tor_state)
+
+
+def connect_to_tor_instances(count, launch_tor, circuit_build_timeout, tor_options,
+                             tor_dir, control_ports=(), first_instance=0):
+    """
+    Launch or connect to `count` Tor instances and return a Deferred which
+    fires with the list of their states.
+
+    Launched instances each use their own data directory under `tor_dir`,
+    instance-N numbered from `first_instance`, and a SOCKS port chosen by
+    txtorcon. `tor_dir` must then not be the data directory of another
+    instance.
+    Otherwise we connect to the instances listening on `control_ports`.
+    """
+    if not launch_tor and len(control_ports) < count:
+        raise ValueError("Need {} control ports to connect to {} Tor instances.".format(
+            count, count))
+
+    tor_states = []
+    for i in range(count):
+        if launch_tor:
+            instance_dir = os.path.join(tor_dir, 'instance-{}'.format(first_instance + i))
+            if not os.path.isdir(instance_dir):
+                os.makedirs(instance_dir)
+            tor_states.append(connect_to_tor(launch_tor, circuit_build_timeout, tor_options,
+                                             tor_dir=instance_dir))
+        else:
+            tor_states.append(connect_to_tor(launch_tor, circuit_build_timeout, tor_options,
+                                             control_port=control_ports[i]))
+    return defer.gatherResults(tor_states, consumeErrors=True)
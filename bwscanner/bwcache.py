@@ -0,0 +1,132 @@
+"""
+Cache of the relay bandwidth values Tor reports over the control port.
+"""
+import time
+
+from stem.descriptor.server_descriptor import ServerDescriptor
+from stem.descriptor.networkstatus import RouterStatusEntryV3
+
+from twisted.internet import defer
+
+from bwscanner.logger import log
+
+
+def parse_ns_bw(raw_entry):
+    """
+    Return the NetworkStatus bandwidth and Measured flag from a router status entry.
+    """
+    router_ns_entry = RouterStatusEntryV3(raw_entry)
+    return (router_ns_entry.bandwidth, router_ns_entry.is_unmeasured)
+
+
+def parse_desc_bw(raw_descriptor):
+    """
+    Return the ServerDescriptor average_bandwidth, burst_bandwidth, and
+    observed_bandwidth from a server descriptor.
+    """
+    server_descriptor = ServerDescriptor(raw_descriptor)
+    return (server_descriptor.average_bandwidth,
+            server_descriptor.burst_bandwidth,
+            server_descriptor.observed_bandwidth)
+
+
+class BandwidthCache(object):
+    """
+    Store the descriptor and NetworkStatus bandwidths of relays for the
+    current consensus.
+
+    The NetworkStatus values are dropped when Tor receives a new consensus
+    and the descriptor values of a relay are dropped when Tor receives a new
+    descriptor for it. Values missing from the cache are requested with a
+    single GETINFO command. A reply is only cached if the values it
+    replaces weren't dropped while it was requested.
+    """
+
+    def __init__(self, tor_protocol):
+        self.protocol = tor_protocol
+        self.desc_bws = {}
+        self.ns_bws = {}
+        # Counted up at each new consensus and, for each relay, at each new
+        # descriptor since the last consensus.
+        self.generation = 0
+        self.desc_generations = {}
+        # The number of GETINFO requests and their total duration
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.protocol.add_event_listener('NEWCONSENSUS', self.new_consensus)
+        self.protocol.add_event_listener('NEWDESC', self.new_descriptors)
+
+    def new_consensus(self, event):
+        log.debug("New consensus, clearing the cached relay bandwidths.")
+        self.ns_bws.clear()
+        self.desc_bws.clear()
+        self.generation += 1
+        self.desc_generations.clear()
+
+    def new_descriptors(self, event):
+        """
+        NEWDESC events contain a space separated list of $fingerprint~nickname
+        entries.
+        """
+        for relay in event.split():
+            relay_fp = relay[:41]
+            self.desc_bws.pop(relay_fp, None)
+            self.desc_generations[relay_fp] = self.desc_generations.get(relay_fp, 0) + 1
+
+    def add_relay_table(self, relay_table):
+        """
+        Cache the bandwidths of the relays of the RelayTable of the current
+        consensus, so they are not requested again.
+        """
+        for relay in relay_table.routers.values():
+            self.ns_bws[relay.id_hex] = (relay.bandwidth, relay.unmeasured)
+            if relay.desc_bw is not None:
+                self.desc_bws[relay.id_hex] = relay.desc_bw
+
+    @defer.inlineCallbacks
+    def get(self, relays):
+        """
+        Return a list of (descriptor bandwidths, NetworkStatus bandwidths)
+        tuples for `relays`.
+
+        :param: relays, list of txtorcon.router.Router
+        """
+        # The cache may be cleared by a NEWDESC or NEWCONSENSUS event while
+        # waiting for GETINFO, so the values are taken from this snapshot
+        # and the reply rather than from the shared dicts.
+        desc_bws, ns_bws = {}, {}
+        keys = []
+        for relay in relays:
+            if relay.id_hex in self.desc_bws:
+                desc_bws[relay.id_hex] = self.desc_bws[relay.id_hex]
+            else:
+                keys.append('desc/id/{}'.format(relay.id_hex))
+            if relay.id_hex in self.ns_bws:
+                ns_bws[relay.id_hex] = self.ns_bws[relay.id_hex]
+            else:
+                keys.append('ns/id/{}'.format(relay.id_hex))
+        keys = sorted(set(keys))
+
+        if keys:
+            generation = self.generation
+            desc_generations = dict((relay.id_hex, self.desc_generations.get(relay.id_hex, 0))
+                                    for relay in relays)
+            start = time.time()
+            info = yield self.protocol.get_info(*keys)
+            self.requests += 1
+            self.request_seconds += time.time() - start
+            current = generation == self.generation
+            for key in keys:
+                kind, _, relay_fp = key.split('/', 2)
+                if kind == 'desc':
+                    desc_bws[relay_fp] = parse_desc_bw(info[key])
+                    if current and (desc_generations[relay_fp] ==
+                                    self.desc_generations.get(relay_fp, 0)):
+                        self.desc_bws[relay_fp] = desc_bws[relay_fp]
+                else:
+                    ns_bws[relay_fp] = parse_ns_bw(info[key])
+                    if current:
+                        self.ns_bws[relay_fp] = ns_bws[relay_fp]
+
+        defer.returnValue([(desc_bws[relay.id_hex], ns_bws[relay.id_hex])
+                           for relay in relays])
@@ -0,0 +1,103 @@
+"""
+The throughput of the measurement circuits as counted by Tor.
+
+Tor sends a CIRC_BW event every second for each circuit which had traffic
+in that second, and a STREAM_BW event for each stream. The bytes read on
+the circuit of a measurement give its throughput without the circuit build
+time and the reactor delays which are in the wall clock duration of the
+request.
+"""
+
+# The STREAM statuses after which a stream has no more traffic
+CLOSED_STREAM_STATUSES = ('CLOSED', 'FAILED')
+
+
+def event_fields(event):
+    """
+    Return the KEY=value fields of a control event as a dict.
+    """
+    return dict(arg.split('=', 1) for arg in event.split() if '=' in arg)
+
+
+def tor_throughput(reads):
+    """
+    Return the mean bytes/s of the seconds of a transfer from the bytes
+    read in each second. The first and last seconds are only partly used
+    by the transfer, they are left out when there are others.
+    """
+    if len(reads) > 2:
+        reads = reads[1:-1]
+    return int(sum(reads) // len(reads)) if reads else None
+
+
+class BandwidthEvents(object):
+    """
+    Collect the bytes read each second on the watched circuits of a Tor
+    instance from its CIRC_BW events, and from the STREAM_BW events of their
+    streams for versions of Tor without CIRC_BW.
+    """
+    def __init__(self, tor_protocol):
+        self.protocol = tor_protocol
+        # Map of watched circuit id -> bytes read in each CIRC_BW event and
+        # in each STREAM_BW event of its streams
+        self.circ_reads = {}
+        self.stream_reads = {}
+        # Map of stream id -> circuit id of the streams of watched circuits
+        self.stream_circuits = {}
+        self.listeners = [('CIRC_BW', self.circ_bw), ('STREAM', self.stream),
+                          ('STREAM_BW', self.stream_bw)]
+        for event, listener in self.listeners:
+            self.protocol.add_event_listener(event, listener)
+
+    def watch(self, circuit_id):
+        circuit_id = str(circuit_id)
+        self.circ_reads[circuit_id] = []
+        self.stream_reads[circuit_id] = []
+
+    def collect(self, circuit_id):
+        """
+        Stop watching a circuit and return the bytes read on it in each
+        second since it was watched.
+        """
+        circuit_id = str(circuit_id)
+        circ_reads = self.circ_reads.pop(circuit_id, [])
+        stream_reads = self.stream_reads.pop(circuit_id, [])
+        for stream_id, stream_circuit in list(self.stream_circuits.items()):
+            if stream_circuit == circuit_id:
+                del self.stream_circuits[stream_id]
+        return circ_reads or stream_reads
+
+    def circ_bw(self, event):
+        """
+        CIRC_BW ID=CircuitID READ=BytesRead WRITTEN=BytesWritten ...
+        """
+        fields = event_fields(event)
+        reads = self.circ_reads.get(fields.get('ID'))
+        if reads is not None:
+            reads.append(int(fields.get('READ', 0)))
+
+    def stream(self, event):
+        """
+        STREAM StreamID StreamStatus CircuitID Target ...
+        """
+        args = event.split()
+        if len(args) < 3:
+            return
+        stream_id, status, circuit_id = args[:3]
+        if status in CLOSED_STREAM_STATUSES:
+            self.stream_circuits.pop(stream_id, None)
+        elif circuit_id in self.stream_reads:
+            self.stream_circuits[stream_id] = circuit_id
+
+    def stream_bw(self, event):
+        """
+        STREAM_BW StreamID BytesWritten BytesRead ...
+        """
+        args = event.split()
+        circuit_id = self.stream_circuits.get(args[0]) if args else None
+        if circuit_id is not None:
+            self.stream_reads[circuit_id].append(int(args[2]))
+
+    def stop(self):
+        for event, listener in self.listeners:
+            self.protocol.remove_event_listener(event, listener)
@@ -30,9 +30,15 @@ def random_path_to_exit(exit_relay, relays):
 
 class CircuitGenerator(object):
     def __init__(self, state):
+        """
+        state: a TorState, or a RelayTable, whose `routers` the circuits are
+        chosen from
+        """
         self.state = state
         # FIXME: don't we want to remove the exits from the list of relays?
-        self.relays = list(set(r for r in state.routers.values() if r))
+        # Sorted so the same random seed always gives the same circuits
+        self.relays = sorted(set(r for r in state.routers.values() if r),
+                             key=operator.attrgetter('id_hex'))
         self.exits = [relay for relay in self.relays if is_valid_exit(relay)]
 
     def __iter__(self):
@@ -47,23 +53,46 @@ class TwoHop(CircuitGenerator):
     Select two hop circuits with the relay to be measured and a random exit
     relay of similar bandwidth.
     """
-    def __init__(self, state, partitions=1, this_partition=1, slice_width=50):
+    def __init__(self, state, partitions=1, this_partition=1, slice_width=50, relays=None,
+                 exclude=None, skip=None):
         """
         TwoHop can be called multiple times with different partition
         values to produce slices containing a subset of the relays. These
         partitions are not grouped by bandwidth.
+
+        When `relays` is a list of fingerprints only those relays are
+        measured and the partition values are ignored. Relays whose
+        fingerprints are in `exclude` are not measured, this is used to
+        resume an interrupted scan. Relays in `skip` are not measured either
+        and their fingerprints are kept in `skipped`.
         """
         super(TwoHop, self).__init__(state)
         self._slice_width = slice_width
         self.exits.sort(key=operator.attrgetter('bandwidth'))
 
+        num_relays = len(self.relays)
+        if relays is not None:
+            wanted = set(relays)
+            relay_subset = [i for i, relay in enumerate(self.relays)
+                            if relay.id_hex in wanted]
+        else:
+            relay_subset = range(this_partition-1, num_relays, partitions)
+        if exclude:
+            relay_subset = [i for i in relay_subset if self.relays[i].id_hex not in exclude]
+        # The relays of this pass which are skipped
+        self.skipped = []
+        if skip:
+            self.skipped = [self.relays[i].id_hex for i in relay_subset
+                            if self.relays[i].id_hex in skip]
+            relay_subset = [i for i in relay_subset if self.relays[i].id_hex not in skip]
+        # The number of circuits in this pass
+        self.num_circuits = len(relay_subset)
+
         def circuit_generator():
             """
             Select relays from the partition in a random order. Also
             choose an exit relay of similar bandwidth for the circuit
             """
-            num_relays = len(self.relays)
-            relay_subset = range(this_partition-1, num_relays, partitions)
             log.info("Performing a measurement scan with {count} relays.", count=len(relay_subset))
 
             # Choose relays in a random order fromm the relays in this partition set.
@@ -73,11 +102,14 @@ class TwoHop(CircuitGenerator):
 
         self._circgen = circuit_generator()
 
-    def exit_by_bw(self, relay):
+    def exit_by_bw(self, relay, exclude=()):
         """
         Find an exit relay with a similar bandwidth to the `relay` being
         measured.
 
+        Exits in `exclude` are avoided unless they are the only exits in the
+        chosen slice.
+
         We can select a slower bandwidth exit relay if we don't have enough
         faster exit relays available to create a full slice. We try to
         pick an exit from a full width slice if possible.
@@ -88,7 +120,7 @@ class TwoHop(CircuitGenerator):
         num_exits = len(self.exits)
         for i, exit in enumerate(self.exits):
             # Skip exit if it's slower, and we have more exits left to choose.
-            if (exit.bandwidth < relay.bandwidth) and (i != num_exits):
+            if (exit.bandwidth < relay.bandwidth) and (i != num_exits - 1):
                 continue
 
             exit_slice = self.exits[i:i+self._slice_width]
@@ -101,7 +133,8 @@ class TwoHop(CircuitGenerator):
 
             if relay in exit_slice:
                 exit_slice.remove(relay)
-            return random.choice(exit_slice)
+            candidates = [exit for exit in exit_slice if exit not in exclude]
+            return random.choice(candidates or exit_slice)
 
         raise ValueError("Did not find a suitable exit relay to build this "
                          "circuit.")
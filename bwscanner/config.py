@@ -39,3 +39,6 @@ TOR_OPTIONS = {
     'SafeLogging': 0,
     'LogTimeGranularity': 1,
 }
+# How the downloaded data is checked: hash all of it, or hash only a sample
+# of the blocks of a range download.
+INTEGRITY_MODES = ('full', 'sampled')
@@ -0,0 +1,333 @@
+"""
+Share the relays of a scan between scanners running on several hosts.
+
+The coordinator splits the relays into work units and leases them to
+scanners over a small HTTP/JSON API. A lease expires if the scanner doesn't
+upload results for its unit in time and the unit is then leased to another
+scanner, so the share of a slow or dead scanner is still measured.
+
+API, all requests are POSTs with a JSON body:
+
+/lease      {"client": name}
+            -> {"unit": id, "relays": [fingerprint, ...], "lease_timeout": s}
+            -> {"unit": null, "retry_after": s} while all units are leased
+            -> {"unit": null, "done": true} once every unit is measured
+/results    {"client": name, "unit": id, "results": [...], "final": bool}
+            -> {"accepted": count}
+/status     {} -> the number of pending, leased and done units
+
+When the coordinator has a token, requests must carry it in an
+"Authorization: Bearer <token>" header.
+"""
+import hmac
+import json
+from collections import deque
+from io import BytesIO
+
+from twisted.internet import defer, task
+from twisted.web import http
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+
+from bwscanner.logger import log
+
+
+class CoordinatorError(Exception):
+    pass
+
+
+class ScanFinished(CoordinatorError):
+    """
+    Results were uploaded after every unit of the scan was done.
+    """
+
+
+def check_results(results):
+    """
+    Raise ValueError unless `results` is a list of result objects, the
+    result sink needs each one to have a `path` list.
+    """
+    if not isinstance(results, list):
+        raise ValueError("The results must be a list.")
+    for result in results:
+        if not isinstance(result, dict) or not isinstance(result.get('path'), list):
+            raise ValueError("Each result must be an object with a path list.")
+
+
+class WorkCoordinator(object):
+    """
+    Lease units of relays to measure and collect their results.
+    """
+    def __init__(self, relays, result_sink, clock, unit_size=50, lease_timeout=1800,
+                 retry_after=30):
+        """
+        relays: the fingerprints of the relays to measure
+        result_sink: the sink the uploaded results are sent to
+        clock: the reactor, or a task.Clock in tests, used to expire leases
+        unit_size: the number of relays in each work unit
+        lease_timeout: the number of seconds a scanner has to upload
+        results for its unit, each uploaded batch renews the lease
+        retry_after: how long scanners should wait before asking for work
+        again when all units are leased
+        """
+        self.units = [relays[i:i + unit_size] for i in range(0, len(relays), unit_size)]
+        self.result_sink = result_sink
+        self.clock = clock
+        self.lease_timeout = lease_timeout
+        self.retry_after = retry_after
+
+        self.pending = deque(range(len(self.units)))
+        # Map unit -> (client, lease expiry time)
+        self.leases = {}
+        self.done = set()
+        self.finished = defer.Deferred()
+        if not self.units:
+            self.finished.callback(None)
+
+    def expire_leases(self):
+        """
+        Put the units with expired leases back at the front of the queue so
+        they are leased again first.
+        """
+        now = self.clock.seconds()
+        expired = []
+        for unit, (client, expiry) in sorted(self.leases.items()):
+            if expiry <= now:
+                log.warn("Lease of unit {unit} by {client} expired.", unit=unit, client=client)
+                del self.leases[unit]
+                expired.append(unit)
+        self.pending.extendleft(reversed(expired))
+
+    def lease(self, client):
+        self.expire_leases()
+        if not self.pending:
+            if len(self.done) == len(self.units):
+                return {'unit': None, 'done': True}
+            return {'unit': None, 'retry_after': self.retry_after}
+
+        unit = self.pending.popleft()
+        self.leases[unit] = (client, self.clock.seconds() + self.lease_timeout)
+        log.info("Leased unit {unit} with {count} relays to {client}.", unit=unit,
+                 count=len(self.units[unit]), client=client)
+        return {'unit': unit, 'relays': self.units[unit], 'lease_timeout': self.lease_timeout}
+
+    def submit(self, client, unit, results, final=False):
+        """
+        Store a batch of results for `unit`.
+
+        Results for a unit whose lease expired are still kept. The unit is
+        done once any scanner uploads its final batch. Results are refused
+        once the whole scan is finished, its directory may already be
+        renamed.
+        """
+        if not 0 <= unit < len(self.units):
+            raise KeyError(unit)
+        check_results(results)
+        if self.finished.called:
+            raise ScanFinished("The scan is finished.")
+        for result in results:
+            self.result_sink.send(result)
+
+        if unit in self.done:
+            return len(results)
+        if final:
+            self.leases.pop(unit, None)
+            if unit in self.pending:
+                self.pending.remove(unit)
+            self.done.add(unit)
+            log.info("Unit {unit} finished by {client}, {done}/{total} done.", unit=unit,
+                     client=client, done=len(self.done), total=len(self.units))
+            if len(self.done) == len(self.units):
+                self.finished.callback(None)
+        elif self.leases.get(unit, (None,))[0] == client:
+            self.leases[unit] = (client, self.clock.seconds() + self.lease_timeout)
+        return len(results)
+
+    def status(self):
+        self.expire_leases()
+        return {'pending': len(self.pending), 'leased': len(self.leases),
+                'done': len(self.done), 'units': len(self.units)}
+
+
+class JSONResource(Resource):
+    """
+    Decode the JSON body of POST requests, pass it to `handler` and encode
+    the object it returns as the JSON response.
+    """
+    isLeaf = True
+
+    def __init__(self, handler, token=None):
+        Resource.__init__(self)
+        self.handler = handler
+        self.token = token
+
+    def authorized(self, request):
+        if self.token is None:
+            return True
+        return hmac.compare_digest(request.getHeader('authorization') or '',
+                                   'Bearer ' + self.token)
+
+    def render_POST(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        if not self.authorized(request):
+            request.setResponseCode(http.FORBIDDEN)
+            return json.dumps({'error': 'Missing or wrong token'})
+        try:
+            data = json.loads(request.content.read() or '{}')
+            if not isinstance(data, dict):
+                raise ValueError("The request must be a JSON object.")
+            response = self.handler(data)
+        except ScanFinished as e:
+            request.setResponseCode(http.GONE)
+            response = {'error': str(e)}
+        except (ValueError, TypeError) as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            response = {'error': str(e)}
+        except KeyError as e:
+            request.setResponseCode(http.NOT_FOUND)
+            response = {'error': 'Unknown {}'.format(e)}
+        return json.dumps(response)
+
+
+def coordinator_resource(coordinator, token=None):
+    def lease(data):
+        return coordinator.lease(data['client'])
+
+    def results(data):
+        accepted = coordinator.submit(data['client'], int(data['unit']), data['results'],
+                                      bool(data.get('final')))
+        return {'accepted': accepted}
+
+    root = Resource()
+    root.putChild('lease', JSONResource(lease, token))
+    root.putChild('results', JSONResource(results, token))
+    root.putChild('status', JSONResource(lambda data: coordinator.status(), token))
+    return root
+
+
+class CoordinatorClient(object):
+    """
+    Request work units from and upload results to a coordinator.
+    """
+    def __init__(self, reactor, url, client_name, agent=None, token=None):
+        self.url = url.rstrip('/')
+        self.client_name = client_name
+        self.agent = agent or Agent(reactor)
+        self.token = token
+
+    @defer.inlineCallbacks
+    def post(self, path, data):
+        body = FileBodyProducer(BytesIO(json.dumps(data)))
+        headers = Headers({'Content-Type': ['application/json']})
+        if self.token is not None:
+            headers.setRawHeaders('Authorization', ['Bearer ' + self.token])
+        response = yield self.agent.request(
+            'POST', '{}/{}'.format(self.url, path), headers, body)
+        content = yield readBody(response)
+        if response.code != http.OK:
+            raise CoordinatorError("Coordinator replied {} to {}: {}".format(
+                response.code, path, content))
+        defer.returnValue(json.loads(content))
+
+    def lease(self):
+        return self.post('lease', {'client': self.client_name})
+
+    def submit(self, unit, results, final=False):
+        return self.post('results', {'client': self.client_name, 'unit': unit,
+                                     'results': results, 'final': final})
+
+
+class UploadSink(object):
+    """
+    Result sink which uploads the results of a unit to the coordinator in
+    batches of `batch_size`. Results of a failed upload are sent again with
+    the next batch. A failed final upload is retried `final_retries` times,
+    `retry_delay` seconds apart and then longer, before the lease is left to
+    expire and the unit is measured again.
+    """
+    def __init__(self, client, unit, clock, batch_size=10, final_retries=3, retry_delay=10):
+        self.client = client
+        self.unit = unit
+        self.clock = clock
+        self.batch_size = batch_size
+        self.final_retries = final_retries
+        self.retry_delay = retry_delay
+        self.buffer = []
+        self.current_task = defer.succeed(None)
+        # Set once the coordinator accepted the final upload
+        self.finished = False
+
+    def upload(self, final=False):
+        batch, self.buffer = self.buffer, []
+
+        def uploaded(result):
+            if final:
+                self.finished = True
+
+        def upload_failed(failure):
+            log.warn("Could not upload {count} results of unit {unit}: {failure}.",
+                     count=len(batch), unit=self.unit, failure=failure.getErrorMessage())
+            self.buffer[:0] = batch
+
+        self.current_task.addCallback(lambda _: self.client.submit(self.unit, batch, final))
+        self.current_task.addCallbacks(uploaded, upload_failed)
+
+    def send(self, res):
+        self.buffer.append(res)
+        if len(self.buffer) >= self.batch_size:
+            self.upload()
+        return self.current_task
+
+    @defer.inlineCallbacks
+    def end_flush(self):
+        """
+        Upload the remaining results and mark the unit as finished.
+        """
+        for attempt in range(self.final_retries + 1):
+            if attempt:
+                yield task.deferLater(self.clock, self.retry_delay * attempt, lambda: None)
+            self.upload(final=True)
+            yield self.current_task
+            if self.finished:
+                return
+        log.warn("Gave up uploading the results of unit {unit}, it will be measured again.",
+                 unit=self.unit)
+
+
+@defer.inlineCallbacks
+def run_client(client, clock, scan_unit, max_errors=5):
+    """
+    Measure work units leased from the coordinator until all of them are
+    done.
+
+    scan_unit: called with the list of relay fingerprints and the result
+    sink of a unit, returns a Deferred which fires once the unit's results
+    are flushed.
+    max_errors: give up after this many consecutive failed lease requests
+    """
+    errors = 0
+    units = 0
+    while True:
+        try:
+            work = yield client.lease()
+        except Exception as e:
+            errors += 1
+            if errors >= max_errors:
+                raise
+            log.warn("Could not lease work from the coordinator: {error}.", error=e)
+            yield task.deferLater(clock, 10 * errors, lambda: None)
+            continue
+        errors = 0
+
+        if work.get('done'):
+            log.info("Coordinator has no more work, measured {count} units.", count=units)
+            defer.returnValue(units)
+        if work['unit'] is None:
+            yield task.deferLater(clock, work['retry_after'], lambda: None)
+            continue
+
+        log.info("Measuring unit {unit} with {count} relays.", unit=work['unit'],
+                 count=len(work['relays']))
+        yield scan_unit(work['relays'], UploadSink(client, work['unit'], clock))
+        units += 1
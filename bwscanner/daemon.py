@@ -0,0 +1,133 @@
+"""
+Scan continuously and keep the bandwidth file up to date.
+
+The daemon keeps the recent results of each relay in memory and rewrites
+the bandwidth file from them on a schedule, so the results never have to
+be read back from disk and the Tor connection of the scan is reused.
+"""
+from collections import namedtuple
+
+from twisted.internet import defer, task
+
+from bwscanner.aggregate import aggregate_lines, write_bandwidth_file
+from bwscanner.logger import log
+
+# What is kept in memory of a result for each relay of its path. circ_bw is
+# None for failed measurements, which don't have the relay bandwidths.
+RelayResult = namedtuple('RelayResult', 'time_start time_end circ_bw desc_bw ns_bw')
+
+
+class RelayResults(object):
+    """
+    Result sink which keeps the results of each relay from the last
+    `window` seconds in memory. Results are also sent to `sink`, if any,
+    to keep a record of them on disk.
+    """
+    def __init__(self, clock, window, sink=None):
+        self.clock = clock
+        self.window = window
+        self.sink = sink
+        # Map of relay fingerprint -> list of RelayResults of the
+        # measurements with the relay in their path, oldest first
+        self.results = {}
+
+    def send(self, result):
+        for i, relay_fp in enumerate(result['path']):
+            if 'failure' in result:
+                relay_result = RelayResult(result['time_start'], result['time_end'], None,
+                                           None, None)
+            else:
+                relay_result = RelayResult(result['time_start'], result['time_end'],
+                                           result['circ_bw'], result['path_desc_bws'][i][0],
+                                           result['path_ns_bws'][i][0])
+            self.results.setdefault(relay_fp, []).append(relay_result)
+        if self.sink is not None:
+            return self.sink.send(result)
+        return defer.succeed(None)
+
+    def end_flush(self):
+        if self.sink is not None:
+            return self.sink.end_flush()
+        return defer.succeed(None)
+
+    def expire(self):
+        """
+        Forget the results which ended more than `window` seconds ago.
+        """
+        oldest = self.clock.seconds() - self.window
+        for relay_fp in self.results.keys():
+            relay_results = [result for result in self.results[relay_fp]
+                             if result.time_end >= oldest]
+            if relay_results:
+                self.results[relay_fp] = relay_results
+            else:
+                del self.results[relay_fp]
+
+    def oldest_time(self):
+        return min(results[0].time_start for results in self.results.values())
+
+    def measurement_data(self):
+        """
+        Return the measured bandwidths and the failures of each relay, like
+        `aggregate.load_measurement_data`.
+        """
+        measurements, failures = {}, {}
+        for relay_fp, relay_results in self.results.items():
+            for result in relay_results:
+                if result.circ_bw is None:
+                    failures.setdefault(relay_fp, []).append(result)
+                else:
+                    measurements.setdefault(relay_fp, []).append(result.circ_bw)
+        return measurements, failures
+
+    def relay_info(self, routers):
+        """
+        Return the nickname and the descriptor and NetworkStatus bandwidths
+        of the measured relays which are in `routers`, the current
+        consensus. The bandwidths are the ones recorded with the latest
+        successful measurement of each relay.
+        """
+        relay_info = {}
+        for relay_fp, relay_results in self.results.items():
+            router = routers.get(relay_fp)
+            if router is None:
+                continue
+            for result in reversed(relay_results):
+                if result.circ_bw is not None:
+                    relay_info[relay_fp] = (router.name, result.desc_bw, result.ns_bw)
+                    break
+        return relay_info
+
+
+class BandwidthFileUpdater(object):
+    """
+    Rewrite the bandwidth file at `file_name` every `interval` seconds from
+    the results in a RelayResults.
+    """
+    def __init__(self, results, tor_state, clock, file_name, interval):
+        self.results = results
+        self.tor_state = tor_state
+        self.clock = clock
+        self.file_name = file_name
+        self.interval = interval
+        self.loop = task.LoopingCall(self.update)
+        self.loop.clock = clock
+
+    def start(self):
+        return self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def update(self):
+        self.results.expire()
+        if not self.results.results:
+            log.info("No measurements yet, not writing the bandwidth file.")
+            return
+        measurements, failures = self.results.measurement_data()
+        lines = aggregate_lines(measurements, failures,
+                                self.results.relay_info(self.tor_state.routers))
+        write_bandwidth_file(self.file_name, int(self.results.oldest_time()), lines)
+        log.info("Wrote {count} relays to the bandwidth file {file}.", count=len(lines),
+                 file=self.file_name)
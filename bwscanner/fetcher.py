@@ -1,18 +1,138 @@
 import warnings
 import hashlib
+import time
 
 from twisted.internet import reactor, defer, protocol
 from twisted.internet.endpoints import TCP4ClientEndpoint
-from twisted.web.client import (ResponseDone, PotentialDataLoss, PartialDownloadError)
+from twisted.web import http
+from twisted.web.client import (HTTPConnectionPool, ResponseDone, PotentialDataLoss,
+                                PartialDownloadError)
+from twisted.web.error import Error
 from bwscanner.logger import log
+from bwscanner.profiling import CIRCUIT_BUILD, FIRST_BYTE, HASHING
 
 
-def fetch(tor_state, path, url):
+class CircuitBuildFailed(Exception):
+    pass
+
+
+def build_circuit(tor_state, path):
     d = tor_state.build_circuit(path, False)
-    sport = get_tor_socks_endpoint(tor_state)
-    d.addCallback(lambda c: c.when_built())
-    d.addCallback(lambda c: c.web_agent(reactor, sport))
-    return d.addCallback(lambda a: a.request("GET", url))
+    d.addCallback(wait_for_circuit)
+    d.addErrback(circuit_failed)
+    return d
+
+
+def request(agent, url, headers=None, spans=None):
+    d = agent.request("GET", url, headers)
+    if spans is not None:
+        spans.span(FIRST_BYTE, d)
+    return d
+
+
+def fetch(tor_state, path, url, headers=None, socks_endpoint=None, spans=None,
+          on_circuit=None):
+    """
+    Build a new circuit over `path` and request `url` through it.
+
+    `socks_endpoint` can be an endpoint, or a Deferred firing with one,
+    resolved in advance, otherwise the SOCKS port is asked from Tor. The
+    circuit build and the wait for the response are recorded in `spans`.
+    `on_circuit` is called with the circuit once it is built, before the
+    request is sent.
+    """
+    if socks_endpoint is None:
+        socks_endpoint = get_tor_socks_endpoint(tor_state)
+    d = build_circuit(tor_state, path)
+    if spans is not None:
+        spans.span(CIRCUIT_BUILD, d)
+    if on_circuit is not None:
+        d.addCallback(lambda circuit: on_circuit(circuit) or circuit)
+    d.addCallback(lambda c: c.web_agent(reactor, socks_endpoint))
+    return d.addCallback(request, url, headers, spans)
+
+
+class CircuitSession(object):
+    """
+    Take several samples over the same circuit.
+
+    The circuit is built for the first request and the following requests
+    reuse it with a persistent HTTP connection pool bound to the circuit, so
+    they also avoid a new connection to the file server when they go to
+    the same server.
+    """
+    def __init__(self, tor_state, path, socks_endpoint, instance=0, spans=None):
+        self.tor_state = tor_state
+        self.path = path
+        self.socks_endpoint = socks_endpoint
+        self.instance = instance
+        self.spans = spans
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = 1
+        self.circuit = None
+        self.agent = None
+        # The outcome of the samples taken so far, kept up to date by the
+        # caller.
+        self.successes = 0
+        self.failed = False
+
+    def fetch(self, url, headers=None, on_circuit=None):
+        if self.agent is None:
+            d = build_circuit(self.tor_state, self.path)
+            if self.spans is not None:
+                self.spans.span(CIRCUIT_BUILD, d)
+            d.addCallback(self.circuit_built)
+        else:
+            d = defer.succeed(self.agent)
+        if on_circuit is not None:
+            d.addCallback(lambda agent: on_circuit(self.circuit) or agent)
+        return d.addCallback(request, url, headers, self.spans)
+
+    @defer.inlineCallbacks
+    def circuit_built(self, circuit):
+        self.circuit = circuit
+        # The agent waits for its SOCKS endpoint at each new connection and
+        # a Deferred only gives its result to the first one, so it gets the
+        # endpoint itself.
+        self.socks_endpoint = yield self.socks_endpoint
+        self.agent = circuit.web_agent(reactor, self.socks_endpoint, pool=self.pool)
+        defer.returnValue(self.agent)
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+
+def circuit_failed(failure):
+    """
+    Report errors from Tor while building the circuit as CircuitBuildFailed.
+    """
+    if failure.check(defer.CancelledError, CircuitBuildFailed):
+        return failure
+    raise CircuitBuildFailed(failure.value)
+
+
+def wait_for_circuit(circuit):
+    """
+    Return a Deferred which fires with `circuit` when it is built, or fails
+    as soon as Tor closes it instead.
+
+    Circuit.when_built() never fires for circuits which fail to build, so
+    we also need to watch for the circuit being closed.
+    """
+    d = defer.Deferred()
+
+    def built(circuit):
+        if not d.called:
+            d.callback(circuit)
+
+    def closed(circuit):
+        if not d.called:
+            d.errback(CircuitBuildFailed("Circuit {} closed before it was built.".format(
+                circuit.id)))
+
+    circuit.when_built().addCallback(built)
+    circuit.when_closed().addCallback(closed)
+    return d
 
 
 def get_tor_socks_endpoint(tor_state):
@@ -42,18 +162,29 @@ class hashingReadBodyProtocol(protocol.Protocol):
     fires a deferred with it.
     """
 
-    def __init__(self, status, message, deferred):
+    def __init__(self, status, message, deferred, spans=None):
         self.deferred = deferred
         self.status = status
         self.message = message
         self.hash_state = hashlib.sha256()
+        self.spans = spans
+        # Time spent hashing, recorded in `spans` when the body is read
+        self.hash_seconds = 0.0
 
     def dataReceived(self, data):
         """
         Accumulate and hash some more bytes from the response.
         """
+        start = time.time()
+        self.update(data)
+        self.hash_seconds += time.time() - start
+
+    def update(self, data):
         self.hash_state.update(data)
 
+    def digest(self):
+        return self.hash_state.hexdigest()
+
     def connectionLost(self, reason):
         """
         Deliver the accumulated response bytes to the waiting L{Deferred}, if
@@ -65,27 +196,86 @@ class hashingReadBodyProtocol(protocol.Protocol):
         """
         if not self.deferred.called:
             if reason.check(ResponseDone):
-                self.deferred.callback(self.hash_state.hexdigest())
+                if self.spans is not None:
+                    self.spans.record(HASHING, self.hash_seconds)
+                self.deferred.callback(self.digest())
             elif reason.check(PotentialDataLoss):
                 self.deferred.errback(
                     PartialDownloadError(self.status, self.message,
-                                         self.hash_state.hexdigest()))
+                                         self.digest()))
             else:
                 self.deferred.errback(reason)
         else:
             log.debug("Deferred already called before connectionLost on hashingReadBodyProtocol.")
 
 
-def hashingReadBody(response):
+class blockHashingReadBodyProtocol(hashingReadBodyProtocol):
     """
-    Get the body of an L{IResponse} and return the SHA1 hash of the body.
+    Protocol that collects data sent to it and hashes it in blocks of
+    `block_size` bytes.
 
-    @param response: The HTTP response for which the body will be read.
-    @type response: L{IResponse} provider
+    This is used to verify a byte range of a large file against the block
+    hashes in its manifest. The deferred fires with the list of hex encoded
+    block hashes. If `sample` is set only the blocks with these indexes
+    are hashed and the other blocks are reported as None.
+    """
 
-    @return: A L{Deferred} which will fire with the hex encoded SHA1 hash
-        of the response. Cancelling it will close the connection to the
-        server immediately.
+    def __init__(self, status, message, deferred, block_size, sample=None, spans=None):
+        hashingReadBodyProtocol.__init__(self, status, message, deferred, spans)
+        self.block_size = block_size
+        self.sample = sample
+        self.block_hashes = []
+        self.block_remaining = block_size
+
+    def update(self, data):
+        """
+        Hash some more bytes from the response, starting a new hash whenever
+        a block boundary is crossed.
+        """
+        while len(data) >= self.block_remaining:
+            self.update_block(data[:self.block_remaining])
+            data = data[self.block_remaining:]
+            self.end_block()
+        if data:
+            self.update_block(data)
+            self.block_remaining -= len(data)
+
+    def block_sampled(self):
+        return self.sample is None or len(self.block_hashes) in self.sample
+
+    def update_block(self, data):
+        if self.block_sampled():
+            self.hash_state.update(data)
+
+    def end_block(self):
+        self.block_hashes.append(self.hash_state.hexdigest() if self.block_sampled() else None)
+        self.hash_state = hashlib.sha256()
+        self.block_remaining = self.block_size
+
+    def digest(self):
+        # Include the final short block, if any.
+        if self.block_remaining != self.block_size:
+            self.end_block()
+        return self.block_hashes
+
+
+class discardBodyProtocol(protocol.Protocol):
+    """
+    Protocol which stops the delivery of an unwanted response body.
+    """
+
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        pass
+
+
+def _readBody(response, protocol_class, **kwargs):
+    """
+    Deliver the body of an L{IResponse} to a new `protocol_class` protocol
+    and return its deferred. Cancelling the deferred will close the
+    connection to the server immediately.
     """
     def cancel(deferred):
         """
@@ -99,7 +289,7 @@ def hashingReadBody(response):
             abort()
 
     d = defer.Deferred(cancel)
-    protocol = hashingReadBodyProtocol(response.code, response.phrase, d)
+    protocol = protocol_class(response.code, response.phrase, d, **kwargs)
 
     def getAbort():
         return getattr(protocol.transport, 'abortConnection', None)
@@ -111,6 +301,39 @@ def hashingReadBody(response):
             'Using readBody with a transport that does not have an '
             'abortConnection method',
             category=DeprecationWarning,
-            stacklevel=2)
+            stacklevel=3)
 
     return d
+
+
+def hashingReadBody(response, spans=None):
+    """
+    Get the body of an L{IResponse} and return the SHA256 hash of the body.
+
+    @param response: The HTTP response for which the body will be read.
+    @type response: L{IResponse} provider
+
+    @param spans: A L{SpanRecorder} the hashing time is recorded in.
+
+    @return: A L{Deferred} which will fire with the hex encoded SHA256 hash
+        of the response. Cancelling it will close the connection to the
+        server immediately.
+    """
+    return _readBody(response, hashingReadBodyProtocol, spans=spans)
+
+
+def blockHashingReadBody(response, block_size, sample=None, spans=None):
+    """
+    Get the body of a partial content L{IResponse} and return the SHA256
+    hashes of each `block_size` block of the body, or of the blocks in
+    `sample` only.
+
+    @return: A L{Deferred} which will fire with the list of hex encoded block
+        hashes. It fails with L{twisted.web.error.Error} without reading the
+        body if the server did not respond with the requested range.
+    """
+    if response.code != http.PARTIAL_CONTENT:
+        response.deliverBody(discardBodyProtocol())
+        return defer.fail(Error(response.code, response.phrase))
+    return _readBody(response, blockHashingReadBodyProtocol, block_size=block_size,
+                     sample=sample, spans=spans)
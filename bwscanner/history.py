@@ -0,0 +1,80 @@
+"""
+Remember the relays which keep failing their measurements.
+
+A relay which failed `threshold` measurements in a row is skipped until its
+TTL is over and then measured again as a probe. Each further failure
+doubles the TTL, up to `max_ttl`, and a success forgets the relay. The
+history is saved between scans so a relay which is down for days costs one
+probe per TTL instead of a circuit and up to a request timeout per pass.
+"""
+from __future__ import division
+import json
+import os
+
+from bwscanner.logger import log
+
+DEFAULT_THRESHOLD = 5
+DEFAULT_TTL = 3600
+DEFAULT_MAX_TTL = 7 * 86400
+
+
+class FailureHistory(object):
+    """
+    The consecutive failures of each relay, stored in the JSON file `path`.
+    """
+    def __init__(self, path, clock, threshold=DEFAULT_THRESHOLD, ttl=DEFAULT_TTL,
+                 max_ttl=DEFAULT_MAX_TTL):
+        self.path = path
+        self.clock = clock
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        # Map of relay fingerprint -> {'failures': consecutive failures,
+        # 'seconds': mean duration of the failures, 'skip_until': time}
+        self.relays = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as history_file:
+                self.relays = json.load(history_file)
+            log.info("Loaded the failure history of {count} relays.", count=len(self.relays))
+
+    def failed(self, relay, duration):
+        record = self.relays.setdefault(relay, {'failures': 0, 'seconds': 0.0,
+                                                'skip_until': 0})
+        record['seconds'] += (duration - record['seconds']) / (record['failures'] + 1)
+        record['failures'] += 1
+        if record['failures'] >= self.threshold:
+            ttl = min(self.ttl * 2 ** (record['failures'] - self.threshold), self.max_ttl)
+            record['skip_until'] = self.clock.seconds() + ttl
+
+    def succeeded(self, relay):
+        self.relays.pop(relay, None)
+
+    def skipped_relays(self):
+        """
+        Return the fingerprints of the relays to skip now.
+        """
+        now = self.clock.seconds()
+        return set(relay for relay, record in self.relays.items()
+                   if record['skip_until'] > now)
+
+    def expected_cost(self, relays):
+        """
+        Return the seconds the failed measurements of `relays` usually take.
+        """
+        return sum(self.relays[relay]['seconds'] for relay in relays if relay in self.relays)
+
+    def prune(self, relays):
+        """
+        Forget the relays which are not in `relays`, the fingerprints of the
+        relays of the current consensus.
+        """
+        for relay in set(self.relays) - set(relays):
+            del self.relays[relay]
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as history_file:
+            json.dump(self.relays, history_file, sort_keys=True)
+        os.rename(tmp_path, self.path)
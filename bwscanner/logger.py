@@ -1,14 +1,120 @@
+import atexit
 import sys
+import threading
+import time
+try:
+    from Queue import Full, Queue
+except ImportError:
+    from queue import Full, Queue
+
 from twisted.internet.protocol import Factory
 from twisted.logger import (FileLogObserver, FilteringLogObserver, globalLogPublisher, Logger,
-                            LogLevel, LogLevelFilterPredicate, formatEvent, formatTime)
+                            LogLevel, LogLevelFilterPredicate, PredicateResult, formatEvent,
+                            formatTime)
 from twisted.python.logfile import DailyLogFile
 
+# The most events waiting for the log writer thread before new ones are
+# dropped.
+MAX_QUEUED_EVENTS = 10000
+
 
 def log_event_format(event):
+    text = formatEvent(event)
+    if event.get('log_suppressed'):
+        text += u" ({0} similar messages were suppressed)".format(event['log_suppressed'])
     return u"{0} [{1}]: {2}\n".format(formatTime(event["log_time"]),
-                                      event["log_level"].name.upper(),
-                                      formatEvent(event))
+                                      event["log_level"].name.upper(), text)
+
+
+class QueuedLogObserver(object):
+    """
+    Pass events to `observers` from a writer thread so the reactor thread
+    doesn't wait for the log file or the terminal.
+
+    When `max_queued` events are already waiting, new events are dropped and
+    counted in `dropped`. The writer logs how many were dropped once it
+    catches up.
+    """
+    def __init__(self, observers, max_queued=MAX_QUEUED_EVENTS):
+        self.observers = observers
+        self.queue = Queue(max_queued)
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.thread = threading.Thread(target=self.write_events, name='log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+    def write_events(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            dropped = self.dropped
+            if dropped > self.reported_dropped:
+                self.write({'log_format': "Dropped {count} log messages, the log writer could "
+                                          "not keep up.",
+                            'log_level': LogLevel.warn, 'log_namespace': 'bwscanner',
+                            'log_time': time.time(), 'count': dropped - self.reported_dropped})
+                self.reported_dropped = dropped
+            self.write(event)
+
+    def write(self, event):
+        for observer in self.observers:
+            observer(event)
+
+    def stop(self):
+        """
+        Write the queued events and stop the writer thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class RelayRateLimitPredicate(object):
+    """
+    Let through at most `rate` messages per second about each relay, the
+    events with a relay fingerprint field, for each message format. Up to
+    `burst` messages may pass at once. Errors always pass.
+
+    The next message of a format about a relay let through after some were
+    suppressed says how many.
+    """
+    RELAY_FIELDS = ('relay', 'fingerprint', 'relay_fp')
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        # Map of (log format, relay) -> [tokens, time of the last update,
+        # suppressed]
+        self.buckets = {}
+
+    def __call__(self, event):
+        if event.get('log_level') in (LogLevel.error, LogLevel.critical):
+            return PredicateResult.maybe
+        relay = next((event[field] for field in self.RELAY_FIELDS if event.get(field)), None)
+        if relay is None:
+            return PredicateResult.maybe
+
+        now = event['log_time']
+        key = (event.get('log_format'), str(relay))
+        bucket = self.buckets.setdefault(key, [self.burst, now, 0])
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return PredicateResult.no
+        bucket[0] -= 1
+        if bucket[2]:
+            event['log_suppressed'] = bucket[2]
+            bucket[2] = 0
+        return PredicateResult.maybe
 
 
 # Disable Factory starting and stopping log messages
@@ -16,20 +122,27 @@ Factory.noisy = False
 log = Logger("bwscanner")
 
 
-def setup_logging(log_level, log_name, log_directory=""):
+def setup_logging(log_level, log_name, log_directory="", rate_limit=None, console=sys.stdout):
     """
-    Configure the logger to use the specified log file and log level
+    Configure the logger to use the specified log file and log level. The
+    log file and the `console` stream are written from a QueuedLogObserver
+    thread.
+
+    With `rate_limit` the messages about single relays are limited to that
+    many per second for each message.
     """
     log_filter = LogLevelFilterPredicate()
     log_filter.setLogLevelForNamespace("bwscanner", LogLevel.levelWithName(log_level.lower()))
+    predicates = [log_filter]
+    if rate_limit:
+        predicates.append(RelayRateLimitPredicate(rate_limit))
 
     # Set up logging
     log_file = DailyLogFile(log_name, log_directory)
     file_observer = FileLogObserver(log_file, log_event_format)
-    console_observer = FileLogObserver(sys.stdout, log_event_format)
-
-    file_filter_observer = FilteringLogObserver(file_observer, (log_filter,))
-    console_filter_observer = FilteringLogObserver(console_observer, (log_filter,))
+    console_observer = FileLogObserver(console, log_event_format)
 
-    globalLogPublisher.addObserver(file_filter_observer)
-    globalLogPublisher.addObserver(console_filter_observer)
+    queued_observer = QueuedLogObserver([file_observer, console_observer])
+    atexit.register(queued_observer.stop)
+    globalLogPublisher.addObserver(FilteringLogObserver(queued_observer, predicates))
+    return queued_observer
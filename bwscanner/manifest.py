@@ -0,0 +1,131 @@
+"""
+Block manifests for measuring relays with HTTP Range requests against a
+single large file.
+
+The manifest lists the SHA-256 hash of each fixed size block of the file so
+an arbitrary block aligned byte range can be verified without knowing the
+hash of the whole range in advance.
+"""
+import hashlib
+import json
+import random
+
+DEFAULT_BLOCK_SIZE = 256 * 1024
+
+
+class ManifestError(Exception):
+    pass
+
+
+class BlockManifest(object):
+    """
+    The name, size and per-block hashes of a file hosted on the file server.
+    """
+    def __init__(self, name, size, block_size, block_hashes):
+        """
+        name: the path of the file relative to the file server base URL
+        size: the size of the file in bytes
+        block_size: the size of each hashed block in bytes, the last block
+        may be shorter
+        block_hashes: the hex encoded SHA-256 hash of each block
+        """
+        self.name = name
+        self.size = size
+        self.block_size = block_size
+        self.block_hashes = block_hashes
+
+        if self.num_blocks != -(-size // block_size):
+            raise ManifestError("Manifest for {} has {} block hashes, expected {}.".format(
+                name, self.num_blocks, -(-size // block_size)))
+
+    @property
+    def num_blocks(self):
+        return len(self.block_hashes)
+
+    def range_length(self, first_block, num_blocks):
+        """
+        Return the number of bytes covered by `num_blocks` blocks starting at
+        `first_block`.
+        """
+        start, end = self.byte_range(first_block, num_blocks)
+        return end - start + 1
+
+    def byte_range(self, first_block, num_blocks):
+        """
+        Return the first and last (inclusive) byte offsets of a block range.
+        """
+        if num_blocks < 1 or first_block < 0 or first_block + num_blocks > self.num_blocks:
+            raise ManifestError("Block range {}+{} is outside of {}.".format(
+                first_block, num_blocks, self.name))
+        start = first_block * self.block_size
+        end = min((first_block + num_blocks) * self.block_size, self.size) - 1
+        return start, end
+
+    def range_header(self, first_block, num_blocks):
+        return "bytes={}-{}".format(*self.byte_range(first_block, num_blocks))
+
+    def expected_hashes(self, first_block, num_blocks):
+        return self.block_hashes[first_block:first_block + num_blocks]
+
+    def choose_blocks(self, size):
+        """
+        Choose a random block aligned range covering at least `size` bytes.
+
+        The range is clamped to the size of the file.
+        """
+        num_blocks = max(1, min(self.num_blocks, -(-int(size) // self.block_size)))
+        first_block = random.randint(0, self.num_blocks - num_blocks)
+        return first_block, num_blocks
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'size': self.size,
+            'block_size': self.block_size,
+            'block_hashes': self.block_hashes,
+        }
+
+    def save(self, path):
+        with open(path, 'w') as manifest_file:
+            json.dump(self.to_dict(), manifest_file, sort_keys=True)
+
+
+def sample_blocks(num_blocks, count):
+    """
+    Choose the indexes of `count` blocks of a range of `num_blocks` blocks
+    to verify.
+
+    The last block is always included, the length of the range is checked
+    through its hash since it is the only block which may be short.
+    """
+    sample = set(random.sample(range(num_blocks - 1), min(max(count, 1), num_blocks) - 1))
+    sample.add(num_blocks - 1)
+    return sample
+
+
+def load_manifest(path):
+    """
+    Load a block manifest from a JSON file.
+    """
+    with open(path, 'r') as manifest_file:
+        try:
+            data = json.load(manifest_file)
+            return BlockManifest(data['name'], data['size'], data['block_size'],
+                                 data['block_hashes'])
+        except (ValueError, KeyError, TypeError) as e:
+            raise ManifestError("Could not read manifest {}: {}".format(path, e))
+
+
+def generate_manifest(name, data_file, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Hash each block of the open file `data_file` and return its manifest.
+    """
+    block_hashes = []
+    size = 0
+    while True:
+        block = data_file.read(block_size)
+        if not block:
+            break
+        size += len(block)
+        block_hashes.append(hashlib.sha256(block).hexdigest())
+    return BlockManifest(name, size, block_size, block_hashes)
@@ -1,27 +1,81 @@
-import time
 import unicodedata
 
-from stem.descriptor.server_descriptor import ServerDescriptor
-from stem.descriptor.networkstatus import RouterStatusEntryV3
-
-from twisted.internet import defer
+from twisted.internet import defer, error, task
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseFailed, PartialDownloadError
+from twisted.web.error import Error
+from twisted.web.http_headers import Headers
+from txtorcon.socks import SocksError
 
 from bwscanner.logger import log
+from bwscanner.config import INTEGRITY_MODES
+from bwscanner.bwcache import BandwidthCache
+from bwscanner.bwevents import BandwidthEvents, tor_throughput
 from bwscanner.circuit import TwoHop
-from bwscanner.fetcher import hashingReadBody, fetch
+from bwscanner.fetcher import (hashingReadBody, blockHashingReadBody, fetch,
+                               get_tor_socks_endpoint, CircuitBuildFailed, CircuitSession)
+from bwscanner.manifest import sample_blocks
+from bwscanner.profiling import BODY_TRANSFER, CONTROL_PORT
+from bwscanner.relays import build_relay_table
 from bwscanner.writer import ResultSink
 
 # defer.setDebugging(True)
 
+CIRCUIT_FAILURE = 'circuit'
+STREAM_FAILURE = 'stream'
+TIMEOUT_FAILURE = 'timeout'
+HASH_FAILURE = 'hash'
+EXIT_FAILURE = 'exit'
+UNKNOWN_FAILURE = 'unknown'
+
+# Failures which might not happen again with a different exit
+RETRYABLE_FAILURES = frozenset([CIRCUIT_FAILURE, STREAM_FAILURE, TIMEOUT_FAILURE,
+                                HASH_FAILURE, EXIT_FAILURE])
+
+# Failures which might be caused by the file server mirror: the exit
+# couldn't connect to it, it returned an error or the wrong data.
+MIRROR_FAILURES = frozenset([EXIT_FAILURE, HASH_FAILURE])
+
 
 class DownloadIncomplete(Exception):
     pass
 
 
+def classify_failure(failure):
+    """
+    Return the class of a failed measurement.
+
+    ResponseFailed (and its subclass ResponseNeverReceived) wraps the
+    failures which caused the request to fail, so a cancelled request is
+    reported as a timeout rather than as a stream failure.
+    """
+    if failure.check(ResponseFailed):
+        if any(reason.check(defer.CancelledError) for reason in failure.value.reasons):
+            return TIMEOUT_FAILURE
+        return STREAM_FAILURE
+    if failure.check(defer.CancelledError):
+        return TIMEOUT_FAILURE
+    if failure.check(CircuitBuildFailed):
+        return CIRCUIT_FAILURE
+    if failure.check(DownloadIncomplete):
+        return HASH_FAILURE
+    # PartialDownloadError is a subclass of Error, it is checked first.
+    if failure.check(PartialDownloadError, error.ConnectError, error.ConnectionLost,
+                     error.ConnectionDone):
+        return STREAM_FAILURE
+    # The exit reported that it could not connect or the file server
+    # returned an unexpected response.
+    if failure.check(SocksError, Error):
+        return EXIT_FAILURE
+    return UNKNOWN_FAILURE
+
+
 class BwScan(object):
     def __init__(self, state, clock, measurement_dir, **kwargs):
         """
-        state: the txtorcon state object
+        state: the txtorcon state object, or a list of them to spread the
+        measurements over several Tor instances. Relays are chosen from the
+        first one.
         clock: this argument is normally the twisted global reactor object but
         unit tests might set this to a clock object which can time travel for
         speeding up tests.
@@ -29,30 +83,122 @@ class BwScan(object):
         partitions: the number of partitions to use for processing the
         set of circuits
         this_partition: which partition of circuit we will process
+        relays: a list of relay fingerprints to measure instead of a
+        partition
+        exclude_relays: fingerprints of relays which are not measured in
+        the first pass, the relays already measured by an interrupted scan
+        result_sink: where the results are sent, a ResultSink writing to
+        `measurement_dir` by default
+        mirrors: a MirrorSet of file servers to download from instead of
+        `baseurl`
+        samples_per_circuit: the number of measurements taken one after the
+        other over each circuit, each one is reported separately
+        range_manifest: the BlockManifest of a single large file, when set
+        each measurement downloads a byte range of that file sized for the
+        circuit instead of one of `bw_files`
+        integrity: one of INTEGRITY_MODES, 'sampled' requires `range_manifest`
+        sample_blocks: the number of blocks of a range checked in 'sampled'
+        integrity mode
+        max_retries: how many times a relay is measured again with a
+        different exit after a retryable failure
+        retry_delay: the delay before the first retry, doubled after each
+        further failure
+        spans: a SpanRecorder the duration of each stage of the
+        measurements is recorded in
+        failure_history: a FailureHistory of the relays which keep failing,
+        they are skipped until their TTL is over
+        tor_bw_events: record the bytes Tor read each second on the circuit
+        of each measurement, from its CIRC_BW and STREAM_BW events, and
+        their mean in `tor_circ_bw`
+        relay_table: a RelayTable of the current consensus to choose the
+        circuits from instead of the routers of `state`, a new table is
+        built when Tor gets a new consensus
         """
-        self.state = state
-        self._socks = None
+        self.states = state if isinstance(state, list) else [state]
+        self.state = self.states[0]
+        # The number of measurements in flight on each Tor instance
+        self.instance_load = [0] * len(self.states)
+        # The SOCKS endpoint of each Tor instance once it is known
+        self._socks = {}
         self.clock = clock
         self.measurement_dir = measurement_dir
         self.partitions = kwargs.get('partitions', 1)
-        self.this_partition = kwargs.get('this_partition', 0)
+        self.this_partition = kwargs.get('this_partition', 1)
+        self.relays = kwargs.get('relays')
+        self.exclude_relays = kwargs.get('exclude_relays')
         self.scan_continuous = kwargs.get('scan_continuous', False)
         self.request_timeout = kwargs.get('request_timeout', 60)
         self.circuit_launch_delay = kwargs.get('circuit_launch_delay', .2)
         # Limit the number of simultaneous bandwidth measurements
         self.request_limit = kwargs.get('request_limit', 10)
+        self.max_retries = kwargs.get('max_retries', 2)
+        self.retry_delay = kwargs.get('retry_delay', 10)
+        self.samples_per_circuit = kwargs.get('samples_per_circuit', 1)
+        self.spans = kwargs.get('spans')
+        self.failure_history = kwargs.get('failure_history')
+        # The bandwidth events of each Tor instance
+        self.bw_events = None
+        if kwargs.get('tor_bw_events'):
+            self.bw_events = [BandwidthEvents(s.protocol) for s in self.states]
 
-        self.tasks = []
+        # The measurements in flight and counters of the finished measurements
+        # and passes.
+        self.tasks = set()
+        self.completed = 0
+        self.passes = 0
+        self.launching = False
         self.circuits = None
+        self.semaphore = None
+        self.pass_start = None
+        # Finished downloads by outcome, 'success' or the failure class, and
+        # the bytes downloaded by the successful ones.
+        self.download_counts = {}
+        self.downloaded_bytes = 0
+        # Relays waiting to be measured again at the end of the pass, and
+        # the exits which already failed for each relay.
+        self.retry_queue = []
+        self.failed_exits = {}
         self.baseurl = kwargs.get('baseurl')
         # test does not use baseurl
         if self.baseurl is not None:
             assert self.baseurl.endswith('/')
+        self.mirrors = kwargs.get('mirrors')
         self.bw_files = kwargs.get('bw_files')
-        self.result_sink = ResultSink(self.measurement_dir, chunk_size=10)
+        self.range_manifest = kwargs.get('range_manifest')
+        self.integrity = kwargs.get('integrity', 'full')
+        self.sample_blocks = kwargs.get('sample_blocks', 4)
+        if self.integrity not in INTEGRITY_MODES:
+            raise ValueError("Unknown integrity mode {}.".format(self.integrity))
+        if self.integrity == 'sampled' and self.range_manifest is None:
+            raise ValueError("The sampled integrity mode requires a range manifest.")
+        self.result_sink = kwargs.get('result_sink')
+        if self.result_sink is None:
+            self.result_sink = ResultSink(self.measurement_dir, chunk_size=10, spans=self.spans)
+        self.bw_cache = BandwidthCache(self.state.protocol)
+        self.relay_table = kwargs.get('relay_table')
+        if self.relay_table is not None:
+            self.bw_cache.add_relay_table(self.relay_table)
+            if self.failure_history is not None:
+                self.failure_history.prune(self.relay_table.routers)
+            self.state.protocol.add_event_listener('NEWCONSENSUS', self.new_consensus)
 
     def now(self):
-        return time.time()
+        return self.clock.seconds()
+
+    def new_consensus(self, event):
+        """
+        Build the relay table of the new consensus, the next pass chooses its
+        circuits from it.
+        """
+        def got_table(relay_table):
+            self.relay_table = relay_table
+            self.bw_cache.add_relay_table(relay_table)
+            # Relays which left the consensus are not measured anymore
+            if self.failure_history is not None:
+                self.failure_history.prune(relay_table.routers)
+        d = build_relay_table(self.state.protocol)
+        d.addCallbacks(got_table, lambda failure: log.failure(
+            "Could not build the relay table of the new consensus", failure))
 
     def choose_file_size(self, path):
         """
@@ -67,71 +213,202 @@ class BwScan(object):
                 return size
         return max(self.bw_files.keys())
 
-    def choose_url(self, path):
-        url = self.baseurl + self.bw_files[self.choose_file_size(path)][0]
+    def choose_url(self, path, baseurl=None):
+        return self.make_url(self.bw_files[self.choose_file_size(path)][0], baseurl)
+
+    def make_url(self, name, baseurl=None):
+        url = (baseurl or self.baseurl) + name
         return unicodedata.normalize('NFKD', url).encode('ascii', 'ignore')
 
+    def choose_blocks(self, path):
+        """
+        Choose a byte range of the manifest file based on the average
+        bandwidth of relays on circuit, using the same sizing rule as
+        `choose_file_size`.
+        """
+        avg_bw = sum([r.bandwidth for r in path])/len(path)
+        return self.range_manifest.choose_blocks(avg_bw * 5 * 1024)
+
+    def choose_instance(self):
+        """
+        Choose the Tor instance with the fewest measurements in flight.
+        """
+        return min(range(len(self.states)), key=lambda i: self.instance_load[i])
+
     def run_scan(self):
+        """
+        Measure every relay of the partition and return a Deferred which
+        fires when the results are written. With `scan_continuous` a new
+        pass is started as soon as the previous one is written and the
+        Deferred only fires once `scan_continuous` is cleared.
+        """
         all_done = defer.Deferred()
-        if self.scan_continuous:
-            all_done.addCallback(lambda ign: self.run_scan())
-        self.circuits = TwoHop(self.state, partitions=self.partitions,
-                               this_partition=self.this_partition)
-        sem = defer.DeferredSemaphore(self.request_limit)
+        self.run_pass(all_done)
+        return all_done
+
+    def run_pass(self, all_done):
+        skip = None
+        if self.failure_history is not None:
+            skip = self.failure_history.skipped_relays()
+        routers = self.relay_table if self.relay_table is not None else self.state
+        self.circuits = TwoHop(routers, partitions=self.partitions,
+                               this_partition=self.this_partition, relays=self.relays,
+                               exclude=self.exclude_relays, skip=skip)
+        # Later passes of a continuous scan measure every relay
+        self.exclude_relays = None
+        self.retry_queue = []
+        self.failed_exits = {}
+        self.completed = 0
+        self.launching = True
+        self.pass_start = self.now()
+        sem = self.semaphore = defer.DeferredSemaphore(self.request_limit)
+
+        def start_task(task):
+            # Only the tasks which are still running are kept, the task
+            # result is dropped once it is finished.
+            self.tasks.add(task)
+            task.addBoth(task_done, task)
+
+        def task_done(result, task):
+            self.tasks.discard(task)
+            self.completed += 1
+            if not self.launching and not self.tasks:
+                retry_failed()
 
         def scan_over_next_circuit():
             try:
-                task = sem.run(self.fetch, self.circuits.next())
-                self.tasks.append(task)
+                start_task(sem.run(self.measure, self.circuits.next()))
             except StopIteration:
                 # All circuit measurement tasks have been setup. Now wait for
-                # all tasks to complete before writing results, and firing
-                # the all_done deferred.
-                task_list = defer.DeferredList(self.tasks)
-                task_list.addCallback(lambda _: self.result_sink.end_flush())
-                task_list.chainDeferred(all_done)
+                # all tasks to complete and for the failed ones to be retried
+                # before writing results, and firing the all_done deferred.
+                self.launching = False
+                if not self.tasks:
+                    retry_failed()
             else:
                 # We have circuits left, schedule scan on the next circuit
                 self.clock.callLater(self.circuit_launch_delay,
                                      scan_over_next_circuit)
 
+        def retry_failed():
+            if not self.retry_queue:
+                self.result_sink.end_flush().addCallback(pass_done)
+                return
+
+            retries, self.retry_queue = self.retry_queue, []
+            log.info("Retrying measurements for {count} relays.", count=len(retries))
+            for i, (relay, attempt) in enumerate(retries):
+                exit_relay = self.circuits.exit_by_bw(relay, exclude=self.failed_exits[relay])
+                delay = (self.retry_delay * 2 ** (attempt - 1) +
+                         i * self.circuit_launch_delay)
+                start_task(task.deferLater(self.clock, delay, sem.run, self.measure,
+                                           (relay, exit_relay), attempt))
+
+        def pass_done(_):
+            self.passes += 1
+            log.info("Finished scan pass {count} with {completed} measurements.",
+                     count=self.passes, completed=self.completed)
+            if self.failure_history is not None:
+                log.info("Skipped {count} relays which keep failing, saving about {saved:.0f}s "
+                         "of measurements.", count=len(self.circuits.skipped),
+                         saved=self.failure_history.expected_cost(self.circuits.skipped))
+                self.failure_history.save()
+            if self.scan_continuous:
+                self.clock.callLater(0, self.run_pass, all_done)
+            else:
+                all_done.callback(None)
+
         # Scan the first circuit
         self.clock.callLater(0, scan_over_next_circuit)
-        return all_done
 
-    def fetch(self, path):
-        url = self.choose_url(path)
-        assert None not in path
-        log.info("Downloading file '{file_size}' over [{relay_fp}, {exit_fp}].",
-                 file_size=url.split('/')[-1], relay_fp=path[0].id_hex, exit_fp=path[-1].id_hex)
-        file_size = self.choose_file_size(path)  # File size in MB
-        file_hash = self.bw_files[file_size][1]
-        time_start = self.now()
+    def socks_endpoint(self, instance):
+        """
+        Return a Deferred which fires with the SOCKS endpoint of a Tor
+        instance, we only ask Tor for its SOCKS port once.
+        """
+        if instance in self._socks:
+            return defer.succeed(self._socks[instance])
+
+        def got_endpoint(endpoint):
+            self._socks[instance] = endpoint
+            return endpoint
+        return get_tor_socks_endpoint(self.states[instance]).addCallback(got_endpoint)
+
+    def measure(self, path, attempt=0):
+        """
+        Measure `path` with `samples_per_circuit` samples over one circuit.
+
+        The samples stop at the first failure since the circuit is probably
+        unusable.
+        """
+        if self.samples_per_circuit == 1:
+            return self.fetch(path, attempt)
+
+        instance = self.choose_instance()
+        session = CircuitSession(self.states[instance], path, self.socks_endpoint(instance),
+                                 instance, spans=self.spans)
 
         @defer.inlineCallbacks
-        def get_circuit_bw(result):
-            time_end = self.now()
-            if result != file_hash:
-                raise DownloadIncomplete
-            report = dict()
-            report['time_end'] = time_end
-            report['time_start'] = time_start
-            request_duration = report['time_end'] - report['time_start']
-            report['circ_bw'] = int((file_size * 1024) // request_duration)
-            report['path'] = [r.id_hex for r in path]
-            log.debug("Download took {duration} for {size} MB", duration=request_duration,
-                      size=int(file_size // 1024))
-
-            # We need to wait for these deferreds to be ready, we can't serialize
-            # deferreds.
-            report['path_desc_bws'] = []
-            report['path_ns_bws'] = []
-            for relay in path:
-                report['path_desc_bws'].append((yield self.get_r_desc_bw(relay)))
-                report['path_ns_bws'].append((yield self.get_r_ns_bw(relay)))
-            report['path_bws'] = [r.bandwidth for r in path]
-            log.info("Download successful for router {fingerprint}.", fingerprint=path[0].id_hex)
-            defer.returnValue(report)
+        def take_samples():
+            try:
+                for sample in range(self.samples_per_circuit):
+                    yield self.fetch(path, attempt, session, sample)
+                    if session.failed:
+                        break
+            finally:
+                yield session.close()
+        return take_samples()
+
+    def fetch(self, path, attempt=0, session=None, sample=0):
+        """
+        Download a file over `path` and send the report to the result sink.
+
+        With a CircuitSession the download reuses its circuit and connection
+        pool, otherwise a new circuit is built.
+        """
+        assert None not in path
+        mirror = self.mirrors.acquire() if self.mirrors else None
+        # The mirror is released once the measurement is reported, or here
+        # if the request can't be made.
+        try:
+            baseurl = mirror.url if mirror else self.baseurl
+            if self.range_manifest is None:
+                url = self.choose_url(path, baseurl)
+                headers = None
+                file_size = self.choose_file_size(path)  # File size in KB
+                expected_body = self.bw_files[file_size][1]
+
+                def read_body(response):
+                    return hashingReadBody(response, spans=self.spans)
+                log.info("Downloading file '{file_size}' over [{relay_fp}, {exit_fp}].",
+                         file_size=url.split('/')[-1], relay_fp=path[0].id_hex,
+                         exit_fp=path[-1].id_hex)
+            else:
+                manifest = self.range_manifest
+                first_block, num_blocks = self.choose_blocks(path)
+                url = self.make_url(manifest.name, baseurl)
+                byte_range = manifest.byte_range(first_block, num_blocks)
+                headers = Headers({'Range': [manifest.range_header(first_block, num_blocks)]})
+                file_size = manifest.range_length(first_block, num_blocks) / 1024.0
+                expected_body = manifest.expected_hashes(first_block, num_blocks)
+                blocks_sample = None
+                if self.integrity == 'sampled':
+                    blocks_sample = sample_blocks(num_blocks, self.sample_blocks)
+                    expected_body = [block_hash if i in blocks_sample else None
+                                     for i, block_hash in enumerate(expected_body)]
+
+                def read_body(response):
+                    return blockHashingReadBody(response, manifest.block_size,
+                                                sample=blocks_sample, spans=self.spans)
+                log.info("Downloading bytes {start}-{end} of '{name}' over "
+                         "[{relay_fp}, {exit_fp}].",
+                         start=byte_range[0], end=byte_range[1], name=manifest.name,
+                         relay_fp=path[0].id_hex, exit_fp=path[-1].id_hex)
+        except Exception:
+            if mirror:
+                self.mirrors.release(mirror)
+            raise
+        time_start = self.now()
 
         def circ_failure(failure):
             time_end = self.now()
@@ -140,8 +417,26 @@ class BwScan(object):
             report['time_start'] = time_start
             report['path'] = [r.id_hex for r in path]
             report['failure'] = failure.__repr__()
+            report['failure_class'] = classify_failure(failure)
+            report['attempt'] = attempt
+            self.count_download(report['failure_class'])
             log.warn("Download failed for router {fingerprint}: {failure}.",
                      fingerprint=path[0].id_hex, failure=report['failure'])
+
+            if mirror and report['failure_class'] in MIRROR_FAILURES:
+                self.mirrors.failed(mirror)
+            # The exit or the file server are more likely to cause these
+            if (self.failure_history is not None and
+                    report['failure_class'] not in MIRROR_FAILURES):
+                self.failure_history.failed(path[0].id_hex, time_end - time_start)
+            # A relay with successful samples over this circuit isn't retried
+            retry = not session or not session.successes
+            if session:
+                session.failed = True
+            if (retry and report['failure_class'] in RETRYABLE_FAILURES and
+                    attempt < self.max_retries):
+                self.failed_exits.setdefault(path[0], set()).add(path[-1])
+                self.retry_queue.append((path[0], attempt + 1))
             return report
 
         def timeoutDeferred(deferred, timeout):
@@ -156,13 +451,98 @@ class BwScan(object):
                 return result
             deferred.addBoth(gotResult)
 
-        d = fetch(self.state, path, url)
-        d.addCallback(hashingReadBody)
+        instance = session.instance if session else self.choose_instance()
+        self.instance_load[instance] += 1
+
+        def read_response(response):
+            body = read_body(response)
+            if self.spans is not None:
+                self.spans.span(BODY_TRANSFER, body)
+            return body
+
+        # The circuit whose bandwidth events are collected
+        circuit_ids = []
+        on_circuit = None
+        if self.bw_events is not None:
+            def on_circuit(circuit):
+                circuit_ids.append(circuit.id)
+                self.bw_events[instance].watch(circuit.id)
+
+        # An exception raised before the request is sent is reported like a
+        # failed request, which releases the mirror and the instance.
+        if session:
+            d = defer.maybeDeferred(session.fetch, url, headers, on_circuit=on_circuit)
+        else:
+            d = defer.maybeDeferred(fetch, self.states[instance], path, url, headers,
+                                    socks_endpoint=self.socks_endpoint(instance),
+                                    spans=self.spans, on_circuit=on_circuit)
+        d.addCallback(read_response)
         timeoutDeferred(d, self.request_timeout)
-        d.addCallbacks(get_circuit_bw)
-        d.addErrback(circ_failure)
-        d.addCallback(self.result_sink.send)
-        return d
+
+        # One generator for the rest of the measurement costs less than a
+        # callback per step, see benchmarks/pipeline.py.
+        @defer.inlineCallbacks
+        def report_measurement():
+            try:
+                try:
+                    body = yield d
+                    time_end = self.now()
+                    if body != expected_body:
+                        raise DownloadIncomplete
+                    report = dict()
+                    report['time_end'] = time_end
+                    report['time_start'] = time_start
+                    request_duration = report['time_end'] - report['time_start']
+                    report['circ_bw'] = int((file_size * 1024) // request_duration)
+                    if circuit_ids:
+                        report['tor_bws'] = self.bw_events[instance].collect(circuit_ids[0])
+                        report['tor_circ_bw'] = tor_throughput(report['tor_bws'])
+                    report['path'] = [r.id_hex for r in path]
+                    if self.range_manifest is not None:
+                        report['range'] = list(byte_range)
+                    if mirror:
+                        self.mirrors.succeeded(mirror, file_size * 1024, request_duration)
+                    if session:
+                        session.successes += 1
+                    log.debug("Download took {duration} for {size} MB",
+                              duration=request_duration, size=int(file_size // 1024))
+
+                    # We need to wait for these deferreds to be ready, we can't
+                    # serialize deferreds.
+                    lookup = self.bw_cache.get(path)
+                    if self.spans is not None:
+                        self.spans.span(CONTROL_PORT, lookup)
+                    path_bws = yield lookup
+                    report['path_desc_bws'] = [desc_bw for desc_bw, _ in path_bws]
+                    report['path_ns_bws'] = [ns_bw for _, ns_bw in path_bws]
+                    report['path_bws'] = [r.bandwidth for r in path]
+                    self.count_download('success')
+                    self.downloaded_bytes += int(file_size * 1024)
+                    if self.failure_history is not None:
+                        self.failure_history.succeeded(path[0].id_hex)
+                    log.info("Download successful for router {fingerprint}.",
+                             fingerprint=path[0].id_hex)
+                except Exception:
+                    report = circ_failure(Failure())
+
+                report['mirror'] = baseurl
+                if session:
+                    report['sample'] = sample
+                if len(self.states) > 1:
+                    report['tor_instance'] = instance
+            finally:
+                self.instance_load[instance] -= 1
+                if circuit_ids:
+                    self.bw_events[instance].collect(circuit_ids[0])
+                if mirror:
+                    self.mirrors.release(mirror)
+            result = yield self.result_sink.send(report)
+            defer.returnValue(result)
+
+        return report_measurement()
+
+    def count_download(self, outcome):
+        self.download_counts[outcome] = self.download_counts.get(outcome, 0) + 1
 
     @defer.inlineCallbacks
     def get_r_ns_bw(self, router):
@@ -172,9 +552,8 @@ class BwScan(object):
         :return: tuple of NetworkStatus bandwidth and Measured flag
         """
 
-        raw_descriptor = yield self.state.protocol.get_info_raw('ns/id/{}'.format(router.id_hex))
-        router_ns_entry = RouterStatusEntryV3(raw_descriptor)
-        defer.returnValue((router_ns_entry.bandwidth, router_ns_entry.is_unmeasured))
+        [(_, ns_bw)] = yield self.bw_cache.get([router])
+        defer.returnValue(ns_bw)
 
     @defer.inlineCallbacks
     def get_r_desc_bw(self, router):
@@ -185,8 +564,5 @@ class BwScan(object):
                  and observed_bandwidth.
         """
 
-        raw_descriptor = yield self.state.protocol.get_info_raw('desc/id/{}'.format(router.id_hex))
-        server_descriptor = ServerDescriptor(raw_descriptor)
-        defer.returnValue((server_descriptor.average_bandwidth,
-                           server_descriptor.burst_bandwidth,
-                           server_descriptor.observed_bandwidth))
+        [(desc_bw, _)] = yield self.bw_cache.get([router])
+        defer.returnValue(desc_bw)
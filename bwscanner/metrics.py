@@ -0,0 +1,172 @@
+"""
+Expose live metrics of a running scan in the Prometheus text format.
+
+The metrics are served over HTTP by the scanner's own reactor, so the
+reactor lag they report is the delay every other event of the scan sees.
+"""
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from bwscanner.logger import log
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Weight of the newest sample in the throughput moving average
+THROUGHPUT_ALPHA = 0.3
+
+
+class ScanMetrics(object):
+    """
+    Sample the reactor lag and download throughput of a BwScan every
+    `interval` seconds and render its current state.
+    """
+    def __init__(self, scan, clock, interval=1.0):
+        self.scan = scan
+        self.clock = clock
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.bytes_per_second = 0.0
+        self._last_bytes = 0
+        self._expected = None
+        self._call = None
+
+    def start(self):
+        self._last_bytes = self.scan.downloaded_bytes
+        self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        self._expected = self.clock.seconds() + self.interval
+        self._call = self.clock.callLater(self.interval, self.sample)
+
+    def sample(self):
+        """
+        Record how late this call ran, which is how long the reactor was
+        busy with other events, and the throughput since the last sample.
+        """
+        now = self.clock.seconds()
+        self.lag = max(now - self._expected, 0.0)
+        self.max_lag = max(self.max_lag, self.lag)
+        elapsed = self.interval + self.lag
+        downloaded = self.scan.downloaded_bytes
+        throughput = (downloaded - self._last_bytes) / elapsed
+        self._last_bytes = downloaded
+        self.bytes_per_second += THROUGHPUT_ALPHA * (throughput - self.bytes_per_second)
+        if self.lag > self.interval:
+            log.warn("The reactor was blocked for {lag:.2f}s.", lag=self.lag)
+        self._schedule()
+
+    def eta(self):
+        """
+        Estimate the seconds left in the current pass from the rate relays
+        were measured so far, or None before the first measurement. Retries
+        at the end of the pass are not included.
+        """
+        scan = self.scan
+        if scan.circuits is None or not scan.completed:
+            return None
+        remaining = max(scan.circuits.num_circuits - scan.completed, 0)
+        elapsed = scan.now() - scan.pass_start
+        return elapsed * remaining / float(scan.completed)
+
+    def collect(self):
+        """
+        Return a list of (name, type, help, [(labels, value)]) tuples.
+        """
+        scan = self.scan
+        sem = scan.semaphore
+        metrics = [
+            ('bwscan_measurements_in_flight', 'gauge',
+             'Measurements holding a slot of the request limit.',
+             [({}, sem.limit - sem.tokens if sem else 0)]),
+            ('bwscan_semaphore_waiters', 'gauge',
+             'Measurements waiting for a slot of the request limit.',
+             [({}, len(sem.waiting) if sem else 0)]),
+            ('bwscan_downloads_in_flight', 'gauge',
+             'Downloads in flight on each Tor instance.',
+             [({'instance': str(i)}, load) for i, load in enumerate(scan.instance_load)]),
+            ('bwscan_downloads_total', 'counter',
+             'Finished downloads by outcome, success or the failure class.',
+             [({'outcome': outcome}, count)
+              for outcome, count in sorted(scan.download_counts.items())]),
+            ('bwscan_downloaded_bytes_total', 'counter',
+             'Bytes downloaded by successful measurements.',
+             [({}, scan.downloaded_bytes)]),
+            ('bwscan_download_bytes_per_second', 'gauge',
+             'Moving average of the download throughput.',
+             [({}, self.bytes_per_second)]),
+            ('bwscan_control_requests_total', 'counter',
+             'GETINFO requests to the control port for relay bandwidths.',
+             [({}, scan.bw_cache.requests)]),
+            ('bwscan_control_request_seconds_total', 'counter',
+             'Total duration of the GETINFO requests.',
+             [({}, scan.bw_cache.request_seconds)]),
+            ('bwscan_reactor_lag_seconds', 'gauge',
+             'Delay of the last timed call on the reactor.',
+             [({}, self.lag)]),
+            ('bwscan_reactor_lag_max_seconds', 'gauge',
+             'Largest delay of a timed call on the reactor.',
+             [({}, self.max_lag)]),
+            ('bwscan_passes_total', 'counter',
+             'Finished scan passes.',
+             [({}, scan.passes)]),
+            ('bwscan_pass_measurements', 'gauge',
+             'Measurements finished in the current pass, including retries.',
+             [({}, scan.completed)]),
+        ]
+        if scan.circuits is not None:
+            metrics.append(('bwscan_pass_circuits', 'gauge',
+                            'Relays to measure in the current pass.',
+                            [({}, scan.circuits.num_circuits)]))
+        eta = self.eta()
+        if eta is not None:
+            metrics.append(('bwscan_pass_eta_seconds', 'gauge',
+                            'Estimated time left in the current pass.', [({}, eta)]))
+        backlog = getattr(scan.result_sink, 'backlog', None)
+        if backlog is not None:
+            metrics.append(('bwscan_result_sink_backlog', 'gauge',
+                            'Results which are not written yet.', [({}, backlog)]))
+        return metrics
+
+    def render(self):
+        lines = []
+        for name, kind, description, samples in self.collect():
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, labels[key])
+                                      for key in sorted(labels))
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append('{}{} {}'.format(name, label_text, value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', CONTENT_TYPE)
+        return self.metrics.render()
+
+
+def serve_metrics(reactor, scan, port, interface='127.0.0.1'):
+    """
+    Start sampling the metrics of `scan` and serve them on `port`. Returns
+    the ScanMetrics and the listening port.
+    """
+    metrics = ScanMetrics(scan, reactor)
+    metrics.start()
+    listening_port = reactor.listenTCP(port, Site(MetricsResource(metrics)),
+                                       interface=interface)
+    log.info("Serving metrics on http://{interface}:{port}/metrics.",
+             interface=interface or '0.0.0.0', port=port)
+    return metrics, listening_port
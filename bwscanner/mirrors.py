@@ -0,0 +1,156 @@
+"""
+Spread the measurement downloads over several file server mirrors.
+
+Each mirror is probed at startup and its download throughput and errors
+are tracked during the scan. Downloads go to the mirror with the best
+expected throughput which still has spare capacity.
+"""
+from twisted.internet import defer
+from twisted.web.client import readBody
+
+from bwscanner.logger import log
+
+# Weight of the newest sample in the throughput moving average
+THROUGHPUT_ALPHA = 0.3
+# Stop using a mirror for a while after this many failures in a row
+MAX_CONSECUTIVE_FAILURES = 3
+BACKOFF_DELAY = 60
+MAX_BACKOFF_DELAY = 600
+
+
+class Mirror(object):
+    """
+    A file server mirror and the statistics collected about it.
+    """
+    def __init__(self, url, capacity):
+        """
+        url: the base URL of the mirror, ending with a /
+        capacity: the number of simultaneous downloads the mirror should
+        serve
+        """
+        assert url.endswith('/')
+        self.url = url
+        self.capacity = capacity
+        self.in_flight = 0
+        # Moving average of the download throughput in bytes per second
+        self.throughput = None
+        self.latency = None
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.down_until = 0
+
+    @property
+    def error_rate(self):
+        return self.failures / float(self.successes + self.failures + 1)
+
+    def __repr__(self):
+        return '<Mirror %s in_flight=%d throughput=%r errors=%d/%d>' % (
+            self.url, self.in_flight, self.throughput, self.failures,
+            self.successes + self.failures)
+
+
+class MirrorSet(object):
+    """
+    Choose the mirror for each download.
+    """
+    def __init__(self, urls, clock, capacity=10):
+        self.mirrors = [Mirror(url, capacity) for url in urls]
+        self.clock = clock
+
+    def available(self, mirror):
+        return mirror.down_until <= self.clock.seconds()
+
+    def expected_throughput(self, mirror):
+        """
+        The throughput we expect from one more download from `mirror`.
+
+        Mirrors without throughput samples yet are assumed to be as fast as
+        the fastest mirror so they get tried.
+        """
+        known = [m.throughput for m in self.mirrors if m.throughput is not None]
+        throughput = mirror.throughput
+        if throughput is None:
+            throughput = max(known) if known else 1.0
+        load = mirror.in_flight / float(mirror.capacity)
+        return throughput * (1 - mirror.error_rate) * (1 - load)
+
+    def acquire(self):
+        """
+        Choose the mirror for a download and count it as in flight until
+        `release` is called.
+
+        When every mirror is busy or failing we use the least loaded one
+        rather than wait, so a measurement is never blocked on the mirrors.
+        """
+        candidates = [m for m in self.mirrors
+                      if self.available(m) and m.in_flight < m.capacity]
+        if candidates:
+            mirror = max(candidates, key=lambda m: (self.expected_throughput(m),
+                                                    -(m.latency or 0)))
+        else:
+            mirror = min(self.mirrors, key=lambda m: (not self.available(m), m.down_until,
+                                                      m.in_flight / float(m.capacity)))
+        mirror.in_flight += 1
+        return mirror
+
+    def release(self, mirror):
+        mirror.in_flight -= 1
+
+    def succeeded(self, mirror, size, duration):
+        """
+        Record a download of `size` bytes which took `duration` seconds.
+        """
+        mirror.successes += 1
+        mirror.consecutive_failures = 0
+        throughput = size / max(duration, 1e-3)
+        if mirror.throughput is None:
+            mirror.throughput = throughput
+        else:
+            mirror.throughput += THROUGHPUT_ALPHA * (throughput - mirror.throughput)
+
+    def failed(self, mirror):
+        """
+        Record a failed download, a mirror which keeps failing isn't used
+        for an exponentially increasing time.
+        """
+        mirror.failures += 1
+        mirror.consecutive_failures += 1
+        if mirror.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            delay = min(BACKOFF_DELAY * 2 ** (mirror.consecutive_failures -
+                                              MAX_CONSECUTIVE_FAILURES),
+                        MAX_BACKOFF_DELAY)
+            mirror.down_until = self.clock.seconds() + delay
+            log.warn("Mirror {url} failed {count} times in a row, not using it for {delay}s.",
+                     url=mirror.url, count=mirror.consecutive_failures, delay=delay)
+
+    def probe(self, agent, path):
+        """
+        Request `path` from each mirror with `agent` and record the latency
+        of the response. Mirrors which don't answer aren't used until their
+        backoff delay has passed.
+        """
+        def probe_mirror(mirror):
+            start = self.clock.seconds()
+
+            def probed(code):
+                if code >= 400:
+                    raise ValueError("HTTP status {}".format(code))
+                mirror.latency = self.clock.seconds() - start
+                log.info("Mirror {url} answered in {latency:.3f}s.", url=mirror.url,
+                         latency=mirror.latency)
+
+            def probe_failed(failure):
+                log.warn("Mirror {url} failed the probe: {error}.", url=mirror.url,
+                         error=failure.getErrorMessage())
+                mirror.failures += 1
+                mirror.down_until = self.clock.seconds() + BACKOFF_DELAY
+
+            d = agent.request('HEAD', mirror.url + path)
+            d.addCallback(lambda response: readBody(response).addCallback(
+                lambda _: response.code))
+            d.addCallback(probed)
+            d.addErrback(probe_failed)
+            return d
+
+        return defer.gatherResults([probe_mirror(mirror) for mirror in self.mirrors])
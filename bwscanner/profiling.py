@@ -0,0 +1,161 @@
+"""
+Find out where a slow scan spends its time and memory.
+
+SpanRecorder collects the duration of each stage of the measurements in
+histograms. MemoryTracer takes periodic memory snapshots, with tracemalloc
+when it is available and otherwise by counting the live objects of each
+type, which is all Python 2 offers.
+"""
+import gc
+import json
+import resource
+from bisect import bisect_left
+
+from bwscanner.logger import log
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Upper bounds in seconds of the histogram buckets, the last bucket has no
+# upper bound.
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120)
+
+# The stages of a measurement
+CIRCUIT_BUILD = 'circuit_build'
+FIRST_BYTE = 'first_byte'
+BODY_TRANSFER = 'body_transfer'
+HASHING = 'hashing'
+CONTROL_PORT = 'control_port'
+SINK_WRITE = 'sink_write'
+
+
+class SpanRecorder(object):
+    """
+    Record how long each stage of the measurements took.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        # Map stage -> [count per bucket, ...]
+        self.counts = {}
+        self.totals = {}
+        self.maxima = {}
+
+    def record(self, stage, duration):
+        if stage not in self.counts:
+            self.counts[stage] = [0] * (len(SPAN_BUCKETS) + 1)
+            self.totals[stage] = 0.0
+            self.maxima[stage] = 0.0
+        self.counts[stage][bisect_left(SPAN_BUCKETS, duration)] += 1
+        self.totals[stage] += duration
+        self.maxima[stage] = max(self.maxima[stage], duration)
+
+    def span(self, stage, deferred):
+        """
+        Record the time until `deferred` succeeds as a span of `stage`.
+        Failures aren't recorded, their duration is mostly the timeout.
+        """
+        start = self.clock.seconds()
+
+        def finished(result):
+            self.record(stage, self.clock.seconds() - start)
+            return result
+        return deferred.addCallback(finished)
+
+    def histograms(self):
+        """
+        Return the histogram, count, total and maximum duration of each stage.
+        """
+        histograms = {}
+        for stage, counts in self.counts.items():
+            bounds = [str(bound) for bound in SPAN_BUCKETS] + ['inf']
+            histograms[stage] = {
+                'buckets': dict(zip(bounds, counts)),
+                'count': sum(counts),
+                'total_s': self.totals[stage],
+                'max_s': self.maxima[stage],
+            }
+        return histograms
+
+    def summary(self):
+        """
+        Return a line per stage with its count, mean, maximum and a text
+        histogram.
+        """
+        lines = []
+        for stage, counts in sorted(self.counts.items()):
+            count = sum(counts)
+            bars = ' '.join('<={}:{}'.format(bound, counts[i])
+                            for i, bound in enumerate(SPAN_BUCKETS) if counts[i])
+            if counts[-1]:
+                bars += ' >{}:{}'.format(SPAN_BUCKETS[-1], counts[-1])
+            lines.append('{:<14} n={:<6} mean={:.3f}s max={:.3f}s  {}'.format(
+                stage, count, self.totals[stage] / count, self.maxima[stage], bars))
+        return lines
+
+    def save(self, path):
+        with open(path, 'w') as spans_file:
+            json.dump(self.histograms(), spans_file, sort_keys=True, indent=2)
+        for line in self.summary():
+            log.info("Span {line}", line=line)
+
+
+class MemoryTracer(object):
+    """
+    Take a memory snapshot every `interval` seconds and log what grew the
+    most since the first one.
+    """
+    def __init__(self, clock, interval=60, top=10):
+        self.clock = clock
+        self.interval = interval
+        self.top = top
+        self.snapshots = []
+        self._first = None
+        self._call = None
+
+    def start(self):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        self._first = self.take_snapshot()
+        self._call = self.clock.callLater(self.interval, self.snapshot)
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def take_snapshot(self):
+        if tracemalloc is not None:
+            return tracemalloc.take_snapshot()
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def growth(self, snapshot):
+        """
+        Return the `top` (what, growth) pairs since the first snapshot, in
+        bytes per source line with tracemalloc or in objects per type.
+        """
+        if tracemalloc is not None:
+            stats = snapshot.compare_to(self._first, 'lineno')[:self.top]
+            return [(str(stat.traceback), stat.size_diff) for stat in stats]
+        growth = [(name, count - self._first.get(name, 0)) for name, count in snapshot.items()]
+        return sorted(growth, key=lambda item: -item[1])[:self.top]
+
+    def snapshot(self):
+        growth = self.growth(self.take_snapshot())
+        max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.snapshots.append({'time': self.clock.seconds(), 'max_rss_kb': max_rss_kb,
+                               'growth': growth})
+        log.info("Memory: max RSS {rss}kB, largest growth: {growth}.", rss=max_rss_kb,
+                 growth=', '.join('{} +{}'.format(what, size) for what, size in growth[:3]))
+        self._call = self.clock.callLater(self.interval, self.snapshot)
+
+    def save(self, path):
+        with open(path, 'w') as memory_file:
+            json.dump(self.snapshots, memory_file, indent=2)
@@ -0,0 +1,201 @@
+"""
+A compact snapshot of the relays in the consensus.
+
+The table is built once per consensus from two GETINFO requests instead of
+reading the txtorcon Router objects and asking Tor for the bandwidths of
+each relay. Its records are immutable tuples so the table is cheap to keep
+in memory, to pickle for another process and to store with a scan.
+"""
+import base64
+import binascii
+import json
+import os
+import time
+from collections import namedtuple
+
+from twisted.internet import defer, threads
+
+from bwscanner.logger import log
+
+# The relay table of a scan, stored in its directory. It is not a .json
+# file so it isn't read as results.
+RELAYS_FILE = 'relays'
+
+
+class Relay(namedtuple('Relay', ['id_hex', 'name', 'bandwidth', 'unmeasured', 'desc_bw',
+                                 'flags', 'exit_policy'])):
+    """
+    A relay with the Router attributes used to choose circuits.
+
+    id_hex: '$' and the hex fingerprint of the relay
+    bandwidth: the consensus bandwidth in KB/s, `unmeasured` is True when
+    it wasn't measured by the bandwidth authorities
+    desc_bw: the (average, burst, observed) bandwidths of the descriptor of
+    the relay, or None when Tor has no descriptor for it
+    flags: frozenset of the lower case consensus flags
+    exit_policy: the exit policy summary, like 'accept 80,443'
+    """
+    __slots__ = ()
+
+
+def identity_fingerprint(identity):
+    """
+    Return the '$' prefixed hex fingerprint of a base64 relay identity.
+    """
+    padded = identity + '=' * (-len(identity) % 4)
+    return '$' + binascii.hexlify(base64.b64decode(padded)).upper()
+
+
+def parse_descriptor_bandwidths(descriptors):
+    """
+    Return a map of relay fingerprint -> (average, burst, observed)
+    bandwidths from concatenated server descriptors.
+    """
+    bandwidths = {}
+    fingerprint = bandwidth = None
+    for line in descriptors.splitlines() + ['router']:
+        if line.startswith('opt '):
+            line = line[4:]
+        keyword, _, args = line.partition(' ')
+        if keyword == 'router':
+            if fingerprint and bandwidth:
+                bandwidths[fingerprint] = bandwidth
+            fingerprint = bandwidth = None
+        elif keyword == 'fingerprint':
+            fingerprint = '$' + ''.join(args.split())
+        elif keyword == 'bandwidth':
+            bandwidth = tuple(int(bw) for bw in args.split()[:3])
+    return bandwidths
+
+
+class RelayTable(object):
+    """
+    The relays of one consensus, `routers` maps their fingerprints to their
+    Relay records so a table can be used in place of a TorState to choose
+    circuits.
+    """
+    def __init__(self, relays):
+        self.routers = dict((relay.id_hex, relay) for relay in relays)
+
+    def __len__(self):
+        return len(self.routers)
+
+    @classmethod
+    def from_network_status(cls, network_status, descriptors=''):
+        """
+        Build the table from the router status entries of the consensus,
+        as returned by GETINFO ns/all, and the server descriptors of
+        GETINFO desc/all-recent.
+        """
+        desc_bws = parse_descriptor_bandwidths(descriptors)
+        # Most relays share a few flag sets and exit policies
+        interned = {}
+        relays = []
+        fields = None
+        for line in network_status.splitlines() + ['r']:
+            keyword, _, args = line.partition(' ')
+            if keyword == 'r':
+                if fields is not None:
+                    relays.append(Relay(**fields))
+                args = args.split()
+                if len(args) < 2:
+                    fields = None
+                    continue
+                id_hex = identity_fingerprint(args[1])
+                fields = {'id_hex': id_hex, 'name': args[0], 'bandwidth': 0,
+                          'unmeasured': False, 'desc_bw': desc_bws.get(id_hex),
+                          'flags': frozenset(), 'exit_policy': ''}
+            elif fields is None:
+                continue
+            elif keyword == 's':
+                flags = frozenset(flag.lower() for flag in args.split())
+                fields['flags'] = interned.setdefault(flags, flags)
+            elif keyword == 'w':
+                values = dict(arg.split('=', 1) for arg in args.split() if '=' in arg)
+                fields['bandwidth'] = int(values.get('Bandwidth', 0))
+                fields['unmeasured'] = values.get('Unmeasured') == '1'
+            elif keyword == 'p':
+                fields['exit_policy'] = interned.setdefault(args, args)
+        return cls(relays)
+
+    def relay_info(self):
+        """
+        Return a map of relay fingerprint -> (nickname, descriptor average
+        bandwidth, consensus bandwidth) of the relays with a descriptor,
+        like aggregate_lines expects.
+        """
+        return dict((relay.id_hex, (relay.name, relay.desc_bw[0], relay.bandwidth))
+                    for relay in self.routers.values() if relay.desc_bw is not None)
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as relays_file:
+            json.dump([[relay.id_hex, relay.name, relay.bandwidth, relay.unmeasured,
+                        relay.desc_bw, sorted(relay.flags), relay.exit_policy]
+                       for relay in sorted(self.routers.values())], relays_file)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as relays_file:
+            records = json.load(relays_file)
+        interned = {}
+        relays = []
+        for id_hex, name, bandwidth, unmeasured, desc_bw, flags, exit_policy in records:
+            flags = frozenset(str(flag) for flag in flags)
+            relays.append(Relay(str(id_hex), name, bandwidth, unmeasured,
+                                tuple(desc_bw) if desc_bw is not None else None,
+                                interned.setdefault(flags, flags), exit_policy))
+        return cls(relays)
+
+
+def load_relay_table(scan_dir):
+    """
+    Return the relay table stored with the scan in `scan_dir`, or None for
+    scans made without one.
+    """
+    path = os.path.join(scan_dir, RELAYS_FILE)
+    if not os.path.exists(path):
+        return None
+    return RelayTable.load(path)
+
+
+def info_value(reply, key):
+    """
+    Return the value of `key` from the raw reply to a GETINFO command for
+    that key alone.
+    """
+    lines = reply.splitlines()
+    if lines and lines[-1].strip() == 'OK':
+        lines.pop()
+    if lines and lines[0].startswith(key + '='):
+        lines[0] = lines[0][len(key) + 1:]
+        if not lines[0]:
+            lines.pop(0)
+    return '\n'.join(lines)
+
+
+def parse_relay_table(network_status, descriptors):
+    """
+    Return the RelayTable of the raw replies to GETINFO ns/all and
+    desc/all-recent.
+    """
+    return RelayTable.from_network_status(info_value(network_status, 'ns/all'),
+                                          info_value(descriptors, 'desc/all-recent'))
+
+
+@defer.inlineCallbacks
+def build_relay_table(tor_protocol):
+    """
+    Return a Deferred which fires with the RelayTable of the current
+    consensus of a Tor instance.
+    """
+    start = time.time()
+    # The replies are a few megabytes, they are parsed in a worker thread
+    # rather than by get_info so the reactor keeps serving the measurements.
+    network_status = yield tor_protocol.get_info_raw('ns/all')
+    descriptors = yield tor_protocol.get_info_raw('desc/all-recent')
+    table = yield threads.deferToThread(parse_relay_table, network_status, descriptors)
+    log.info("Built the table of {count} relays in {seconds:.1f}s.", count=len(table),
+             seconds=time.time() - start)
+    defer.returnValue(table)
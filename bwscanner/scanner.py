@@ -1,26 +1,53 @@
+import cProfile
+import glob
+import json
 import os
+import socket
 import sys
 import time
 
 import click
-from twisted.internet import reactor
 
-from bwscanner.attacher import connect_to_tor
+# The Twisted, txtorcon and scan modules take most of a second to import, so
+# they are imported by the commands which use them. This keeps `--help`,
+# `list` and `manifest` fast.
 from bwscanner.logger import setup_logging, log
-from bwscanner.measurement import BwScan
-from bwscanner.aggregate import write_aggregate_data
-from bwscanner.config import TOR_OPTIONS, DEFAULT, BW_FILES
+from bwscanner.config import TOR_OPTIONS, DEFAULT, BW_FILES, INTEGRITY_MODES
+from bwscanner.manifest import DEFAULT_BLOCK_SIZE, generate_manifest, load_manifest
 from bwscanner import __version__
 
+# The reactors which can be chosen with --reactor
+REACTORS = ('default', 'epoll', 'poll', 'select', 'asyncio')
+
 
 class ScanInstance(object):
     """
     Store the configuration and state for the CLI tool.
     """
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, tor_dir=None):
         self.data_dir = data_dir
         self.measurement_dir = os.path.join(data_dir, 'measurements')
-        self.tor_dir = os.path.join(data_dir, 'tor_data')
+        self.tor_dir = tor_dir or os.path.join(data_dir, 'tor_data')
+        self.launch_tor = False
+        self.circuit_build_timeout = 20
+        self.profile = False
+        self.trace_mem = False
+        self.reactor_name = 'default'
+        # Records the duration of the measurement stages with --profile
+        self.spans = None
+        self._tor_state = None
+
+    @property
+    def tor_state(self):
+        """
+        A Deferred which fires with the state of the Tor instance. We only
+        connect to (or launch) Tor when a command first needs it.
+        """
+        if self._tor_state is None:
+            from bwscanner.attacher import connect_to_tor
+            self._tor_state = connect_to_tor(self.launch_tor, self.circuit_build_timeout,
+                                             TOR_OPTIONS, self.tor_dir)
+        return self._tor_state
 
     def __repr__(self):
         return '<BWScan %r>' % self.data_dir
@@ -38,31 +65,111 @@ pass_scan = click.make_pass_decorator(ScanInstance)
               default='info', type=click.Choice(['debug', 'info', 'warn', 'error', 'critical']))
 @click.option('-f', '--logfile', type=click.Path(), help='The file the log will be written to',
               default=os.environ.get("BWSCANNER_LOGFILE", 'bwscanner.log'))
+@click.option('--log-rate-limit', type=float, default=0,
+              help='Log at most this many of each message about single relays per second, '
+              'and how many were suppressed (default: no limit).')
 @click.option('--launch-tor/--no-launch-tor', default=False,
               help='Launch Tor or try to connect to an existing Tor instance.')
 @click.option('--circuit-build-timeout', default=20,
               help='Option passed when launching Tor.')
+@click.option('--tor-dir', type=click.Path(), default=None,
+              help='Data directory of the launched Tor instance (default: tor_data in the '
+              'data directory).')
+@click.option('--profile', is_flag=True, default=False,
+              help='Run the command under cProfile and record the duration of each stage of '
+              'the measurements. The results are written to the profiles directory in the '
+              'data directory.')
+@click.option('--trace-mem', is_flag=True, default=False,
+              help='Take a memory snapshot every minute and log what grew the most.')
+@click.option('--reactor', 'reactor_name', default='default', type=click.Choice(REACTORS),
+              help='The Twisted reactor to run on (default: the platform default). asyncio '
+              'requires Python 3.')
 @click.version_option(__version__)
 @click.pass_context
-def cli(ctx, data_dir, loglevel, logfile, launch_tor, circuit_build_timeout):
+def cli(ctx, data_dir, loglevel, logfile, log_rate_limit, launch_tor, circuit_build_timeout,
+        tor_dir, profile, trace_mem, reactor_name):
     """
     The bwscan tool measures Tor relays and calculates their bandwidth. These
     bandwidth measurements can then be aggregate to create the bandwidth
     values used by the Tor bandwidth authorities when creating the Tor consensus.
     """
+    # Before anything imports the default reactor
+    install_reactor(reactor_name)
+
     # Create the data directory if it doesn't exist
     data_dir = os.path.abspath(data_dir)
-    ctx.obj = ScanInstance(data_dir)
+    ctx.obj = ScanInstance(data_dir, tor_dir and os.path.abspath(tor_dir))
+    ctx.obj.launch_tor = launch_tor
+    ctx.obj.circuit_build_timeout = circuit_build_timeout
+    ctx.obj.loglevel = loglevel
+    ctx.obj.logfile = logfile
+    ctx.obj.log_rate_limit = log_rate_limit
+    ctx.obj.profile = profile
+    ctx.obj.trace_mem = trace_mem
+    ctx.obj.reactor_name = reactor_name
 
     if not os.path.isdir(ctx.obj.measurement_dir):
         os.makedirs(ctx.obj.measurement_dir)
 
-    # Create a connection to a Tor instance
-    ctx.obj.tor_state = connect_to_tor(launch_tor, circuit_build_timeout,
-                                       TOR_OPTIONS, ctx.obj.tor_dir)
-
     # Set up the logger to only output log lines of level `loglevel` and above.
-    setup_logging(log_level=loglevel, log_name=logfile)
+    # The simulate command writes its JSON summary to stdout by default, its
+    # log goes to stderr instead.
+    console = sys.stderr if ctx.invoked_subcommand == 'simulate' else sys.stdout
+    setup_logging(log_level=loglevel, log_name=logfile, rate_limit=log_rate_limit,
+                  console=console)
+
+    if profile or trace_mem:
+        start_profiling(ctx, profile, trace_mem)
+
+
+def install_reactor(name):
+    """
+    Install the Twisted reactor `name`, one of REACTORS, as the global
+    reactor. The commands import the reactor when they run, after this.
+    """
+    if name == 'default':
+        return
+    from twisted.application.reactors import installReactor
+    try:
+        installReactor(name)
+    except ImportError as e:
+        raise click.UsageError("Can't use the {} reactor: {}".format(name, e))
+
+
+def start_profiling(ctx, profile, trace_mem):
+    """
+    Profile the subcommand and write the results when it ends.
+    """
+    from twisted.internet import reactor
+    from bwscanner.profiling import MemoryTracer, SpanRecorder
+
+    profile_dir = os.path.join(ctx.obj.data_dir, 'profiles')
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    run_name = '{}-{}-{}'.format(ctx.invoked_subcommand, int(time.time()), os.getpid())
+
+    if profile:
+        profiler = cProfile.Profile()
+        ctx.obj.spans = SpanRecorder(reactor)
+
+        def save_profile():
+            profiler.disable()
+            stats_path = os.path.join(profile_dir, run_name + '.pstats')
+            profiler.dump_stats(stats_path)
+            log.info("Wrote the profile to {path}.", path=stats_path)
+            if ctx.obj.spans.counts:
+                ctx.obj.spans.save(os.path.join(profile_dir, run_name + '-spans.json'))
+        ctx.call_on_close(save_profile)
+        profiler.enable()
+
+    if trace_mem:
+        tracer = MemoryTracer(reactor)
+        tracer.start()
+
+        def save_memory():
+            tracer.stop()
+            tracer.save(os.path.join(profile_dir, run_name + '-memory.json'))
+        ctx.call_on_close(save_memory)
 
 
 @cli.command(short_help="Measure the Tor relays.")
@@ -75,37 +182,563 @@ def cli(ctx, data_dir, loglevel, logfile, launch_tor, circuit_build_timeout):
 @click.option('--request-limit', default=10,
               help='Limit the number of simultaneous bandwidth measurements '
               '(default: %d).' % 10)
-@click.option('--baseurl', default=DEFAULT.get('baseurl'),
-              help='File server URL')
+@click.option('--max-retries', default=2,
+              help='Retry failed measurements with a different exit up to this many '
+              'times at the end of the scan (default: %d).' % 2)
+@click.option('--samples-per-circuit', default=1,
+              help='Take this many measurements one after the other over each circuit, '
+              'reusing its HTTP connection (default: %d).' % 1)
+@click.option('--baseurl', 'baseurls', multiple=True, default=[DEFAULT.get('baseurl')],
+              help='File server URL, repeat it to spread the downloads over several mirrors.')
+@click.option('--mirror-capacity', default=10,
+              help='Number of simultaneous downloads from each mirror before the next best '
+              'mirror is used (default: %d).' % 10)
+@click.option('--range-manifest', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Download byte ranges of the single large file described by this '
+              'block manifest instead of the fixed size files.')
+@click.option('--integrity', default='full', type=click.Choice(INTEGRITY_MODES),
+              help='How downloads are verified: hash all of the data (full) or only hash '
+              'some blocks of each range (sampled, requires --range-manifest). '
+              'Default: full.')
+@click.option('--tor-instances', default=1,
+              help='Spread the measurements over this many Tor instances, each with its '
+              'own SOCKS port (default: 1). --request-limit applies to all of them.')
+@click.option('--control-port', 'control_ports', type=int, multiple=True,
+              help='Control port of an additional running Tor instance, repeat it for '
+              'each instance after the first one when using --no-launch-tor.')
+@click.option('--workers', default=1,
+              help='Split the scan between this many worker processes, each with its own '
+              'Tor connection (default: 1). --request-limit applies to each worker.')
+@click.option('--output-dir', type=click.Path(file_okay=False), default=None,
+              help='Write the measurements to this existing directory instead of a new '
+              'scan directory. Used by the worker processes.')
+@click.option('--coordinator', default=None,
+              help='URL of a `bwscan coordinator` to lease the relays to measure from '
+              'instead of scanning a partition. Results are uploaded to the coordinator.')
+@click.option('--client-name', default='{}-{}'.format(socket.gethostname(), os.getpid()),
+              help='Name of this scanner reported to the coordinator (default: '
+              'hostname-pid).')
+@click.option('--coordinator-token', default=None,
+              help='Token the coordinator was started with.')
+@click.option('--resume', is_flag=True, default=False,
+              help='Continue the latest interrupted scan, with its partition, without '
+              'measuring again the relays it already measured.')
+@click.option('--metrics-port', type=int, default=None,
+              help='Serve live metrics of the scan in the Prometheus text format on this '
+              'local port. With --workers, worker i uses this port + i.')
+@click.option('--skip-failing', is_flag=True, default=False,
+              help='Skip the relays which failed their last measurements, in this and '
+              'previous scans, for a time which doubles after each failure. They are '
+              'measured again once that time is over.')
+@click.option('--tor-bw-events', is_flag=True, default=False,
+              help='Also record the throughput of each measurement as counted by Tor, from '
+              'its CIRC_BW and STREAM_BW events, in tor_bws and tor_circ_bw.')
 @pass_scan
-def scan(scan, partitions, current_partition, timeout, request_limit, baseurl):
+def scan(scan, partitions, current_partition, timeout, request_limit, max_retries,
+         samples_per_circuit, baseurls, mirror_capacity, range_manifest, integrity,
+         tor_instances, control_ports, workers, output_dir, coordinator, client_name,
+         coordinator_token, resume, metrics_port, skip_failing, tor_bw_events):
     """
     Start a scan through each Tor relay to measure it's bandwidth.
     """
+    from twisted.internet import defer, reactor
+    from twisted.web.client import Agent
+    from bwscanner.attacher import connect_to_tor_instances
+    from bwscanner.coordinator import CoordinatorClient, run_client
+    from bwscanner.measurement import BwScan
+    from bwscanner.metrics import serve_metrics
+    from bwscanner.mirrors import MirrorSet
+    from bwscanner.relays import RELAYS_FILE, build_relay_table
+    from bwscanner.writer import write_scan_info
+
     log.info("Using {data_dir} as the data directory.", data_dir=scan.data_dir)
     assert isinstance(BW_FILES, dict)
-    # XXX: check that each run is producing the same input set!
-    scan_time = str(int(time.time()))
-    scan_data_dir = os.path.join(scan.measurement_dir, '{}.running'.format(scan_time))
-    if not os.path.isdir(scan_data_dir):
-        os.makedirs(scan_data_dir)
+    if integrity == 'sampled' and not range_manifest:
+        raise click.UsageError("--integrity sampled requires --range-manifest.")
+    if workers > 1 and (output_dir or coordinator):
+        raise click.UsageError("--workers can't be used with --output-dir or --coordinator.")
+    if resume and (workers > 1 or output_dir or coordinator):
+        raise click.UsageError("--resume can't be used with --workers, --output-dir or "
+                               "--coordinator.")
+    if skip_failing and (workers > 1 or output_dir or coordinator):
+        raise click.UsageError("--skip-failing can't be used with --workers, --output-dir or "
+                               "--coordinator.")
+    exclude_relays = None
+    if resume:
+        scan_time, partitions, current_partition, exclude_relays = resume_scan(
+            scan, partitions, current_partition)
+    if workers > 1:
+        scan_args = ['--timeout', str(timeout), '--request-limit', str(request_limit),
+                     '--max-retries', str(max_retries),
+                     '--samples-per-circuit', str(samples_per_circuit),
+                     '--mirror-capacity', str(mirror_capacity),
+                     '--integrity', integrity, '--tor-instances', str(tor_instances)]
+        for baseurl in baseurls:
+            scan_args += ['--baseurl', baseurl]
+        if tor_bw_events:
+            scan_args.append('--tor-bw-events')
+        if range_manifest:
+            scan_args += ['--range-manifest', os.path.abspath(range_manifest)]
+        for control_port in control_ports:
+            scan_args += ['--control-port', str(control_port)]
+        return scan_with_workers(scan, workers, partitions, current_partition, scan_args,
+                                 metrics_port)
+
+    if range_manifest:
+        range_manifest = load_manifest(range_manifest)
+        log.info("Measuring with byte ranges of {name} from {count} blocks.",
+                 name=range_manifest.name, count=range_manifest.num_blocks)
+    if tor_instances > 1 and scan.launch_tor:
+        # Each instance has its own data directory next to the others,
+        # rather than inside the directory of the first one which Tor owns.
+        tor_state = connect_to_tor_instances(tor_instances, scan.launch_tor,
+                                             scan.circuit_build_timeout, TOR_OPTIONS,
+                                             scan.tor_dir)
+    elif tor_instances > 1:
+        try:
+            extra_states = connect_to_tor_instances(
+                tor_instances - 1, scan.launch_tor, scan.circuit_build_timeout,
+                TOR_OPTIONS, scan.tor_dir, control_ports, first_instance=1)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        tor_state = defer.gatherResults([scan.tor_state, extra_states], consumeErrors=True)
+        tor_state.addCallback(lambda states: [states[0]] + states[1])
+    else:
+        tor_state = scan.tor_state
+
+    mirrors = MirrorSet(baseurls, reactor, capacity=mirror_capacity)
+    if len(baseurls) > 1:
+        # Probe the mirrors directly while we connect to Tor
+        probe_path = range_manifest.name if range_manifest else BW_FILES[min(BW_FILES)][0]
+        probed = mirrors.probe(Agent(reactor, connectTimeout=30), probe_path)
+        tor_state = defer.gatherResults([tor_state, probed], consumeErrors=True)
+        tor_state.addCallback(lambda results: results[0])
+
+    scan_options = dict(baseurl=baseurls[0],
+                        mirrors=mirrors,
+                        bw_files=BW_FILES,
+                        range_manifest=range_manifest,
+                        integrity=integrity,
+                        request_timeout=timeout,
+                        request_limit=request_limit,
+                        max_retries=max_retries,
+                        samples_per_circuit=samples_per_circuit,
+                        spans=scan.spans,
+                        failure_history=load_failure_history(scan) if skip_failing else None,
+                        tor_bw_events=tor_bw_events)
+    failures = []
+
+    def scan_failed(failure):
+        log.failure("Scan failed", failure)
+        failures.append(failure)
+        reactor.stop()
+
+    def start_metrics(scanner):
+        if metrics_port is not None:
+            serve_metrics(reactor, scanner, metrics_port)
+        return scanner
+
+    if coordinator:
+        client = CoordinatorClient(reactor, coordinator, client_name,
+                                   token=coordinator_token)
+
+        def scan_leased_units(scanner):
+            def scan_unit(relays, result_sink):
+                scanner.relays = relays
+                scanner.result_sink = result_sink
+                return scanner.run_scan()
+            return run_client(client, reactor, scan_unit)
+
+        tor_state.addCallback(BwScan, reactor, scan.measurement_dir, **scan_options)
+        tor_state.addCallback(start_metrics)
+        tor_state.addCallback(scan_leased_units)
+        tor_state.addCallback(lambda _: reactor.stop())
+        tor_state.addErrback(scan_failed)
+        reactor.run()
+        if failures:
+            sys.exit(1)
+        return
+
+    if output_dir:
+        scan_data_dir = os.path.abspath(output_dir)
+    elif resume:
+        scan_data_dir = os.path.join(scan.measurement_dir, '{}.running'.format(scan_time))
+    else:
+        # XXX: check that each run is producing the same input set!
+        scan_time = str(int(time.time()))
+        scan_data_dir = os.path.join(scan.measurement_dir, '{}.running'.format(scan_time))
+        if not os.path.isdir(scan_data_dir):
+            os.makedirs(scan_data_dir)
+        write_scan_info(scan_data_dir, partitions=partitions,
+                        current_partition=current_partition)
 
     def rename_finished_scan(deferred):
         click.echo(deferred)
+        # Workers leave renaming the scan directory to the parent process
+        if not output_dir:
+            os.rename(scan_data_dir, os.path.join(scan.measurement_dir, scan_time))
+
+    def build_scan(tor_state):
+        # The relays are chosen from the first Tor instance, their table is
+        # stored with the scan for the aggregation.
+        first_state = tor_state[0] if isinstance(tor_state, list) else tor_state
+        d = build_relay_table(first_state.protocol)
+        d.addCallback(lambda relay_table: relay_table.save(
+            os.path.join(scan_data_dir, RELAYS_FILE)) or relay_table)
+        d.addCallback(lambda relay_table: BwScan(tor_state, reactor, scan_data_dir,
+                                                 partitions=partitions,
+                                                 this_partition=current_partition,
+                                                 exclude_relays=exclude_relays,
+                                                 relay_table=relay_table,
+                                                 **scan_options))
+        return d
+
+    tor_state.addCallback(build_scan)
+    tor_state.addCallback(start_metrics)
+    tor_state.addCallback(lambda scanner: scanner.run_scan())
+    tor_state.addCallback(lambda _: reactor.stop())
+    tor_state.addCallback(rename_finished_scan)
+    tor_state.addErrback(scan_failed)
+
+    reactor.run()
+    if failures:
+        sys.exit(1)
+
+
+def load_failure_history(scan):
+    """
+    Return the failure history of the relays measured from this data
+    directory, it is saved after each pass and when we stop.
+    """
+    from twisted.internet import reactor
+    from bwscanner.history import FailureHistory
+
+    history = FailureHistory(os.path.join(scan.data_dir, 'failure_history'), reactor)
+    reactor.addSystemEventTrigger('before', 'shutdown', history.save)
+    return history
+
+
+def resume_scan(scan, partitions, current_partition):
+    """
+    Find the latest interrupted scan and return its time, its partition and
+    the relays it already measured.
+
+    Scans started before the partition was recorded continue with the
+    `partitions` and `current_partition` options.
+    """
+    from bwscanner.workers import merge_worker_results
+    from bwscanner.writer import measured_relays, read_scan_info
+
+    running_scans = get_running_scans(scan.measurement_dir)
+    if not running_scans:
+        raise click.UsageError("There is no interrupted scan to resume in {}.".format(
+            scan.measurement_dir))
+    scan_time = running_scans[0].split('.')[0]
+    scan_data_dir = os.path.join(scan.measurement_dir, running_scans[0])
+
+    # The results of an interrupted scan with workers are still in the
+    # directory of each worker.
+    worker_dirs = [path for path in sorted(glob.glob(os.path.join(scan_data_dir, 'worker-*')))
+                   if os.path.isdir(path)]
+    merge_worker_results(scan_data_dir, worker_dirs)
+
+    scan_info = read_scan_info(scan_data_dir)
+    if scan_info is not None:
+        partitions = scan_info['partitions']
+        current_partition = scan_info['current_partition']
+    measured = measured_relays(scan_data_dir)
+    log.info("Resuming scan {scan_time} of partition {current}/{partitions}, {count} relays "
+             "were already measured.", scan_time=scan_time, current=current_partition,
+             partitions=partitions, count=len(measured))
+    return scan_time, partitions, current_partition, measured
+
+
+def scan_with_workers(scan, workers, partitions, current_partition, scan_args,
+                      metrics_port=None):
+    """
+    Measure partition `current_partition` of `partitions` with `workers`
+    child processes which each scan a share of it.
+
+    Every worker writes to its own directory inside the running scan
+    directory. Their files are merged into the scan directory once all of
+    them have exited, and it is only renamed to mark the scan as complete if
+    all of them succeeded.
+    """
+    from twisted.internet import reactor
+    from bwscanner.workers import (merge_worker_results, run_workers, worker_command,
+                                   worker_partition)
+    from bwscanner.writer import write_scan_info
+
+    scan_time = str(int(time.time()))
+    scan_data_dir = os.path.join(scan.measurement_dir, '{}.running'.format(scan_time))
+    log_name, log_ext = os.path.splitext(scan.logfile)
+    os.makedirs(scan_data_dir)
+    write_scan_info(scan_data_dir, partitions=partitions, current_partition=current_partition)
+
+    worker_dirs = []
+    commands = []
+    for worker in range(workers):
+        worker_name = 'worker-{}'.format(worker)
+        worker_dirs.append(os.path.join(scan_data_dir, worker_name))
+        os.makedirs(worker_dirs[-1])
+        global_args = ['--data-dir', scan.data_dir,
+                       '--loglevel', scan.loglevel,
+                       '--log-rate-limit', str(scan.log_rate_limit),
+                       '--logfile', '{}.{}{}'.format(log_name, worker_name, log_ext),
+                       '--circuit-build-timeout', str(scan.circuit_build_timeout),
+                       '--tor-dir', os.path.join(scan.tor_dir, worker_name)]
+        global_args.append('--launch-tor' if scan.launch_tor else '--no-launch-tor')
+        if scan.profile:
+            global_args.append('--profile')
+        if scan.trace_mem:
+            global_args.append('--trace-mem')
+        global_args += ['--reactor', scan.reactor_name]
+        worker_partitions, worker_current = worker_partition(partitions, current_partition,
+                                                             workers, worker)
+        worker_args = ['--partitions', str(worker_partitions),
+                       '--current-partition', str(worker_current)] + scan_args
+        if metrics_port is not None:
+            worker_args += ['--metrics-port', str(metrics_port + worker)]
+        commands.append(worker_command(global_args, worker_args, worker_dirs[-1]))
+
+    def workers_done(exit_codes):
+        merge_worker_results(scan_data_dir, worker_dirs)
+        failed = [worker for worker, code in enumerate(exit_codes) if code != 0]
+        if failed:
+            log.error("Workers {workers} failed, leaving the incomplete scan in {scan_dir}.",
+                      workers=failed, scan_dir=scan_data_dir)
+            return failed
         os.rename(scan_data_dir, os.path.join(scan.measurement_dir, scan_time))
+        log.info("All {count} workers finished scan {scan_time}.", count=workers,
+                 scan_time=scan_time)
+
+    failures = []
+    d = run_workers(reactor, commands)
+    d.addCallback(workers_done)
+    d.addErrback(lambda failure: log.failure("Unexpected error", failure))
+    d.addCallback(lambda failed: failures.extend(failed or []))
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    if failures:
+        sys.exit(1)
+
+
+@cli.command(short_help="Scan continuously and keep the bandwidth file up to date.")
+@click.option('--partitions', '-p', default=1,
+              help='Divide the set of relays into subsets. 1 by default.')
+@click.option('--current-partition', '-c', default=1,
+              help='Scan a particular subset / partition of the relays.')
+@click.option('--timeout', default=120,
+              help='Timeout for measurement HTTP requests (default: %ds).' % 120)
+@click.option('--request-limit', default=10,
+              help='Limit the number of simultaneous bandwidth measurements '
+              '(default: %d).' % 10)
+@click.option('--max-retries', default=2,
+              help='Retry failed measurements with a different exit up to this many '
+              'times at the end of each pass (default: %d).' % 2)
+@click.option('--baseurl', 'baseurls', multiple=True, default=[DEFAULT.get('baseurl')],
+              help='File server URL, repeat it to spread the downloads over several mirrors.')
+@click.option('--mirror-capacity', default=10,
+              help='Number of simultaneous downloads from each mirror before the next best '
+              'mirror is used (default: %d).' % 10)
+@click.option('--interval', default=3600,
+              help='Rewrite the bandwidth file every this many seconds (default: %d).' % 3600)
+@click.option('--window', default=5 * 86400,
+              help='Use the measurements from the last this many seconds in the bandwidth '
+              'file (default: %d, 5 days).' % (5 * 86400))
+@click.option('--bandwidth-file', type=click.Path(dir_okay=False), default=None,
+              help='Path of the bandwidth file (default: bandwidth_file in the data '
+              'directory).')
+@click.option('--metrics-port', type=int, default=None,
+              help='Serve live metrics of the scan in the Prometheus text format on this '
+              'local port.')
+@click.option('--skip-failing', is_flag=True, default=False,
+              help='Skip the relays which failed their last measurements, in this and '
+              'previous scans, for a time which doubles after each failure. They are '
+              'measured again once that time is over.')
+@click.option('--tor-bw-events', is_flag=True, default=False,
+              help='Also record the throughput of each measurement as counted by Tor, from '
+              'its CIRC_BW and STREAM_BW events, in tor_bws and tor_circ_bw.')
+@pass_scan
+def daemon(scan, partitions, current_partition, timeout, request_limit, max_retries, baseurls,
+           mirror_capacity, interval, window, bandwidth_file, metrics_port, skip_failing,
+           tor_bw_events):
+    """
+    Measure the relays in continuous passes over a single Tor connection.
+    The results of the last `--window` seconds are kept in memory and the
+    bandwidth file is rewritten from them every `--interval` seconds. The
+    results are also written to a <time>.daemon directory.
+    """
+    from twisted.internet import reactor
+    from bwscanner.daemon import BandwidthFileUpdater, RelayResults
+    from bwscanner.measurement import BwScan
+    from bwscanner.metrics import serve_metrics
+    from bwscanner.mirrors import MirrorSet
+    from bwscanner.relays import build_relay_table
+    from bwscanner.writer import ResultSink, write_scan_info
+
+    bandwidth_file = os.path.abspath(bandwidth_file or
+                                     os.path.join(scan.data_dir, 'bandwidth_file'))
+    scan_data_dir = os.path.join(scan.measurement_dir, '{}.daemon'.format(int(time.time())))
+    os.makedirs(scan_data_dir)
+    write_scan_info(scan_data_dir, partitions=partitions, current_partition=current_partition)
+    results = RelayResults(reactor, window, ResultSink(scan_data_dir))
+    failures = []
 
-    scan.tor_state.addCallback(BwScan, reactor, scan_data_dir,
-                               baseurl=baseurl,
-                               bw_files=BW_FILES,
-                               request_timeout=timeout,
-                               request_limit=request_limit,
-                               partitions=partitions,
-                               this_partition=current_partition)
-    scan.tor_state.addCallback(lambda scanner: scanner.run_scan())
-    scan.tor_state.addCallback(lambda _: reactor.stop())
-    scan.tor_state.addCallback(rename_finished_scan)
+    def start_daemon(tor_state, relay_table):
+        scanner = BwScan(tor_state, reactor, scan_data_dir,
+                         partitions=partitions,
+                         this_partition=current_partition,
+                         scan_continuous=True,
+                         result_sink=results,
+                         baseurl=baseurls[0],
+                         mirrors=MirrorSet(baseurls, reactor, capacity=mirror_capacity),
+                         bw_files=BW_FILES,
+                         request_timeout=timeout,
+                         request_limit=request_limit,
+                         max_retries=max_retries,
+                         spans=scan.spans,
+                         failure_history=load_failure_history(scan) if skip_failing else None,
+                         tor_bw_events=tor_bw_events,
+                         relay_table=relay_table)
+        if metrics_port is not None:
+            serve_metrics(reactor, scanner, metrics_port)
+        updater = BandwidthFileUpdater(results, tor_state, reactor, bandwidth_file, interval)
+        updater.start()
+        # Write the latest results when the daemon is stopped
+        reactor.addSystemEventTrigger('before', 'shutdown', updater.update)
+        log.info("Scanning continuously, writing the bandwidth file {file} every {interval}s.",
+                 file=bandwidth_file, interval=interval)
+        return scanner.run_scan()
 
+    def daemon_failed(failure):
+        log.failure("Daemon failed", failure)
+        failures.append(failure)
+        reactor.stop()
+
+    def build_daemon(tor_state):
+        d = build_relay_table(tor_state.protocol)
+        return d.addCallback(lambda relay_table: start_daemon(tor_state, relay_table))
+
+    scan.tor_state.addCallback(build_daemon)
+    scan.tor_state.addErrback(daemon_failed)
     reactor.run()
+    if failures:
+        sys.exit(1)
+
+
+@cli.command(name='coordinator', short_help="Lease relays to scanners on other hosts.")
+@click.option('--port', default=8080,
+              help='Port the coordinator listens on (default: %d).' % 8080)
+@click.option('--interface', default='127.0.0.1',
+              help='Address the coordinator listens on (default: 127.0.0.1).')
+@click.option('--token', default=None,
+              help='Only accept requests from scanners started with this '
+              '--coordinator-token. Required unless the coordinator listens on localhost.')
+@click.option('--unit-size', default=50,
+              help='Number of relays leased to a scanner at once (default: %d).' % 50)
+@click.option('--lease-timeout', default=1800,
+              help='Lease a unit to another scanner if no results were uploaded for it for '
+              'this many seconds (default: %ds).' % 1800)
+@pass_scan
+def run_coordinator(scan, port, interface, token, unit_size, lease_timeout):
+    """
+    Split the relays into work units and lease them to `bwscan scan
+    --coordinator URL` scanners. The uploaded results are written to a new
+    scan directory which is renamed once every unit is measured.
+    """
+    from twisted.internet import reactor, task
+    from twisted.web.server import Site
+    from bwscanner.coordinator import WorkCoordinator, coordinator_resource
+    from bwscanner.writer import ResultSink
+
+    if interface not in ('127.0.0.1', '::1', 'localhost') and not token:
+        raise click.UsageError("--token is required when the coordinator doesn't listen on "
+                               "localhost.")
+
+    scan_time = str(int(time.time()))
+    scan_data_dir = os.path.join(scan.measurement_dir, '{}.running'.format(scan_time))
+    os.makedirs(scan_data_dir)
+    result_sink = ResultSink(scan_data_dir)
+
+    def start_coordinator(tor_state):
+        relays = sorted(set(relay.id_hex for relay in tor_state.routers.values() if relay))
+        work = WorkCoordinator(relays, result_sink, reactor, unit_size=unit_size,
+                               lease_timeout=lease_timeout)
+        reactor.listenTCP(port, Site(coordinator_resource(work, token)), interface=interface)
+        log.info("Coordinating a scan of {count} relays in {units} units on port {port}.",
+                 count=len(relays), units=len(work.units), port=port)
+        work.finished.addCallback(lambda _: result_sink.end_flush())
+        work.finished.addCallback(rename_finished_scan)
+        # Keep answering lease requests for a while so waiting scanners
+        # learn that the scan is done.
+        work.finished.addCallback(lambda _: task.deferLater(reactor, work.retry_after,
+                                                            lambda: None))
+        return work.finished
+
+    def rename_finished_scan(_):
+        os.rename(scan_data_dir, os.path.join(scan.measurement_dir, scan_time))
+        log.info("All units of scan {scan_time} are measured.", scan_time=scan_time)
+
+    d = scan.tor_state.addCallback(start_coordinator)
+    d.addErrback(lambda failure: log.failure("Unexpected error", failure))
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+@cli.command(short_help="Create the block manifest of a file.")
+@click.option('--block-size', default=DEFAULT_BLOCK_SIZE,
+              help='Size of each hashed block in bytes (default: %d).' % DEFAULT_BLOCK_SIZE)
+@click.option('--name', default=None,
+              help='Path of the file relative to the file server URL (default: file name).')
+@click.argument('file_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('manifest_path', type=click.Path())
+def manifest(file_path, manifest_path, block_size, name):
+    """
+    Hash a large file hosted on the file servers so it can be used with
+    `scan --range-manifest`.
+    """
+    with open(file_path, 'rb') as data_file:
+        block_manifest = generate_manifest(name or os.path.basename(file_path),
+                                           data_file, block_size)
+    block_manifest.save(manifest_path)
+    click.echo("Wrote manifest with {} blocks to {}.".format(block_manifest.num_blocks,
+                                                             manifest_path))
+
+
+@cli.command(short_help="Simulate a scan without Tor.")
+@click.option('--relays', default=7000,
+              help='Number of simulated relays (default: %d).' % 7000)
+@click.option('--seed', default=0,
+              help='Seed of the simulated relays and failures (default: 0).')
+@click.option('--timeout', default=120,
+              help='Timeout for measurement HTTP requests (default: %ds).' % 120)
+@click.option('--request-limit', default=10,
+              help='Limit the number of simultaneous bandwidth measurements '
+              '(default: %d).' % 10)
+@click.option('--max-retries', default=2,
+              help='Retry failed measurements up to this many times (default: %d).' % 2)
+@click.option('--samples-per-circuit', default=1,
+              help='Take this many measurements over each circuit (default: %d).' % 1)
+@click.option('--circuit-launch-delay', default=0.2,
+              help='Seconds between the launch of two measurements (default: 0.2).')
+@click.option('--output', type=click.File('w'), default='-',
+              help='Write the JSON summary of the simulation to this file (default: stdout, the '
+              'log is then written to stderr).')
+def simulate(relays, seed, timeout, request_limit, max_retries, samples_per_circuit,
+             circuit_launch_delay, output):
+    """
+    Run a scan of simulated relays on a simulated clock to compare scan
+    options. It finishes in seconds and needs neither Tor nor a file server.
+    """
+    from bwscanner.simulation import run_simulation
+
+    summary = run_simulation(relays, seed=seed, request_timeout=timeout,
+                             request_limit=request_limit,
+                             max_retries=max_retries, samples_per_circuit=samples_per_circuit,
+                             circuit_launch_delay=circuit_launch_delay)
+    json.dump(summary, output, indent=4, sort_keys=True)
+    output.write('\n')
 
 
 def get_recent_scans(measurement_dir):
@@ -113,6 +746,15 @@ def get_recent_scans(measurement_dir):
                   reverse=True)
 
 
+def get_running_scans(measurement_dir):
+    """
+    Return the directories of the unfinished scans, latest first.
+    """
+    running = [name for name in os.listdir(measurement_dir)
+               if name.endswith('.running') and name.split('.')[0].isdigit()]
+    return sorted(running, key=lambda name: int(name.split('.')[0]), reverse=True)
+
+
 @cli.command(short_help="List available bandwidth measurement directories.")
 @pass_scan
 def list(scan):
@@ -128,15 +770,49 @@ def list(scan):
                  measurement_dir=scan.measurement_dir)
 
 
+@cli.command(short_help="Show the measurements of a relay.")
+@click.option('--since', type=int, default=None,
+              help='Only show the measurements which ended at or after this Unix time.')
+@click.argument('fingerprint')
+@pass_scan
+def show(scan, fingerprint, since):
+    """
+    Print the results of every scan with the relay FINGERPRINT in their
+    path, oldest scan first, as one JSON object per line. Only the results
+    of the relay are read, using the fingerprint index of each scan.
+    """
+    from bwscanner.writer import relay_results
+
+    relay = '$' + fingerprint.lstrip('$').upper()
+    scan_names = [name for name in os.listdir(scan.measurement_dir)
+                  if name.split('.')[0].isdigit()
+                  and os.path.isdir(os.path.join(scan.measurement_dir, name))]
+    count = 0
+    for name in sorted(scan_names, key=lambda name: int(name.split('.')[0])):
+        for result in relay_results(os.path.join(scan.measurement_dir, name), relay, since):
+            click.echo(json.dumps(result, sort_keys=True))
+            count += 1
+    if not count:
+        log.warn("No measurements of {relay} found in {measurement_dir}.", relay=relay,
+                 measurement_dir=scan.measurement_dir)
+
+
 @cli.command(short_help="Combine bandwidth measurements.")
 @click.option('-p', '--previous', type=int, default=1,
               help='The number of recent scans to include when aggregating.')
+@click.option('--quantiles', is_flag=True, default=False,
+              help='Add the median and 90th percentile of the measurements of each relay to '
+              'the bandwidth file (median_bw and p90_bw).')
 @click.argument('scan_name', required=False)
 @pass_scan
-def aggregate(scan, scan_name, previous):
+def aggregate(scan, scan_name, previous, quantiles):
     """
     Command to aggregate BW measurements and create the bandwidth file for the BWAuths
     """
+    from twisted.internet import reactor, task
+    from bwscanner.aggregate import write_aggregate_data
+    from bwscanner.relays import RELAYS_FILE
+
     # Aggregate the specified scan
     if scan_name:
         # Confirm that the specified scan directory exists
@@ -148,18 +824,24 @@ def aggregate(scan, scan_name, previous):
         log.info("Aggregating bandwidth measurements for scan {scan_name}.", scan_name=scan_name)
 
     else:
-        # Aggregate the n previous scan runs
-        try:
-            # Use the most recent completed scan by default
-            recent_scan_names = get_recent_scans(scan.measurement_dir)[:previous]
-        except IndexError:
+        # Aggregate the n previous scan runs, the most recent completed
+        # scan by default
+        recent_scan_names = get_recent_scans(scan.measurement_dir)[:previous]
+        if not recent_scan_names:
             log.warn("Could not find any completed scan data.")
             sys.exit(-1)
 
         scan_data_dirs = [os.path.join(scan.measurement_dir, name) for name in recent_scan_names]
         log.info("Aggregating data from past {count} scans.", count=len(scan_data_dirs))
 
-    scan.tor_state.addCallback(lambda tor_state: write_aggregate_data(tor_state, scan_data_dirs))
-    scan.tor_state.addErrback(lambda failure: log.failure("Unexpected error"))
-    scan.tor_state.addCallback(lambda _: reactor.stop())
+    def write_data(tor_state):
+        return write_aggregate_data(tor_state, scan_data_dirs, quantiles=quantiles)
+
+    if all(os.path.exists(os.path.join(scan_dir, RELAYS_FILE)) for scan_dir in scan_data_dirs):
+        # The relay bandwidths were stored with the scans, Tor isn't needed
+        d = task.deferLater(reactor, 0, write_data, None)
+    else:
+        d = scan.tor_state.addCallback(write_data)
+    d.addErrback(lambda failure: log.failure("Unexpected error"))
+    d.addCallback(lambda _: reactor.stop())
     reactor.run()
@@ -0,0 +1,350 @@
+"""
+Simulate a full scan without Tor or a file server.
+
+A SimulatedTorState provides synthetic relays whose circuits take a random
+time to build and sometimes fail, and whose web agents answer requests
+after a transfer time based on the capacity of the relays on the circuit.
+Everything is driven by a task.Clock, so a scan of a full consensus runs in
+seconds and can be used to compare scheduling policies and concurrency
+limits before deploying them.
+"""
+import base64
+import binascii
+import hashlib
+import math
+import random
+import resource
+import time
+
+from twisted.internet import defer, error, task
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from txtorcon.torcontrolprotocol import parse_keywords
+
+from bwscanner.fetcher import CircuitBuildFailed
+from bwscanner.logger import log
+from bwscanner.measurement import BwScan
+
+NS_ENTRY = ("r {nick} {identity} BBBBBBBBBBBBBBBBBBBBBBBBBBB "
+            "2018-01-01 00:00:00 127.0.0.1 5000 0\ns {flags}\nw Bandwidth={bw}")
+DESC_ENTRY = ("router {nick} 127.0.0.1 5000 0 0\nfingerprint {fingerprint}\n"
+              "bandwidth {bw} {bw} {bw}")
+
+SIMULATED_BASEURL = u'http://simulated/'
+# The simulated files have the same sizes as the real ones but the body
+# of the responses is only the name of the file.
+SIMULATED_BW_FILES = dict(
+    (size_kb, (name, hashlib.sha256(name).hexdigest()))
+    for size_kb, name in [(2 * 1024, '2M'), (4 * 1024, '4M'), (8 * 1024, '8M'),
+                          (16 * 1024, '16M'), (32 * 1024, '32M'), (64 * 1024, '64M')])
+
+
+class SimulatedRouter(object):
+    """
+    A relay with the Router attributes used by the scanner and the real
+    capacity the simulated transfers are limited by.
+    """
+    def __init__(self, index, bandwidth, capacity, flags, failure_rate):
+        """
+        bandwidth: the consensus bandwidth in KB/s
+        capacity: the real throughput of the relay in bytes/s
+        failure_rate: the probability that a circuit through the relay
+        fails to build
+        """
+        self.id_hex = '${:040X}'.format(index)
+        self.name = 'relay{}'.format(index)
+        self.bandwidth = bandwidth
+        self.capacity = capacity
+        self.flags = flags
+        self.failure_rate = failure_rate
+        # The number of simulated transfers through the relay
+        self.streams = 0
+
+    def __repr__(self):
+        return '<SimulatedRouter %s>' % self.name
+
+
+def ns_entry(relay_fp, nick, bw, flags=('fast', 'running', 'valid')):
+    """
+    Return the router status entry of a relay, `bw` is in KB/s.
+    """
+    identity = base64.b64encode(binascii.unhexlify(relay_fp[1:])).rstrip('=')
+    return NS_ENTRY.format(nick=nick, identity=identity, bw=bw,
+                           flags=' '.join(flag.capitalize() for flag in flags))
+
+
+def desc_entry(relay_fp, nick, bw):
+    """
+    Return the server descriptor of a relay, `bw` is in bytes/s.
+    """
+    fingerprint = ' '.join(relay_fp[i:i + 4] for i in range(1, 41, 4))
+    return DESC_ENTRY.format(nick=nick, fingerprint=fingerprint, bw=bw)
+
+
+class SimulatedTorProtocol(object):
+    """
+    Answer the control port requests BwScan makes from the simulated
+    relays.
+    """
+    def __init__(self, routers):
+        self.routers = routers
+        self.listeners = {}
+
+    def add_event_listener(self, event, callback):
+        self.listeners.setdefault(event, []).append(callback)
+
+    def remove_event_listener(self, event, callback):
+        self.listeners[event].remove(callback)
+
+    def event(self, event, data):
+        for callback in list(self.listeners.get(event, [])):
+            callback(data)
+
+    def get_conf(self, *keys):
+        return defer.succeed({'SocksPort': '9050'})
+
+    def entry(self, kind, relay):
+        if kind == 'ns':
+            return ns_entry(relay.id_hex, relay.name, relay.bandwidth, relay.flags)
+        return desc_entry(relay.id_hex, relay.name, relay.bandwidth * 1024)
+
+    def get_info(self, *keys):
+        lines = []
+        for key in keys:
+            kind, _, relay_fp = key.split('/', 2)
+            lines.append(key + '=')
+            lines.append(self.entry(kind, self.routers[relay_fp]))
+        return defer.succeed(parse_keywords('\n'.join(lines), key_hints=keys))
+
+    def get_info_raw(self, key):
+        """
+        Answer GETINFO ns/all and desc/all-recent.
+        """
+        kind = key.split('/', 1)[0]
+        entries = [self.entry(kind, relay) for _, relay in sorted(self.routers.items())]
+        return defer.succeed('\n'.join([key + '='] + entries + ['OK']))
+
+
+class SimulatedCircuit(object):
+    """
+    A circuit which is built, or closed, after a simulated build time.
+    """
+    def __init__(self, state, path, build_time, fails):
+        self.state = state
+        self.id = id(self)
+        self.path = path
+        self.built = defer.Deferred()
+        self.closed = defer.Deferred()
+        if fails:
+            state.clock.callLater(build_time, self.closed.callback, self)
+        else:
+            state.clock.callLater(build_time, self.built.callback, self)
+
+    def when_built(self):
+        return self.built
+
+    def when_closed(self):
+        return self.closed
+
+    def web_agent(self, reactor, socks_endpoint, pool=None):
+        return SimulatedAgent(self)
+
+
+class SimulatedAgent(object):
+    """
+    Answer each request with a response after the round trip time. The body
+    is delivered once it would have been transferred through the circuit.
+    """
+    def __init__(self, circuit):
+        self.circuit = circuit
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        state = self.circuit.state
+        rng = state.rng
+        name = uri.rsplit('/', 1)[-1]
+        if rng.random() < state.stream_failure_rate:
+            d = task.deferLater(state.clock, state.round_trip_time(), lambda: None)
+            return d.addCallback(lambda _: Failure(error.ConnectionRefusedError()))
+        response = SimulatedResponse(state, self.circuit, name)
+        return task.deferLater(state.clock, state.round_trip_time(), lambda: response)
+
+
+class SimulatedResponse(object):
+    """
+    A response which delivers its body after a transfer time limited by the
+    slowest relay on the path, sharing the capacity of each relay between
+    its simultaneous transfers.
+    """
+    code = 200
+    phrase = 'OK'
+
+    def __init__(self, state, circuit, name):
+        self.state = state
+        self.circuit = circuit
+        self.path = circuit.path
+        self.name = name
+        self.size = state.file_sizes.get(name, len(name))
+        self.protocol = None
+        self.call = None
+        self.bw_events = []
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self)
+        for relay in self.path:
+            relay.streams += 1
+        throughput = min(relay.capacity / float(relay.streams) for relay in self.path)
+        self.call = self.state.clock.callLater(self.size / throughput, self.finish,
+                                               Failure(ResponseDone()))
+        if 'CIRC_BW' in self.state.protocol.listeners:
+            self.send_bw_events(throughput)
+
+    def send_bw_events(self, throughput):
+        """
+        Send a CIRC_BW event at the end of each second of the transfer with
+        the bytes read in that second, like Tor does.
+        """
+        clock = self.state.clock
+        start = clock.seconds()
+        end = start + self.size / throughput
+        second = math.floor(start) + 1
+        while second - 1 < end:
+            read = int((min(second, end) - max(second - 1, start)) * throughput)
+            event = 'ID={} READ={} WRITTEN=0'.format(self.circuit.id, read)
+            self.bw_events.append(clock.callLater(second - start, self.state.protocol.event,
+                                                  'CIRC_BW', event))
+            second += 1
+
+    def finish(self, reason):
+        for relay in self.path:
+            relay.streams -= 1
+        if reason.check(ResponseDone):
+            self.protocol.dataReceived(self.name)
+        self.protocol.connectionLost(reason)
+
+    def abortConnection(self):
+        """
+        The transfer was aborted because the measurement timed out.
+        """
+        if self.call.active():
+            self.call.cancel()
+            for call in self.bw_events:
+                if call.active():
+                    call.cancel()
+            self.finish(Failure(defer.CancelledError()))
+
+    def stopProducing(self):
+        self.abortConnection()
+
+
+class SimulatedTorState(object):
+    """
+    A TorState with `num_relays` synthetic relays.
+
+    Consensus bandwidths follow a log-normal distribution and the real
+    capacity of each relay differs from its consensus bandwidth by a
+    log-normal error. Most relays rarely fail to build circuits but a few
+    are flaky.
+    """
+    def __init__(self, num_relays, clock, seed=0, exit_fraction=0.35, flaky_fraction=0.05,
+                 stream_failure_rate=0.01, build_time=0.5, round_trip_time=0.3):
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.stream_failure_rate = stream_failure_rate
+        self.mean_build_time = build_time
+        self.mean_round_trip_time = round_trip_time
+        self.file_sizes = dict((name, size_kb * 1024)
+                               for size_kb, (name, _) in SIMULATED_BW_FILES.items())
+
+        self.routers = {}
+        for i in range(num_relays):
+            bandwidth = max(int(self.rng.lognormvariate(8, 1.5)), 20)
+            capacity = bandwidth * 1024 * self.rng.lognormvariate(0, 0.5)
+            flags = ['fast', 'running', 'valid']
+            if self.rng.random() < exit_fraction:
+                flags.append('exit')
+            failure_rate = 0.5 if self.rng.random() < flaky_fraction else 0.02
+            relay = SimulatedRouter(i, bandwidth, capacity, flags, failure_rate)
+            self.routers[relay.id_hex] = relay
+        self.protocol = SimulatedTorProtocol(self.routers)
+
+    def random_time(self, mean):
+        return self.rng.lognormvariate(0, 0.5) * mean
+
+    def round_trip_time(self):
+        return self.random_time(self.mean_round_trip_time)
+
+    def build_circuit(self, path, using_guards=True):
+        # The path may be Relay records of a RelayTable
+        path = [self.routers[relay.id_hex] for relay in path]
+        if len(set(path)) != len(path):
+            return defer.fail(CircuitBuildFailed("Path contains the same relay twice."))
+        fails = any(self.rng.random() < relay.failure_rate for relay in path)
+        return defer.succeed(SimulatedCircuit(self, path, self.random_time(self.mean_build_time),
+                                              fails))
+
+
+class SimulationSink(object):
+    """
+    Result sink which keeps counts of the results instead of writing them.
+    """
+    def __init__(self, routers):
+        self.routers = routers
+        self.measurements = 0
+        self.failures = {}
+        # Ratio of the measured circuit bandwidth to the real capacity of
+        # the measured relay.
+        self.ratios = []
+
+    def send(self, result):
+        if 'failure' in result:
+            self.failures[result['failure_class']] = \
+                self.failures.get(result['failure_class'], 0) + 1
+        else:
+            self.measurements += 1
+            relay = self.routers[result['path'][0]]
+            self.ratios.append(result['circ_bw'] / relay.capacity)
+        return defer.succeed(None)
+
+    def end_flush(self):
+        return defer.succeed(None)
+
+
+def run_simulation(num_relays, seed=0, state_options=None, **scan_options):
+    """
+    Simulate one scan of `num_relays` relays and return a summary of it.
+
+    `scan_options` are passed on to BwScan and `state_options` to
+    SimulatedTorState.
+    """
+    clock = task.Clock()
+    # TwoHop picks the relays and exits with the random module
+    random.seed(seed)
+    state = SimulatedTorState(num_relays, clock, seed=seed, **(state_options or {}))
+    sink = SimulationSink(state.routers)
+    scan_options.setdefault('bw_files', SIMULATED_BW_FILES)
+    scan_options.setdefault('baseurl', SIMULATED_BASEURL)
+    scan = BwScan(state, clock, None, result_sink=sink, **scan_options)
+
+    wall_start = time.time()
+    done = scan.run_scan()
+    while not done.called:
+        calls = clock.getDelayedCalls()
+        if not calls:
+            raise RuntimeError("Simulated scan stalled with {} tasks left.".format(
+                len(scan.tasks)))
+        clock.advance(max(0, min(call.getTime() for call in calls) - clock.seconds()))
+
+    ratios = sorted(sink.ratios) or [0]
+    summary = {
+        'relays': num_relays,
+        'simulated_s': clock.seconds(),
+        'wall_s': time.time() - wall_start,
+        'measurements': sink.measurements,
+        'failures': sink.failures,
+        'median_bw_ratio': ratios[len(ratios) // 2],
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    log.info("Simulated a {hours:.1f}h scan of {relays} relays in {wall:.1f}s.",
+             hours=summary['simulated_s'] / 3600, relays=num_relays, wall=summary['wall_s'])
+    return summary
@@ -0,0 +1,120 @@
+"""
+Estimate the quantiles of a relay's measurements without keeping them.
+
+TDigest is the merging variant of Ted Dunning's t-digest: the samples are
+summarised by a sorted list of centroids (mean, weight) which are small
+near the extreme quantiles and large around the median. Its size is
+bounded by about `compression` centroids whatever the number of samples,
+and digests of separate scans can be merged and saved as JSON.
+"""
+from __future__ import division
+import math
+
+DEFAULT_COMPRESSION = 100
+
+
+class TDigest(object):
+    """
+    A mergeable summary of the distribution of the samples added to it.
+    """
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        # Sorted list of (mean, weight)
+        self.centroids = []
+        self.count = 0
+        self.min = None
+        self.max = None
+        # Samples and centroids not yet merged into `centroids`
+        self._buffer = []
+
+    def add(self, value, weight=1):
+        self._buffer.append((value, weight))
+        self.count += weight
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) >= 5 * self.compression:
+            self.compress()
+
+    def merge(self, other):
+        """
+        Add the samples summarised by `other` to this digest.
+        """
+        if not other.count:
+            return
+        other.compress()
+        self._buffer.extend(other.centroids)
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        if len(self._buffer) >= 5 * self.compression:
+            self.compress()
+
+    def _scale(self, q):
+        """
+        The k1 scale function: a centroid may grow while it covers less
+        than one unit of k, which is narrow near q = 0 and q = 1.
+        """
+        return self.compression / (2 * math.pi) * math.asin(2 * min(q, 1.0) - 1)
+
+    def compress(self):
+        if not self._buffer:
+            return
+        points = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        merged = [list(points[0])]
+        cumulative = 0
+        k_left = self._scale(0)
+        for mean, weight in points[1:]:
+            last = merged[-1]
+            q_right = (cumulative + last[1] + weight) / self.count
+            if self._scale(q_right) - k_left <= 1:
+                last[1] += weight
+                last[0] += (mean - last[0]) * weight / last[1]
+            else:
+                cumulative += last[1]
+                k_left = self._scale(cumulative / self.count)
+                merged.append([mean, weight])
+        self.centroids = [tuple(centroid) for centroid in merged]
+
+    def quantile(self, q):
+        """
+        Return the estimated value at quantile `q` (0 to 1), interpolated
+        between the centroid means, or None if there are no samples.
+        """
+        self.compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+
+        index = q * self.count
+        first_mean, first_weight = self.centroids[0]
+        if index < first_weight / 2:
+            return self.min + (first_mean - self.min) * index / (first_weight / 2)
+
+        cumulative = 0
+        for i, (mean, weight) in enumerate(self.centroids[:-1]):
+            next_mean, next_weight = self.centroids[i + 1]
+            center = cumulative + weight / 2
+            next_center = cumulative + weight + next_weight / 2
+            if index <= next_center:
+                return mean + (next_mean - mean) * (index - center) / (next_center - center)
+            cumulative += weight
+
+        last_mean, last_weight = self.centroids[-1]
+        remaining = self.count - index
+        return self.max - (self.max - last_mean) * remaining / (last_weight / 2)
+
+    def to_dict(self):
+        self.compress()
+        return {'compression': self.compression, 'min': self.min, 'max': self.max,
+                'centroids': [list(centroid) for centroid in self.centroids]}
+
+    @classmethod
+    def from_dict(cls, data):
+        digest = cls(data['compression'])
+        digest.centroids = [tuple(centroid) for centroid in data['centroids']]
+        digest.count = sum(weight for _, weight in digest.centroids)
+        digest.min = data['min']
+        digest.max = data['max']
+        return digest
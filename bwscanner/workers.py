@@ -0,0 +1,146 @@
+"""
+Run a scan in several local worker processes.
+
+Each worker is a separate `bwscan scan` process with its own reactor and
+Tor connection which measures one partition of the relays and writes its
+results to its own directory. The parent process waits for all of them and
+merges their results into a single scan directory.
+"""
+import os
+import signal
+import sys
+
+from twisted.internet import defer, error
+from twisted.internet.protocol import ProcessProtocol
+
+from bwscanner.logger import log
+from bwscanner.relays import RELAYS_FILE, RelayTable, load_relay_table
+from bwscanner.writer import INDEX_FILE
+
+
+def worker_partition(partitions, current_partition, workers, worker):
+    """
+    Return the (partitions, current_partition) arguments which make
+    `worker` (numbered from 0) measure its share of partition
+    `current_partition` of `partitions`.
+
+    TwoHop partitions take every `partitions`th relay, so splitting each of
+    them `workers` times gives `partitions * workers` disjoint partitions.
+    """
+    return partitions * workers, current_partition + partitions * worker
+
+
+def worker_command(global_args, scan_args, output_dir):
+    """
+    Return the argument list to run `bwscan` in a child process which
+    writes its measurements to `output_dir`.
+    """
+    return ([sys.executable, '-m', 'bwscanner'] + list(global_args) + ['scan'] +
+            list(scan_args) + ['--output-dir', output_dir])
+
+
+class WorkerProtocol(ProcessProtocol):
+    """
+    Fire `ended` with the exit code of the worker process.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        if reason.check(error.ProcessDone):
+            exit_code = 0
+        else:
+            exit_code = reason.value.exitCode
+            if exit_code is None:
+                # Killed by a signal
+                exit_code = -reason.value.signal
+        log.info("Worker {name} exited with code {code}.", name=self.name, code=exit_code)
+        self.ended.callback(exit_code)
+
+
+def run_workers(reactor, commands):
+    """
+    Spawn a process for each command and return a Deferred which fires with
+    the list of their exit codes once all of them have exited.
+
+    The workers share our stdout and stderr and are terminated if the reactor
+    is stopped before they exit.
+    """
+    processes = []
+    finished = []
+    for i, command in enumerate(commands):
+        protocol = WorkerProtocol(i)
+        processes.append(reactor.spawnProcess(protocol, command[0], command,
+                                              env=os.environ,
+                                              childFDs={0: 'w', 1: 1, 2: 2}))
+        finished.append(protocol.ended)
+        log.info("Started worker {name} with pid {pid}.", name=i, pid=processes[-1].pid)
+
+    def terminate_workers():
+        for process in processes:
+            if process.pid is not None:
+                try:
+                    process.signalProcess(signal.SIGTERM)
+                except error.ProcessExitedAlready:
+                    pass
+
+    trigger = reactor.addSystemEventTrigger('before', 'shutdown', terminate_workers)
+
+    def all_exited(exit_codes):
+        reactor.removeSystemEventTrigger(trigger)
+        return exit_codes
+
+    return defer.gatherResults(finished).addCallback(all_exited)
+
+
+def merge_worker_results(scan_data_dir, worker_dirs):
+    """
+    Move the measurement files written by each worker into the scan
+    directory, prefixed with the name of the worker directory so files
+    written at the same time by different workers don't collide.
+    """
+    for worker_dir in worker_dirs:
+        prefix = os.path.basename(worker_dir)
+        for name in sorted(os.listdir(worker_dir)):
+            if name == INDEX_FILE:
+                merge_index(scan_data_dir, worker_dir, prefix)
+                continue
+            if name == RELAYS_FILE:
+                merge_relay_table(scan_data_dir, worker_dir)
+                continue
+            os.rename(os.path.join(worker_dir, name),
+                      os.path.join(scan_data_dir, '{}-{}'.format(prefix, name)))
+        os.rmdir(worker_dir)
+
+
+def merge_relay_table(scan_data_dir, worker_dir):
+    """
+    Add the relays of the relay table of a worker to the table of the scan,
+    the workers may have started with different consensuses.
+    """
+    worker_relays = os.path.join(worker_dir, RELAYS_FILE)
+    relay_table = RelayTable.load(worker_relays)
+    scan_table = load_relay_table(scan_data_dir)
+    if scan_table is not None:
+        relay_table.routers.update(scan_table.routers)
+    relay_table.save(os.path.join(scan_data_dir, RELAYS_FILE))
+    os.remove(worker_relays)
+
+
+def merge_index(scan_data_dir, worker_dir, prefix):
+    """
+    Add the fingerprint index of a worker to the index of the scan, with the
+    file names prefixed like in merge_worker_results.
+    """
+    worker_index = os.path.join(worker_dir, INDEX_FILE)
+    with open(worker_index) as index_file:
+        entries = []
+        for line in index_file:
+            fields = line.split()
+            if line.endswith('\n') and len(fields) == 4:
+                fields[1] = '{}-{}'.format(prefix, fields[1])
+                entries.append(' '.join(fields) + '\n')
+    with open(os.path.join(scan_data_dir, INDEX_FILE), 'a') as index_file:
+        index_file.writelines(entries)
+    os.remove(worker_index)
@@ -1,10 +1,21 @@
 import datetime
+import glob
 import os.path
 import json
+import time
 
 from twisted.internet import threads, defer
+from twisted.python.failure import Failure
 
 from bwscanner.logger import log
+from bwscanner.profiling import SINK_WRITE
+
+# Metadata of a scan, written in its directory when it starts. The name has
+# no .json extension so it isn't read as a file of results.
+SCAN_INFO_FILE = 'scan_info'
+# Index of the results of each relay in the files of a scan, with a
+# "fingerprint file offset length" line for each relay of each result.
+INDEX_FILE = 'fingerprint_index'
 
 
 class ResultSink(object):
@@ -13,16 +24,20 @@ class ResultSink(object):
     via another thread so as to not block the reactor.
     """
 
-    def __init__(self, out_dir, chunk_size=1000):
+    def __init__(self, out_dir, chunk_size=1000, spans=None):
         """
         out_dir: the directory to json log files to
         chunk_size: the max amount of data to write per file
+        spans: a SpanRecorder the duration of each write is recorded in
         """
         self.out_dir = out_dir
         self.chunk_size = chunk_size
+        self.spans = spans
 
         self.buffer = []
         self.writing = False
+        # The number of results in chunks waiting to be written
+        self.pending = 0
         self.current_task = defer.succeed(None)
 
     def send(self, res):
@@ -33,43 +48,199 @@ class ResultSink(object):
         """
         self.buffer.append(res)
 
-        def write():
-            wf = open(log_path, "w")
-            try:
-                json.dump(chunk, wf, sort_keys=True)
-            finally:
-                wf.close()
+        def write(file_name, chunk):
+            start = time.time()
+            write_results(self.out_dir, file_name, chunk)
+            return time.time() - start
 
         # buffer is full, write to disk
         while len(self.buffer) >= self.chunk_size:
             chunk = self.buffer[:self.chunk_size]
             self.buffer = self.buffer[self.chunk_size:]
-            log_path = os.path.join(self.out_dir,
-                                    "%s-scan.json" % (datetime.datetime.utcnow().isoformat()))
+            file_name = "%s-scan.json" % (datetime.datetime.utcnow().isoformat())
 
-            self.current_task.addCallback(lambda ign: threads.deferToThread(write))
+            self.pending += len(chunk)
+            self.current_task.addCallback(lambda ign, file_name=file_name, chunk=chunk:
+                                          threads.deferToThread(write, file_name, chunk))
+            self.current_task.addBoth(self.written, len(chunk))
 
         # buffer is not full, return deferred for current batch
         return self.current_task
 
+    def written(self, result, count):
+        """
+        Called with the duration of a chunk write, or its failure.
+        """
+        self.pending -= count
+        if isinstance(result, Failure):
+            return result
+        if self.spans is not None:
+            self.spans.record(SINK_WRITE, result)
+
+    @property
+    def backlog(self):
+        """
+        The number of results which are not written to disk yet.
+        """
+        return len(self.buffer) + self.pending
+
     def end_flush(self):
         """
         Return the current deferred work chain.
         This last write is not performed in separate thread.
         """
         def flush():
-            log_path = os.path.join(self.out_dir,
-                                    "%s-scan.json" % (datetime.datetime.utcnow().isoformat()))
-            wf = open(log_path, "w")
-            try:
-                json.dump(self.buffer, wf, sort_keys=True)
-            finally:
-                wf.close()
+            file_name = "%s-scan.json" % (datetime.datetime.utcnow().isoformat())
+            log_path = os.path.join(self.out_dir, file_name)
+            write_results(self.out_dir, file_name, self.buffer)
             log.info("Finished writing measurement values to {log_path}.", log_path=log_path)
 
         def maybe_do_work(result):
             if len(self.buffer) != 0:
                 flush()
+                self.buffer = []
             return None
 
         return self.current_task.addCallback(maybe_do_work)
+
+
+def index_entries(file_name, result, offset, length):
+    return ['{} {} {} {}\n'.format(relay, file_name, offset, length)
+            for relay in result.get('path', ())]
+
+
+def write_results(out_dir, file_name, results):
+    """
+    Write `results` as a JSON list to `file_name` in `out_dir` and add them
+    to the fingerprint index of the directory.
+
+    The file is the same as with json.dump, but it is encoded a result at a
+    time to know where each one starts.
+    """
+    encoded, entries = [], []
+    offset = 1
+    for result in results:
+        data = json.dumps(result, sort_keys=True)
+        encoded.append(data)
+        entries.extend(index_entries(file_name, result, offset, len(data)))
+        offset += len(data) + 2
+    with open(os.path.join(out_dir, file_name), 'w') as results_file:
+        results_file.write('[' + ', '.join(encoded) + ']')
+    # Results are indexed once they are written, so a crash can lose
+    # entries but not index a missing result.
+    if entries:
+        with open(os.path.join(out_dir, INDEX_FILE), 'a') as index_file:
+            index_file.writelines(entries)
+
+
+def decode_results(data):
+    """
+    Yield each complete result in the JSON list `data` with its offset and
+    length, up to the first incomplete one.
+    """
+    decoder = json.JSONDecoder()
+    pos = data.find('[') + 1
+    while pos:
+        while data[pos:pos + 1] in (' ', ',', '\n'):
+            pos += 1
+        try:
+            result, end = decoder.raw_decode(data, pos)
+        except ValueError:
+            break
+        yield result, pos, end - pos
+        pos = end
+
+
+def read_results(path):
+    """
+    Return the results in a file written by ResultSink.
+
+    A file truncated by a crash during the write is read up to its last
+    complete result.
+    """
+    with open(path, 'r') as json_file:
+        data = json_file.read()
+    try:
+        return json.loads(data)
+    except ValueError:
+        pass
+
+    results = [result for result, _, _ in decode_results(data)]
+    log.warn("Recovered {count} results from the truncated file {path}.",
+             count=len(results), path=path)
+    return results
+
+
+def index_results(scan_dir):
+    """
+    Write the fingerprint index of a scan whose results were written
+    without one.
+    """
+    entries = []
+    for path in sorted(glob.glob(os.path.join(scan_dir, '*.json'))):
+        with open(path, 'r') as json_file:
+            data = json_file.read()
+        for result, offset, length in decode_results(data):
+            entries.extend(index_entries(os.path.basename(path), result, offset, length))
+    with open(os.path.join(scan_dir, INDEX_FILE), 'w') as index_file:
+        index_file.writelines(entries)
+
+
+def relay_results(scan_dir, relay, since=None):
+    """
+    Yield the results of the scan in `scan_dir` with `relay` in their path,
+    which ended at or after the time `since` if it is given. Only the
+    results listed in the fingerprint index are read.
+    """
+    index_path = os.path.join(scan_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        index_results(scan_dir)
+    elif since is not None and os.path.getmtime(index_path) < since:
+        # Nothing was written to the scan since then
+        return
+
+    locations = {}
+    with open(index_path, 'r') as index_file:
+        for line in index_file:
+            fields = line.split()
+            # The last line is incomplete if we crashed while writing it
+            if line.endswith('\n') and len(fields) == 4 and fields[0] == relay:
+                locations.setdefault(fields[1], []).append((int(fields[2]), int(fields[3])))
+
+    for file_name, file_locations in sorted(locations.items()):
+        with open(os.path.join(scan_dir, file_name), 'r') as json_file:
+            for offset, length in file_locations:
+                json_file.seek(offset)
+                result = json.loads(json_file.read(length))
+                if since is None or result.get('time_end', since) >= since:
+                    yield result
+
+
+def measured_relays(scan_dir):
+    """
+    Return the fingerprints of the relays with a successful measurement in
+    the result files of `scan_dir`.
+    """
+    relays = set()
+    for path in glob.glob(os.path.join(scan_dir, '*.json')):
+        for result in read_results(path):
+            if 'failure' not in result:
+                relays.add(result['path'][0])
+    return relays
+
+
+def write_scan_info(scan_dir, **info):
+    with open(os.path.join(scan_dir, SCAN_INFO_FILE), 'w') as info_file:
+        json.dump(info, info_file, sort_keys=True)
+
+
+def read_scan_info(scan_dir):
+    """
+    Return the metadata of the scan in `scan_dir`, or None for scans
+    started without it.
+    """
+    path = os.path.join(scan_dir, SCAN_INFO_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as info_file:
+        return json.load(info_file)
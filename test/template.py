@@ -1,12 +1,29 @@
+import fnmatch
+import json
 import os
 import random
 
 from twisted.internet import defer, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.trial import unittest
+from twisted.web.client import Agent
+from txtorcon.torcontrolprotocol import parse_keywords
 
 from bwscanner import circuit
 from bwscanner.attacher import connect_to_tor
 from bwscanner.config import TOR_OPTIONS
+from bwscanner.simulation import desc_entry, ns_entry
+
+
+def load_measurements(measurement_dir):
+    """
+    Return the measurements of all the result files in `measurement_dir`.
+    """
+    measurements = []
+    for filename in fnmatch.filter(os.listdir(measurement_dir), '*.json'):
+        with open(os.path.join(measurement_dir, filename), 'r') as result_file:
+            measurements.extend(json.load(result_file))
+    return measurements
 
 
 class TorTestCase(unittest.TestCase):
@@ -38,3 +55,126 @@ class TorTestCase(unittest.TestCase):
         yield self.tor_state.protocol.quit()
         # seems to leave dirty reactor otherwise?
         yield self.tor_state.protocol.transport.loseConnection()
+
+
+class FakeRouter(object):
+    def __init__(self, index, bandwidth=None, flags=()):
+        self.id_hex = '${:040X}'.format(index)
+        self.nickname = 'relay{}'.format(index)
+        self.bandwidth = index * 100 if bandwidth is None else bandwidth
+        self.flags = list(flags)
+
+    def __repr__(self):
+        return '<FakeRouter %s>' % self.nickname
+
+
+class FakeTorProtocol(object):
+    """
+    Answer GETINFO requests for the ns and desc of relays, the bandwidth of
+    relay n is n * 100.
+    """
+    def __init__(self):
+        self.listeners = {}
+        self.requests = []
+        self.conf_requests = []
+
+    def add_event_listener(self, event, callback):
+        self.listeners.setdefault(event, []).append(callback)
+
+    def remove_event_listener(self, event, callback):
+        self.listeners[event].remove(callback)
+
+    def event(self, event, data):
+        for callback in list(self.listeners.get(event, [])):
+            callback(data)
+
+    def get_conf(self, *keys):
+        self.conf_requests.append(keys)
+        return defer.succeed({'SocksPort': '9050'})
+
+    def get_info(self, *keys):
+        self.requests.append(keys)
+        lines = []
+        for key in keys:
+            kind, _, relay_fp = key.split('/', 2)
+            index = int(relay_fp[1:], 16)
+            entry = ns_entry if kind == 'ns' else desc_entry
+            lines.append(key + '=')
+            lines.append(entry(relay_fp, 'relay{}'.format(index), index * 100))
+        return defer.succeed(parse_keywords('\n'.join(lines), key_hints=keys))
+
+
+class DirectEndpoint(object):
+    """
+    Connect directly to the web server. Like txtorcon's TorSocksEndpoint,
+    the SOCKS endpoint is yielded again for each connection, so a Deferred
+    gives None after the first one.
+    """
+    def __init__(self, reactor, socks_endpoint, host, port):
+        self.reactor = reactor
+        self.socks_endpoint = socks_endpoint
+        self.host = host
+        self.port = port
+
+    @defer.inlineCallbacks
+    def connect(self, factory):
+        socks_endpoint = yield self.socks_endpoint
+        if socks_endpoint is None:
+            raise ValueError("The SOCKS endpoint was already consumed.")
+        proto = yield TCP4ClientEndpoint(self.reactor, self.host, self.port).connect(factory)
+        defer.returnValue(proto)
+
+
+class DirectEndpointFactory(object):
+
+    def __init__(self, reactor, socks_endpoint):
+        self.reactor = reactor
+        self.socks_endpoint = socks_endpoint
+
+    def endpointForURI(self, uri):
+        return DirectEndpoint(self.reactor, self.socks_endpoint, uri.host, uri.port)
+
+
+class FakeCircuit(object):
+    """
+    A built circuit whose web agent connects directly to the web server
+    instead of going through Tor.
+    """
+    def __init__(self, path):
+        self.id = id(self)
+        self.path = path
+
+    def when_built(self):
+        return defer.succeed(self)
+
+    def when_closed(self):
+        return defer.Deferred()
+
+    def web_agent(self, reactor, socks_endpoint, pool=None):
+        return Agent.usingEndpointFactory(
+            reactor, DirectEndpointFactory(reactor, socks_endpoint), pool=pool)
+
+
+class FakeTorState(object):
+    """
+    A TorState with `num_relays` relays where every third relay is an exit.
+    Building a circuit fails with `circuit_failure` unless it is set to None,
+    in which case it never completes, or `connect_directly` is set, in which
+    case a FakeCircuit is built.
+    """
+    def __init__(self, num_relays, circuit_failure=None, connect_directly=False):
+        relays = [FakeRouter(i, flags=['exit'] if i % 3 == 0 else [])
+                  for i in range(1, num_relays + 1)]
+        self.routers = dict((r.id_hex, r) for r in relays)
+        self.protocol = FakeTorProtocol()
+        self.circuit_failure = circuit_failure
+        self.connect_directly = connect_directly
+        self.built_paths = []
+
+    def build_circuit(self, path, using_guards=True):
+        self.built_paths.append(path)
+        if self.connect_directly:
+            return defer.succeed(FakeCircuit(path))
+        if self.circuit_failure is None:
+            return defer.Deferred()
+        return defer.fail(self.circuit_failure)
@@ -0,0 +1,140 @@
+import os
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import txtorcon
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from bwscanner import attacher
+
+
+CONSENSUS_HEADER = """network-status-version 3
+vote-status consensus
+consensus-method 28
+valid-after 2018-05-01 12:00:00
+fresh-until 2018-05-01 13:00:00
+valid-until {valid_until}
+voting-delay 300 300
+dir-source moria1 D586D18309DED4CD6D57C18FDB97EFA96D330566 128.31.0.34 128.31.0.34 9131 9101
+"""
+
+
+def write_consensus(data_dir, valid_until):
+    with open(os.path.join(data_dir, attacher.CONSENSUS_FILE), 'w') as consensus:
+        consensus.write(CONSENSUS_HEADER.format(
+            valid_until=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(valid_until))))
+
+
+class FakeProtocol(object):
+
+    def __init__(self):
+        self.listeners = {}
+
+    def add_event_listener(self, event, callback):
+        self.listeners.setdefault(event, []).append(callback)
+
+    def remove_event_listener(self, event, callback):
+        self.listeners[event].remove(callback)
+
+
+class FakeState(object):
+
+    def __init__(self):
+        self.protocol = FakeProtocol()
+
+
+class FakeConfig(object):
+
+    def __init__(self, data_dir):
+        self.DataDirectory = data_dir
+        self.UseMicroDescriptors = 1
+
+    def save(self):
+        return defer.succeed(None)
+
+
+class FakeTor(object):
+
+    def __init__(self, data_dir):
+        self.state = FakeState()
+        self.config = FakeConfig(data_dir)
+
+    def create_state(self):
+        return defer.succeed(self.state)
+
+    def get_config(self):
+        return defer.succeed(self.config)
+
+
+class TestCachedConsensus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.clock = task.Clock()
+        self.clock.advance(1525190400)
+        self.tor = FakeTor(self.tmpdir)
+        self.patch(txtorcon, 'connect', lambda reactor, endpoint: defer.succeed(self.tor))
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_valid_until(self):
+        assert attacher.cached_consensus_valid_until(self.tmpdir) is None
+        write_consensus(self.tmpdir, 1525190400)
+        assert attacher.cached_consensus_valid_until(self.tmpdir) == 1525190400
+
+    def test_valid_cached_consensus(self):
+        write_consensus(self.tmpdir, self.clock.seconds() + 3600)
+        d = attacher.connect_to_tor(False, 20, {'UseMicroDescriptors': 0}, reactor=self.clock)
+        assert self.successResultOf(d) is self.tor.state
+        assert self.tor.config.UseMicroDescriptors == 0
+
+    def test_expired_cached_consensus(self):
+        write_consensus(self.tmpdir, self.clock.seconds() - 60)
+        d = attacher.connect_to_tor(False, 20, {'UseMicroDescriptors': 0}, reactor=self.clock)
+        self.assertNoResult(d)
+        [got_newconsensus] = self.tor.state.protocol.listeners['NEWCONSENSUS']
+        got_newconsensus('consensus')
+        assert self.successResultOf(d) is self.tor.state
+
+    def test_launch(self):
+        launched = []
+
+        def launch(reactor, progress_updates=None, data_directory=None):
+            launched.append(data_directory)
+            return defer.succeed(self.tor)
+        self.patch(txtorcon, 'launch', launch)
+        write_consensus(self.tmpdir, self.clock.seconds() + 3600)
+        d = attacher.connect_to_tor(True, 20, {'UseMicroDescriptors': 0}, tor_dir=self.tmpdir,
+                                    reactor=self.clock)
+        assert self.successResultOf(d) is self.tor.state
+        assert launched == [self.tmpdir]
+        # The options are set once Tor runs, the cached consensus is used
+        assert self.tor.config.UseMicroDescriptors == 0
+
+    def test_launch_instances(self):
+        launched = []
+
+        def launch(reactor, progress_updates=None, data_directory=None):
+            launched.append(data_directory)
+            return defer.succeed(FakeTor(data_directory))
+        self.patch(txtorcon, 'launch', launch)
+        d = attacher.connect_to_tor_instances(2, True, 20, {}, self.tmpdir)
+        assert len(self.successResultOf(d)) == 2
+        assert launched == [os.path.join(self.tmpdir, 'instance-0'),
+                            os.path.join(self.tmpdir, 'instance-1')]
+
+
+class TestStartupTimings(unittest.TestCase):
+
+    def test_phases(self):
+        clock = task.Clock()
+        timings = attacher.StartupTimings(clock)
+        clock.advance(5)
+        timings.phase('launch')
+        clock.advance(1.25)
+        timings.phase('create_state')
+        assert timings.phases == [('launch', 5), ('create_state', 1.25)]
+        assert timings.summary() == 'launch 5.0s, create_state 1.2s'
@@ -0,0 +1,76 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from bwscanner.bwcache import BandwidthCache
+from test.template import FakeRouter, FakeTorProtocol
+
+
+class TestBandwidthCache(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = FakeTorProtocol()
+        self.cache = BandwidthCache(self.protocol)
+        self.relays = [FakeRouter(i) for i in range(1, 4)]
+
+    @defer.inlineCallbacks
+    def test_single_getinfo(self):
+        path_bws = yield self.cache.get(self.relays[:2])
+        assert len(self.protocol.requests) == 1
+        assert len(self.protocol.requests[0]) == 4
+        assert path_bws == [((100, 100, 100), (100, False)),
+                            ((200, 200, 200), (200, False))]
+
+    @defer.inlineCallbacks
+    def test_cached(self):
+        yield self.cache.get(self.relays[:2])
+        path_bws = yield self.cache.get(self.relays[1:])
+        # Only the relay which wasn't seen yet is requested
+        assert self.protocol.requests[1] == ('desc/id/' + self.relays[2].id_hex,
+                                             'ns/id/' + self.relays[2].id_hex)
+        assert path_bws[1] == ((300, 300, 300), (300, False))
+        yield self.cache.get(self.relays)
+        assert len(self.protocol.requests) == 2
+
+    @defer.inlineCallbacks
+    def test_new_consensus(self):
+        yield self.cache.get(self.relays)
+        self.protocol.event('NEWCONSENSUS', '')
+        yield self.cache.get(self.relays[:1])
+        assert len(self.protocol.requests) == 2
+        assert len(self.protocol.requests[1]) == 2
+
+    @defer.inlineCallbacks
+    def test_new_descriptor(self):
+        yield self.cache.get(self.relays)
+        self.protocol.event('NEWDESC', '{}~relay2'.format(self.relays[1].id_hex))
+        yield self.cache.get(self.relays)
+        assert self.protocol.requests[1] == ('desc/id/' + self.relays[1].id_hex,)
+
+    @defer.inlineCallbacks
+    def test_new_consensus_during_getinfo(self):
+        yield self.cache.get(self.relays[:1])
+        get_info = self.protocol.get_info
+
+        def get_info_then_new_consensus(*keys):
+            d = get_info(*keys)
+            self.protocol.event('NEWCONSENSUS', '')
+            return d
+        self.protocol.get_info = get_info_then_new_consensus
+        path_bws = yield self.cache.get(self.relays[:2])
+        assert path_bws == [((100, 100, 100), (100, False)),
+                            ((200, 200, 200), (200, False))]
+        # The reply may be from the previous consensus, it isn't cached
+        assert self.cache.desc_bws == {} and self.cache.ns_bws == {}
+
+    @defer.inlineCallbacks
+    def test_new_descriptor_during_getinfo(self):
+        get_info = self.protocol.get_info
+
+        def get_info_then_new_descriptor(*keys):
+            d = get_info(*keys)
+            self.protocol.event('NEWDESC', '{}~relay2'.format(self.relays[1].id_hex))
+            return d
+        self.protocol.get_info = get_info_then_new_descriptor
+        yield self.cache.get(self.relays[:2])
+        assert sorted(self.cache.desc_bws) == [self.relays[0].id_hex]
+        assert len(self.cache.ns_bws) == 2
@@ -0,0 +1,110 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from bwscanner.bwevents import BandwidthEvents, tor_throughput
+from bwscanner.measurement import BwScan
+from bwscanner.simulation import SIMULATED_BASEURL, SIMULATED_BW_FILES, SimulatedTorState
+
+
+class ReplayProtocol(object):
+    """
+    A control protocol which replays a sequence of (event, data) to its
+    listeners.
+    """
+    def __init__(self):
+        self.listeners = {}
+
+    def add_event_listener(self, event, callback):
+        self.listeners.setdefault(event, []).append(callback)
+
+    def remove_event_listener(self, event, callback):
+        self.listeners[event].remove(callback)
+
+    def replay(self, events):
+        for event, data in events:
+            for callback in list(self.listeners.get(event, [])):
+                callback(data)
+
+
+class ResultList(object):
+
+    def __init__(self):
+        self.results = []
+
+    def send(self, result):
+        self.results.append(result)
+        return defer.succeed(None)
+
+    def end_flush(self):
+        return defer.succeed(None)
+
+
+class TestBandwidthEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = ReplayProtocol()
+        self.events = BandwidthEvents(self.protocol)
+
+    def test_circ_bw(self):
+        self.protocol.replay([('CIRC_BW', 'ID=5 READ=100 WRITTEN=10')])
+        self.events.watch(5)
+        self.protocol.replay([
+            ('CIRC_BW', 'ID=5 READ=500 WRITTEN=10 TIME=2018-05-01T12:00:01.000000'),
+            ('CIRC_BW', 'ID=6 READ=900 WRITTEN=10'),
+            ('CIRC_BW', 'ID=5 READ=1000 WRITTEN=0'),
+            ('CIRC_BW', 'ID=5 READ=1200 WRITTEN=0'),
+            ('CIRC_BW', 'ID=5 READ=300 WRITTEN=0'),
+        ])
+        reads = self.events.collect(5)
+        assert reads == [500, 1000, 1200, 300]
+        assert tor_throughput(reads) == 1100
+        # The circuit isn't watched anymore
+        self.protocol.replay([('CIRC_BW', 'ID=5 READ=100 WRITTEN=10')])
+        assert self.events.collect(5) == []
+
+    def test_stream_bw_without_circ_bw(self):
+        self.events.watch('7')
+        self.protocol.replay([
+            ('STREAM', '12 NEW 0 127.0.0.1:80 SOURCE_ADDR=127.0.0.1:5000 PURPOSE=USER'),
+            ('STREAM', '12 SENTCONNECT 7 127.0.0.1:80'),
+            ('STREAM', '13 SENTCONNECT 8 127.0.0.1:80'),
+            ('STREAM_BW', '12 40 2000'),
+            ('STREAM_BW', '13 40 9000'),
+            ('STREAM_BW', '12 0 3000'),
+            ('STREAM', '12 CLOSED 7 127.0.0.1:80 REASON=DONE'),
+            ('STREAM_BW', '12 0 100'),
+        ])
+        assert self.events.stream_circuits == {}
+        assert self.events.collect('7') == [2000, 3000]
+
+    def test_throughput(self):
+        assert tor_throughput([]) is None
+        assert tor_throughput([100, 300]) == 200
+        assert tor_throughput([10, 1000, 2000, 20]) == 1500
+
+    def test_stop(self):
+        self.events.stop()
+        assert all(not listeners for listeners in self.protocol.listeners.values())
+
+
+class TestSimulatedBandwidthEvents(unittest.TestCase):
+
+    def test_scan(self):
+        clock = task.Clock()
+        state = SimulatedTorState(30, clock, seed=6, flaky_fraction=0, stream_failure_rate=0)
+        sink = ResultList()
+        scan = BwScan(state, clock, None, result_sink=sink, bw_files=SIMULATED_BW_FILES,
+                      baseurl=SIMULATED_BASEURL, tor_bw_events=True)
+        done = scan.run_scan()
+        while not done.called:
+            clock.advance(0.5)
+
+        measurements = [r for r in sink.results if 'failure' not in r]
+        assert measurements
+        assert all(result['tor_bws'] for result in measurements)
+        long_transfers = [r for r in measurements if len(r['tor_bws']) > 2]
+        assert long_transfers
+        for result in long_transfers:
+            # Tor only counts the transfer, not the circuit build and request
+            assert result['tor_circ_bw'] >= result['circ_bw']
+        assert scan.bw_events[0].circ_reads == {}
@@ -1,6 +1,7 @@
+from twisted.trial import unittest
 
 from bwscanner.circuit import TwoHop
-from test.template import TorTestCase
+from test.template import FakeTorState, TorTestCase
 
 
 class TestCircuitGenerators(TorTestCase):
@@ -16,3 +17,26 @@ class TestCircuitGenerators(TorTestCase):
             seen.add(circuit[0])
         assert seen == all_r
         assert num_circuits == len(all_r)
+
+
+class TestTwoHopSubsets(unittest.TestCase):
+
+    def test_exclude(self):
+        tor_state = FakeTorState(40)
+        partition = set(relay for relay, _ in TwoHop(tor_state, partitions=2, this_partition=2))
+        measured = set(relay.id_hex for relay in list(partition)[:5])
+        circuits = TwoHop(tor_state, partitions=2, this_partition=2, exclude=measured)
+        assert circuits.num_circuits == len(partition) - 5
+        remaining = set(relay for relay, _ in circuits)
+        assert remaining == set(relay for relay in partition if relay.id_hex not in measured)
+
+
+class TestExitByBandwidth(unittest.TestCase):
+
+    def test_relay_faster_than_all_exits(self):
+        # Relay 31 is not an exit and is faster than every exit
+        tor_state = FakeTorState(31)
+        circuits = TwoHop(tor_state, slice_width=5)
+        relay = tor_state.routers['${:040X}'.format(31)]
+        exit_relay = circuits.exit_by_bw(relay)
+        assert exit_relay in circuits.exits[-5:]
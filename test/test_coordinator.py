@@ -0,0 +1,176 @@
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web.server import Site
+
+from bwscanner.coordinator import (CoordinatorClient, CoordinatorError, ScanFinished,
+                                   UploadSink, WorkCoordinator, coordinator_resource,
+                                   run_client)
+
+RELAYS = ['{:040X}'.format(i) for i in range(10)]
+
+
+class ListSink(object):
+    def __init__(self):
+        self.results = []
+
+    def send(self, res):
+        self.results.append(res)
+        return defer.succeed(None)
+
+    def end_flush(self):
+        return defer.succeed(None)
+
+
+class TestWorkCoordinator(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sink = ListSink()
+        self.work = WorkCoordinator(RELAYS, self.sink, self.clock, unit_size=4,
+                                    lease_timeout=100)
+
+    def test_units(self):
+        assert [len(unit) for unit in self.work.units] == [4, 4, 2]
+        leases = [self.work.lease('client-{}'.format(i)) for i in range(3)]
+        assert sum([lease['relays'] for lease in leases], []) == RELAYS
+        assert self.work.lease('client-3') == {'unit': None, 'retry_after': 30}
+
+    def test_lease_expires(self):
+        first = self.work.lease('slow')
+        self.clock.advance(60)
+        # Uploading a batch renews the lease
+        self.work.submit('slow', first['unit'], [{'path': []}])
+        self.work.lease('other')
+        self.work.lease('other')
+        self.clock.advance(60)
+        assert self.work.lease('other')['unit'] is None
+
+        self.clock.advance(60)
+        assert self.work.lease('other')['unit'] == first['unit']
+        assert self.sink.results == [{'path': []}]
+
+    def test_finished(self):
+        leases = [self.work.lease('client') for _ in range(3)]
+        for lease in leases:
+            assert not self.work.finished.called
+            self.work.submit('client', lease['unit'], [], final=True)
+        assert self.work.finished.called
+        assert self.work.lease('client') == {'unit': None, 'done': True}
+        self.assertRaises(ScanFinished, self.work.submit, 'client', 0, [{'path': []}])
+        assert self.sink.results == []
+
+    def test_malformed_results(self):
+        lease = self.work.lease('client')
+        for results in [{'path': []}, [None], [{'path': 'AB'}], [{'path': []}, {}]]:
+            self.assertRaises(ValueError, self.work.submit, 'client', lease['unit'], results)
+        assert self.sink.results == []
+
+    def test_late_results(self):
+        lease = self.work.lease('dead')
+        self.clock.advance(200)
+        retry = self.work.lease('other')
+        assert retry['unit'] == lease['unit']
+        self.work.submit('other', retry['unit'], [{'path': []}], final=True)
+        # The results of the expired lease are kept but the unit stays done
+        self.work.submit('dead', lease['unit'], [{'path': []}], final=True)
+        assert len(self.sink.results) == 2
+        assert self.work.status() == {'pending': 2, 'leased': 0, 'done': 1, 'units': 3}
+
+
+class FlakyClient(object):
+    """
+    Fail the first `failures` uploads.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        self.uploads = []
+
+    def submit(self, unit, results, final=False):
+        if self.failures:
+            self.failures -= 1
+            return defer.fail(CoordinatorError("Coordinator replied 503 to results"))
+        self.uploads.append((results, final))
+        return defer.succeed({'accepted': len(results)})
+
+
+class TestUploadSink(unittest.TestCase):
+
+    def test_final_upload_retried(self):
+        clock = task.Clock()
+        client = FlakyClient(failures=2)
+        sink = UploadSink(client, 0, clock, final_retries=3, retry_delay=10)
+        sink.send({'path': []})
+        d = sink.end_flush()
+        self.assertNoResult(d)
+        clock.advance(10)
+        self.assertNoResult(d)
+        clock.advance(20)
+        self.successResultOf(d)
+        assert sink.finished
+        assert client.uploads == [([{'path': []}], True)]
+
+    def test_final_upload_gives_up(self):
+        clock = task.Clock()
+        client = FlakyClient(failures=10)
+        sink = UploadSink(client, 0, clock, final_retries=2, retry_delay=10)
+        d = sink.end_flush()
+        clock.pump([10, 20])
+        self.successResultOf(d)
+        assert not sink.finished
+        assert client.failures == 7
+
+
+class TestCoordinatorService(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = ListSink()
+        self.work = WorkCoordinator(RELAYS, self.sink, reactor, unit_size=3, retry_after=0)
+        self.port = reactor.listenTCP(0, Site(coordinator_resource(self.work, 'secret')),
+                                      interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:{}/'.format(self.port.getHost().port)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_scan_units(self):
+        scanned = []
+
+        def scan_unit(relays, result_sink):
+            scanned.extend(relays)
+            for relay in relays * 4:
+                result_sink.send({'path': [relay]})
+            return result_sink.end_flush()
+
+        clients = [CoordinatorClient(reactor, self.url, 'client-{}'.format(i),
+                                     token='secret') for i in range(2)]
+        units = yield defer.gatherResults([run_client(client, reactor, scan_unit)
+                                           for client in clients])
+        assert sum(units) == 4
+        assert sorted(scanned) == RELAYS
+        assert len(self.sink.results) == len(RELAYS) * 4
+        assert self.work.finished.called
+
+    @defer.inlineCallbacks
+    def test_unknown_unit(self):
+        client = CoordinatorClient(reactor, self.url, 'client', token='secret')
+        yield self.assertFailure(client.submit(10, []), CoordinatorError)
+
+    @defer.inlineCallbacks
+    def test_malformed_results(self):
+        client = CoordinatorClient(reactor, self.url, 'client', token='secret')
+        lease = yield client.lease()
+        error = yield self.assertFailure(client.submit(lease['unit'], [{'relay': 'A'}]),
+                                         CoordinatorError)
+        assert 'replied 400' in str(error)
+        # The scanner can still upload valid results for the unit
+        yield client.submit(lease['unit'], [{'path': ['A']}])
+        assert self.sink.results == [{'path': ['A']}]
+
+    @defer.inlineCallbacks
+    def test_token(self):
+        for token in [None, 'wrong']:
+            client = CoordinatorClient(reactor, self.url, 'client', token=token)
+            error = yield self.assertFailure(client.lease(), CoordinatorError)
+            assert 'replied 403' in str(error)
+        assert self.work.status()['leased'] == 0
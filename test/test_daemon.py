@@ -0,0 +1,106 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from bwscanner.aggregate import aggregate_lines
+from bwscanner.daemon import BandwidthFileUpdater, RelayResults
+from bwscanner.measurement import BwScan
+from bwscanner.simulation import SIMULATED_BASEURL, SIMULATED_BW_FILES, SimulatedTorState
+
+
+def result(relay, exit_relay, time_end, circ_bw=None):
+    result = {'time_start': time_end - 10, 'time_end': time_end, 'path': [relay, exit_relay]}
+    if circ_bw is None:
+        result['failure'] = 'timeout'
+    else:
+        result['circ_bw'] = circ_bw
+        result['path_desc_bws'] = [[1000, 2000, 1500], [3000, 4000, 3500]]
+        result['path_ns_bws'] = [[900, False], [2900, False]]
+    return result
+
+
+class TestAggregateLines(unittest.TestCase):
+
+    def test_lines(self):
+        measurements = {'$A': [100, 200, 300], '$B': [50], '$C': [0]}
+        failures = {'$A': [{}], '$D': [{}], '$E': [{}], '$F': [{}]}
+        relay_info = {'$A': ('a', 1000, 900), '$C': ('c', 10, 10)}
+        # $B isn't in the consensus and $C has no valid filtered bandwidth
+        assert aggregate_lines(measurements, failures, relay_info) == [
+            "node_id=$A nick=a strm_bw=200 filt_bw=250 circ_fail_rate=0.25 desc_bw=1000 "
+            "ns_bw=900\n"]
+
+
+class TestRelayResults(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.results = RelayResults(self.clock, window=100)
+
+    def test_measurement_data(self):
+        self.results.send(result('$A', '$X', 10, 500))
+        self.results.send(result('$A', '$Y', 20))
+        measurements, failures = self.results.measurement_data()
+        assert measurements == {'$A': [500], '$X': [500]}
+        assert len(failures['$A']) == 1 and len(failures['$Y']) == 1
+        assert self.results.oldest_time() == 0
+
+    def test_expire(self):
+        self.results.send(result('$A', '$X', 10, 500))
+        self.clock.advance(60)
+        self.results.send(result('$A', '$Y', 70, 600))
+        self.clock.advance(60)
+        self.results.expire()
+        measurements, _ = self.results.measurement_data()
+        assert measurements == {'$A': [600], '$Y': [600]}
+
+    def test_relay_info(self):
+        class Router(object):
+            def __init__(self, name):
+                self.name = name
+        self.results.send(result('$A', '$X', 10, 500))
+        self.results.send(result('$A', '$Y', 20))
+        # $X left the consensus
+        relay_info = self.results.relay_info({'$A': Router('a'), '$Y': Router('y')})
+        assert relay_info == {'$A': ('a', 1000, 900)}
+
+
+class TestBandwidthFileUpdater(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.file_name = os.path.join(self.tmpdir, 'bandwidth_file')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def read_relays(self):
+        with open(self.file_name) as bw_file:
+            lines = bw_file.read().splitlines()
+        assert lines[0] == '0'
+        return [line.split()[0][len('node_id='):] for line in lines[2:]]
+
+    def test_continuous_scan(self):
+        clock = task.Clock()
+        state = SimulatedTorState(50, clock, seed=4, flaky_fraction=0)
+        results = RelayResults(clock, window=3600)
+        scan = BwScan(state, clock, None, result_sink=results, scan_continuous=True,
+                      bw_files=SIMULATED_BW_FILES, baseurl=SIMULATED_BASEURL)
+        updater = BandwidthFileUpdater(results, state, clock, self.file_name, interval=600)
+        updater.start()
+        scan.run_scan()
+        clock.pump([1] * 599)
+        assert not os.path.exists(self.file_name)
+
+        clock.pump([1] * 1800)
+        assert scan.passes >= 2
+        relays = self.read_relays()
+        assert len(relays) > 40
+        assert set(relays) <= set(state.routers)
+        assert not os.path.exists(self.file_name + '.tmp')
+
+        scan.scan_continuous = False
+        updater.stop()
@@ -0,0 +1,93 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from bwscanner.history import FailureHistory
+from bwscanner.measurement import BwScan
+from bwscanner.simulation import (SIMULATED_BASEURL, SIMULATED_BW_FILES, SimulatedTorState,
+                                  SimulationSink)
+
+
+class TestFailureHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'failure_history')
+        self.clock = task.Clock()
+        self.history = FailureHistory(self.path, self.clock, threshold=2, ttl=100, max_ttl=300)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_backoff(self):
+        self.history.failed('$A', 10)
+        assert self.history.skipped_relays() == set()
+        self.history.failed('$A', 30)
+        assert self.history.skipped_relays() == set(['$A'])
+        assert self.history.expected_cost(['$A', '$B']) == 20
+        self.clock.advance(100)
+        assert self.history.skipped_relays() == set()
+
+        # The probe failed, the TTL doubles up to max_ttl
+        for ttl in [200, 300]:
+            self.history.failed('$A', 10)
+            self.clock.advance(ttl - 1)
+            assert self.history.skipped_relays() == set(['$A'])
+            self.clock.advance(1)
+            assert self.history.skipped_relays() == set()
+
+        self.history.succeeded('$A')
+        self.history.failed('$A', 10)
+        assert self.history.skipped_relays() == set()
+
+    def test_save(self):
+        self.history.failed('$A', 10)
+        self.history.failed('$A', 10)
+        self.history.save()
+        history = FailureHistory(self.path, self.clock)
+        assert history.skipped_relays() == set(['$A'])
+
+    def test_prune(self):
+        for relay in ['$A', '$B', '$C']:
+            self.history.failed(relay, 10)
+        self.history.prune({'$B': None, '$D': None})
+        assert sorted(self.history.relays) == ['$B']
+
+    def test_save_without_path(self):
+        history = FailureHistory(None, self.clock)
+        history.failed('$A', 10)
+        history.save()
+        assert os.listdir(self.tmpdir) == []
+
+
+class TestSkipFailingRelays(unittest.TestCase):
+
+    def run_scan(self, state, history):
+        scan = BwScan(state, state.clock, None, result_sink=SimulationSink(state.routers),
+                      bw_files=SIMULATED_BW_FILES, baseurl=SIMULATED_BASEURL,
+                      failure_history=history, max_retries=2)
+        done = scan.run_scan()
+        while not done.called:
+            state.clock.advance(1)
+        return scan
+
+    def test_dead_relays_are_skipped(self):
+        clock = task.Clock()
+        state = SimulatedTorState(50, clock, seed=3, flaky_fraction=0, stream_failure_rate=0)
+        dead = set(sorted(state.routers)[:3])
+        for relay in dead:
+            state.routers[relay].failure_rate = 1
+        history = FailureHistory(None, clock, threshold=3, ttl=10 ** 6)
+        self.patch(history, 'save', lambda: None)
+
+        scan = self.run_scan(state, history)
+        assert scan.circuits.skipped == []
+        # Every attempt of the first pass failed
+        assert history.skipped_relays() >= dead
+
+        scan = self.run_scan(state, history)
+        assert set(scan.circuits.skipped) >= dead
+        assert scan.circuits.num_circuits == 50 - len(scan.circuits.skipped)
@@ -0,0 +1,85 @@
+import threading
+import time
+
+from twisted.logger import LogLevel, PredicateResult
+from twisted.trial import unittest
+
+from bwscanner.logger import QueuedLogObserver, RelayRateLimitPredicate, log_event_format
+
+
+def event(log_time, **fields):
+    logged = {'log_format': "Download failed for router {fingerprint}.",
+              'log_level': LogLevel.warn, 'log_time': log_time}
+    logged.update(fields)
+    return logged
+
+
+class BlockedObserver(object):
+    """
+    Collect the events once `unblocked` is set.
+    """
+    def __init__(self):
+        self.unblocked = threading.Event()
+        self.events = []
+
+    def __call__(self, event):
+        self.unblocked.wait()
+        self.events.append(event)
+
+
+class TestQueuedLogObserver(unittest.TestCase):
+
+    def test_write_and_stop(self):
+        events = []
+        observer = QueuedLogObserver([events.append])
+        for i in range(100):
+            observer(event(i, fingerprint='$A'))
+        observer.stop()
+        assert [e['log_time'] for e in events] == range(100)
+        assert not observer.thread.is_alive()
+
+    def test_drop_when_full(self):
+        blocked = BlockedObserver()
+        observer = QueuedLogObserver([blocked], max_queued=2)
+        observer(event(0))
+        # Wait for the writer to take the first event, it is then blocked
+        while not observer.queue.empty():
+            time.sleep(0.001)
+        for i in range(1, 6):
+            observer(event(i))
+        assert observer.dropped == 3
+        blocked.unblocked.set()
+        observer.stop()
+        assert [e['log_time'] for e in blocked.events if 'count' not in e] == [0, 1, 2]
+        [dropped] = [e for e in blocked.events if 'count' in e]
+        assert dropped['count'] == 3
+        assert 'Dropped 3 log messages' in log_event_format(dropped)
+
+
+class TestRelayRateLimit(unittest.TestCase):
+
+    def test_rate_limit(self):
+        predicate = RelayRateLimitPredicate(rate=1, burst=2)
+        events = [event(t, fingerprint='$A') for t in [0, 0, 0, 0.5, 1]]
+        assert [predicate(e) for e in events] == [
+            PredicateResult.maybe, PredicateResult.maybe, PredicateResult.no, PredicateResult.no,
+            PredicateResult.maybe]
+
+        # The next message says how many were suppressed
+        assert events[-1]['log_suppressed'] == 2
+        assert log_event_format(events[-1]).endswith(
+            "Download failed for router $A. (2 similar messages were suppressed)\n")
+
+    def test_other_messages_pass(self):
+        predicate = RelayRateLimitPredicate(rate=1, burst=1)
+        predicate(event(0, fingerprint='$A'))
+        assert predicate(event(0)) == PredicateResult.maybe
+        error = event(0, fingerprint='$A', log_level=LogLevel.error)
+        assert predicate(error) == PredicateResult.maybe
+
+    def test_each_relay(self):
+        predicate = RelayRateLimitPredicate(rate=1, burst=1)
+        assert predicate(event(0, fingerprint='$A')) == PredicateResult.maybe
+        assert predicate(event(0, fingerprint='$B')) == PredicateResult.maybe
+        assert predicate(event(0, relay_fp='$C')) == PredicateResult.maybe
+        assert predicate(event(0, fingerprint='$A')) == PredicateResult.no
@@ -0,0 +1,131 @@
+import hashlib
+import os
+from io import BytesIO
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import http
+from twisted.web.client import Agent
+from twisted.web.error import Error
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from bwscanner.fetcher import blockHashingReadBody
+from bwscanner.manifest import (BlockManifest, ManifestError, generate_manifest,
+                                load_manifest, sample_blocks)
+
+BLOCK_SIZE = 1024
+# A file which doesn't end on a block boundary
+FILE_DATA = os.urandom(BLOCK_SIZE * 20 + 100)
+
+
+class RangeResource(Resource):
+    isLeaf = True
+
+    def __init__(self, data, honour_range=True):
+        Resource.__init__(self)
+        self.data = data
+        self.honour_range = honour_range
+
+    def render_GET(self, request):
+        range_header = request.getHeader('range')
+        if not range_header or not self.honour_range:
+            return self.data
+        start, end = range_header.split('=')[1].split('-')
+        request.setResponseCode(http.PARTIAL_CONTENT)
+        return self.data[int(start):int(end) + 1]
+
+
+class TestBlockManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest = generate_manifest("bwfile", BytesIO(FILE_DATA), BLOCK_SIZE)
+
+    def test_generate(self):
+        assert self.manifest.size == len(FILE_DATA)
+        assert self.manifest.num_blocks == 21
+        assert self.manifest.block_hashes[-1] == hashlib.sha256(FILE_DATA[-100:]).hexdigest()
+
+    def test_save_and_load(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        path = os.path.join(tmpdir, "manifest")
+        self.manifest.save(path)
+        loaded = load_manifest(path)
+        assert loaded.to_dict() == self.manifest.to_dict()
+
+    def test_wrong_number_of_hashes(self):
+        self.assertRaises(ManifestError, BlockManifest, "bwfile", len(FILE_DATA), BLOCK_SIZE,
+                          self.manifest.block_hashes[:-1])
+
+    def test_byte_range(self):
+        assert self.manifest.byte_range(0, 1) == (0, BLOCK_SIZE - 1)
+        assert self.manifest.byte_range(19, 2) == (19 * BLOCK_SIZE, len(FILE_DATA) - 1)
+        assert self.manifest.range_length(19, 2) == BLOCK_SIZE + 100
+        self.assertRaises(ManifestError, self.manifest.byte_range, 20, 2)
+
+    def test_sample_blocks(self):
+        assert sample_blocks(1, 4) == {0}
+        assert sample_blocks(3, 4) == {0, 1, 2}
+        sample = sample_blocks(20, 4)
+        assert len(sample) == 4
+        assert 19 in sample
+
+    def test_choose_blocks(self):
+        for size in [1, BLOCK_SIZE, BLOCK_SIZE * 5 + 1, len(FILE_DATA) * 10]:
+            first_block, num_blocks = self.manifest.choose_blocks(size)
+            assert self.manifest.range_length(first_block, num_blocks) >= min(size,
+                                                                              len(FILE_DATA))
+            assert first_block + num_blocks <= self.manifest.num_blocks
+
+
+class TestRangeDownload(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.manifest = generate_manifest("bwfile", BytesIO(FILE_DATA), BLOCK_SIZE)
+        self.resource = RangeResource(FILE_DATA)
+        self.port = yield reactor.listenTCP(0, Site(self.resource), interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:{}/bwfile'.format(self.port.getHost().port)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def fetch_blocks(self, first_block, num_blocks, **kwargs):
+        headers = Headers({'Range': [self.manifest.range_header(first_block, num_blocks)]})
+        d = Agent(reactor).request("GET", self.url, headers)
+        d.addCallback(blockHashingReadBody, self.manifest.block_size, **kwargs)
+        return d
+
+    @defer.inlineCallbacks
+    def test_range_matches_manifest(self):
+        for first_block, num_blocks in [(0, 1), (3, 7), (15, 6), (0, 21)]:
+            block_hashes = yield self.fetch_blocks(first_block, num_blocks)
+            assert block_hashes == self.manifest.expected_hashes(first_block, num_blocks)
+
+    @defer.inlineCallbacks
+    def test_range_tampered(self):
+        self.resource.data = FILE_DATA[:BLOCK_SIZE * 4] + 'x' + FILE_DATA[BLOCK_SIZE * 4 + 1:]
+        block_hashes = yield self.fetch_blocks(2, 4)
+        expected = self.manifest.expected_hashes(2, 4)
+        assert block_hashes[0:2] == expected[0:2]
+        assert block_hashes[2] != expected[2]
+        assert block_hashes[3] == expected[3]
+
+    @defer.inlineCallbacks
+    def test_range_sampled(self):
+        self.resource.data = FILE_DATA[:BLOCK_SIZE * 4] + 'x' + FILE_DATA[BLOCK_SIZE * 4 + 1:]
+        block_hashes = yield self.fetch_blocks(2, 4, sample={0, 3})
+        expected = self.manifest.expected_hashes(2, 4)
+        # The tampered block isn't in the sample
+        assert block_hashes == [expected[0], None, None, expected[3]]
+
+        block_hashes = yield self.fetch_blocks(2, 4, sample={2, 3})
+        assert block_hashes[2] != expected[2]
+
+    def test_range_not_supported(self):
+        self.resource.honour_range = False
+        return self.assertFailure(self.fetch_blocks(0, 2), Error)
@@ -1,13 +1,26 @@
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import PartialDownloadError, ResponseNeverReceived, readBody
+from twisted.web.error import Error
 from twisted.web.resource import Resource
 from twisted.web.server import Site
+from twisted.web.static import File
+from txtorcon.socks import HostUnreachableError
 from txtorcon.util import available_tcp_port
-from bwscanner.measurement import BwScan
-from test.template import TorTestCase
+from bwscanner.config import BW_FILES
+from bwscanner.mirrors import MirrorSet
+from bwscanner.fetcher import CircuitBuildFailed, CircuitSession, get_tor_socks_endpoint
+from bwscanner.manifest import generate_manifest
+from bwscanner.measurement import (BwScan, DownloadIncomplete, classify_failure,
+                                   CIRCUIT_FAILURE, TIMEOUT_FAILURE, STREAM_FAILURE,
+                                   HASH_FAILURE, EXIT_FAILURE, UNKNOWN_FAILURE)
+from bwscanner.writer import ResultSink
+from test.template import TorTestCase, FakeTorState, load_measurements
 from tempfile import mkdtemp
 
+import gc
 import os
-import json
 from shutil import rmtree
 
 
@@ -56,14 +69,10 @@ class TestBwscan(TorTestCase):
             Load the measurement files from the tmp directory and confirm
             we a measurements for every relay.
             """
-            measurements = []
             measured_relays = set()
             all_relays = set([r.id_hex for r in self.routers])
 
-            for filename in os.listdir(measurement_dir):
-                result_path = os.path.join(measurement_dir, filename)
-                with open(result_path, 'r') as result_file:
-                    measurements.extend(json.load(result_file))
+            measurements = load_measurements(measurement_dir)
 
             for measurement in measurements:
                 measured_relays.update({str(router) for router in measurement['path']})
@@ -84,3 +93,270 @@ class TestBwscan(TorTestCase):
         yield super(TestBwscan, self).tearDown()
         yield self.test_service.stopListening()
         rmtree(self.tmp)
+
+
+class TestFailureClassification(unittest.TestCase):
+
+    def test_classify_failure(self):
+        cancelled = Failure(defer.CancelledError())
+        for exception, expected in [
+                (CircuitBuildFailed(), CIRCUIT_FAILURE),
+                (defer.CancelledError(), TIMEOUT_FAILURE),
+                (ResponseNeverReceived([cancelled]), TIMEOUT_FAILURE),
+                (ResponseNeverReceived([Failure(ValueError())]), STREAM_FAILURE),
+                (DownloadIncomplete(), HASH_FAILURE),
+                (HostUnreachableError(), EXIT_FAILURE),
+                (Error(404), EXIT_FAILURE),
+                (PartialDownloadError(200), STREAM_FAILURE),
+                (ValueError(), UNKNOWN_FAILURE)]:
+            assert classify_failure(Failure(exception)) == expected
+
+
+class TestRetryFailures(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.clock = task.Clock()
+        self.tor_state = FakeTorState(12, circuit_failure=RuntimeError("552 No such router"))
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_retry_with_different_exit(self):
+        scan = BwScan(self.tor_state, self.clock, self.tmp, bw_files=BW_FILES,
+                      baseurl=u'http://127.0.0.1/', max_retries=2, retry_delay=10)
+        # Write all results in the end so the clock drives the whole scan
+        scan.result_sink = ResultSink(self.tmp, chunk_size=1000)
+        done = scan.run_scan()
+        self.clock.pump([1] * 100)
+        assert done.called
+
+        def check_retries(_):
+            measurements = load_measurements(self.tmp)
+            assert len(measurements) == 12 * 3
+            assert set(m['failure_class'] for m in measurements) == {'circuit'}
+            assert sorted(m['attempt'] for m in measurements) == [0] * 12 + [1] * 12 + [2] * 12
+
+            paths = {}
+            for path in self.tor_state.built_paths:
+                paths.setdefault(path[0], []).append(path[-1])
+            for relay, exits in paths.items():
+                assert len(exits) == 3
+                # Relays which aren't exits have three exits to choose from
+                if 'exit' not in relay.flags:
+                    assert len(set(exits)) == 3
+        return done.addCallback(check_retries)
+
+    def test_mirror_recorded(self):
+        mirrors = MirrorSet([u'http://mirror-a/', u'http://mirror-b/'], self.clock)
+        scan = BwScan(self.tor_state, self.clock, self.tmp, bw_files=BW_FILES,
+                      baseurl=u'http://127.0.0.1/', mirrors=mirrors, max_retries=0)
+        scan.result_sink = ResultSink(self.tmp, chunk_size=1000)
+        done = scan.run_scan()
+        self.clock.pump([1] * 20)
+        assert done.called
+
+        measurements = load_measurements(self.tmp)
+        # Each circuit fails at once so the first mirror is never busy
+        assert set(m['mirror'] for m in measurements) == {u'http://mirror-a/'}
+        # Circuit failures aren't the fault of the mirrors
+        assert [(m.in_flight, m.failures) for m in mirrors.mirrors] == [(0, 0), (0, 0)]
+
+    def test_mirror_capacity(self):
+        # Circuits are never built so the measurements stay in flight
+        tor_state = FakeTorState(12)
+        mirrors = MirrorSet([u'http://mirror-a/', u'http://mirror-b/'], self.clock, capacity=2)
+        scan = BwScan(tor_state, self.clock, self.tmp, bw_files=BW_FILES,
+                      baseurl=u'http://127.0.0.1/', mirrors=mirrors, request_limit=5)
+        scan.run_scan()
+        self.clock.pump([1] * 10)
+        assert sorted(m.in_flight for m in mirrors.mirrors) == [2, 3]
+
+    def test_mirror_released_on_error(self):
+        mirrors = MirrorSet([u'http://mirror-a/'], self.clock)
+        scan = BwScan(self.tor_state, self.clock, self.tmp, bw_files={}, mirrors=mirrors)
+        path = [self.tor_state.routers.values()[0], self.tor_state.routers.values()[2]]
+        # Without bandwidth files no file can be chosen
+        self.assertRaises(ValueError, scan.fetch, path)
+        assert mirrors.mirrors[0].in_flight == 0
+
+
+class TestContinuousScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.clock = task.Clock()
+        self.tor_state = FakeTorState(30, circuit_failure=RuntimeError("552 No such router"))
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def run_passes(self, scan, passes):
+        while scan.passes < passes:
+            self.clock.advance(1)
+
+    def test_memory_is_bounded(self):
+        """
+        Memory use must not grow with the number of passes of a continuous
+        scan.
+        """
+        scan = BwScan(self.tor_state, self.clock, self.tmp, bw_files=BW_FILES,
+                      baseurl=u'http://127.0.0.1/', max_retries=1, retry_delay=1,
+                      scan_continuous=True)
+        scan.result_sink = ResultSink(self.tmp, chunk_size=1000)
+        done = scan.run_scan()
+
+        self.run_passes(scan, 10)
+        self.tor_state.built_paths = []
+        gc.collect()
+        objects_before = len(gc.get_objects())
+
+        self.run_passes(scan, 110)
+        self.tor_state.built_paths = []
+        gc.collect()
+        objects_after = len(gc.get_objects())
+
+        assert not scan.tasks
+        assert len(scan.result_sink.buffer) <= 30 * 2
+        # Each pass creates hundreds of objects, allow for some noise.
+        assert objects_after - objects_before < 200, (objects_before, objects_after)
+
+        # The scan stops after the current pass when it's no longer continuous
+        scan.scan_continuous = False
+        self.run_passes(scan, 111)
+        self.clock.advance(1)
+        assert done.called
+        assert scan.completed == 30 * 2
+
+
+class TestMultipleInstances(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.clock = task.Clock()
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_spread_over_instances(self):
+        # Circuits on these instances are never built so measurements stay in flight
+        tor_states = [FakeTorState(30) for _ in range(3)]
+        scan = BwScan(tor_states, self.clock, self.tmp, bw_files=BW_FILES,
+                      baseurl=u'http://127.0.0.1/', request_limit=7)
+        scan.run_scan()
+        self.clock.pump([1] * 10)
+
+        assert [len(state.built_paths) for state in tor_states] == [3, 2, 2]
+        assert scan.instance_load == [3, 2, 2]
+        # Relays are chosen from the first instance only
+        assert set(path[0] for state in tor_states for path in state.built_paths) <= \
+            set(tor_states[0].routers.values())
+
+
+class TestLeasedRelays(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.clock = task.Clock()
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_leased_relays(self):
+        tor_state = FakeTorState(30)
+        relays = sorted(tor_state.routers)[:4]
+        scan = BwScan(tor_state, self.clock, self.tmp, bw_files=BW_FILES,
+                      baseurl=u'http://127.0.0.1/', relays=relays)
+        scan.run_scan()
+        self.clock.pump([1] * 10)
+
+        assert sorted(path[0].id_hex for path in tor_state.built_paths) == relays
+
+
+class CountingSite(Site):
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return Site.buildProtocol(self, addr)
+
+
+class TestSamplesPerCircuit(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.tmp = mkdtemp()
+
+        class FileResource(Resource):
+            isLeaf = True
+
+            def render_GET(self, request):
+                return 'a'
+
+        self.site = CountingSite(FileResource())
+        self.service = yield reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.baseurl = u'http://127.0.0.1:{}/'.format(self.service.getHost().port)
+
+    def tearDown(self):
+        rmtree(self.tmp)
+        return self.service.stopListening()
+
+    @defer.inlineCallbacks
+    def test_samples_share_circuit(self):
+        tor_state = FakeTorState(6, connect_directly=True)
+        bw_files = {1: ('1M', 'ca978112ca1bbdcafac231b39a23dc4da786eff8147c4e72b9807785afee48bb')}
+        scan = BwScan(tor_state, reactor, self.tmp, bw_files=bw_files, baseurl=self.baseurl,
+                      samples_per_circuit=3, circuit_launch_delay=0)
+        scan.result_sink = ResultSink(self.tmp, chunk_size=1000)
+        yield scan.run_scan()
+
+        measurements = load_measurements(self.tmp)
+        assert len(measurements) == 6 * 3
+        assert not [m for m in measurements if 'failure' in m]
+        assert sorted(m['sample'] for m in measurements) == [0] * 6 + [1] * 6 + [2] * 6
+        # One circuit and one connection per relay, the SOCKS port is only
+        # asked once.
+        assert len(tor_state.built_paths) == 6
+        assert self.site.connections == 6
+        assert len(tor_state.protocol.conf_requests) == 1
+
+    @defer.inlineCallbacks
+    def test_session_connects_to_two_hosts(self):
+        other_service = yield reactor.listenTCP(0, CountingSite(self.site.resource),
+                                                interface='127.0.0.1')
+        self.addCleanup(other_service.stopListening)
+        other_url = u'http://127.0.0.1:{}/'.format(other_service.getHost().port)
+        tor_state = FakeTorState(6, connect_directly=True)
+        path = tor_state.routers.values()[:2]
+        session = CircuitSession(tor_state, path, get_tor_socks_endpoint(tor_state))
+        self.addCleanup(session.close)
+        # Each sample needs a new connection through the SOCKS endpoint
+        for url in [self.baseurl, other_url]:
+            response = yield session.fetch(url.encode('ascii'))
+            yield readBody(response)
+        assert len(tor_state.built_paths) == 1
+
+    @defer.inlineCallbacks
+    def test_samples_with_range_manifest(self):
+        data_dir = mkdtemp()
+        self.addCleanup(rmtree, data_dir)
+        with open(os.path.join(data_dir, 'bwfile'), 'wb') as data_file:
+            data_file.write(os.urandom(1024 * 20 + 100))
+        with open(os.path.join(data_dir, 'bwfile'), 'rb') as data_file:
+            manifest = generate_manifest('bwfile', data_file, 1024)
+        service = yield reactor.listenTCP(0, Site(File(data_dir)), interface='127.0.0.1')
+        self.addCleanup(service.stopListening)
+        baseurl = u'http://127.0.0.1:{}/'.format(service.getHost().port)
+
+        for integrity in ['full', 'sampled']:
+            out_dir = os.path.join(self.tmp, integrity)
+            os.mkdir(out_dir)
+            scan = BwScan(FakeTorState(6, connect_directly=True), reactor, out_dir,
+                          baseurl=baseurl, range_manifest=manifest, integrity=integrity,
+                          samples_per_circuit=2, circuit_launch_delay=0)
+            scan.result_sink = ResultSink(out_dir, chunk_size=1000)
+            yield scan.run_scan()
+
+            measurements = load_measurements(out_dir)
+            assert not [m for m in measurements if 'failure' in m]
+            assert sorted(m['sample'] for m in measurements) == [0] * 6 + [1] * 6
@@ -0,0 +1,60 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from bwscanner.measurement import BwScan
+from bwscanner.metrics import ScanMetrics
+from bwscanner.simulation import (SIMULATED_BASEURL, SIMULATED_BW_FILES, SimulatedTorState,
+                                  SimulationSink)
+
+
+def parse_metrics(text):
+    values = {}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+class TestScanMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        state = SimulatedTorState(100, self.clock, seed=2)
+        self.scan = BwScan(state, self.clock, None, result_sink=SimulationSink(state.routers),
+                           bw_files=SIMULATED_BW_FILES, baseurl=SIMULATED_BASEURL,
+                           request_limit=5)
+        self.metrics = ScanMetrics(self.scan, self.clock)
+
+    def test_before_scan(self):
+        values = parse_metrics(self.metrics.render())
+        assert values['bwscan_measurements_in_flight'] == 0
+        assert 'bwscan_pass_eta_seconds' not in values
+
+    def test_during_scan(self):
+        self.metrics.start()
+        done = self.scan.run_scan()
+        self.clock.pump([1] * 60)
+        assert not done.called
+        values = parse_metrics(self.metrics.render())
+        assert values['bwscan_measurements_in_flight'] == 5
+        assert values['bwscan_semaphore_waiters'] > 0
+        assert values['bwscan_pass_circuits'] == 100
+        assert values['bwscan_pass_eta_seconds'] > 0
+        assert values['bwscan_downloads_total{outcome="success"}'] > 0
+        assert values['bwscan_downloaded_bytes_total'] > 0
+        assert values['bwscan_download_bytes_per_second'] > 0
+        assert values['bwscan_control_requests_total'] > 0
+        assert values['bwscan_reactor_lag_seconds'] == 0
+        self.metrics.stop()
+
+    def test_reactor_lag(self):
+        self.metrics.start()
+        # The reactor was busy 2.5s longer than the sampling interval
+        self.clock.advance(3.5)
+        assert self.metrics.lag == 2.5
+        self.clock.advance(1)
+        assert self.metrics.lag == 0
+        assert self.metrics.max_lag == 2.5
+        self.metrics.stop()
+        assert not self.clock.getDelayedCalls()
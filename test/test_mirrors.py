@@ -0,0 +1,98 @@
+import json
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web.client import Agent
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from twisted.web.static import Data
+
+from bwscanner.aggregate import mirror_bias
+from bwscanner.mirrors import MAX_CONSECUTIVE_FAILURES, MirrorSet
+
+MIRRORS = ['http://mirror-a/', 'http://mirror-b/', 'http://mirror-c/']
+
+
+class TestMirrorSet(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.mirrors = MirrorSet(MIRRORS, self.clock, capacity=2)
+        self.a, self.b, self.c = self.mirrors.mirrors
+
+    def test_spread_by_capacity(self):
+        chosen = [self.mirrors.acquire() for _ in range(7)]
+        assert sorted(m.url for m in chosen[:6]) == sorted(MIRRORS * 2)
+        # Every mirror is full, the download still goes to one of them
+        assert chosen[6].in_flight == 3
+        for mirror in chosen:
+            self.mirrors.release(mirror)
+        assert [m.in_flight for m in self.mirrors.mirrors] == [0, 0, 0]
+
+    def test_prefer_fast_mirror(self):
+        self.mirrors.succeeded(self.a, 1000, 10)
+        self.mirrors.succeeded(self.b, 1000, 1)
+        self.mirrors.succeeded(self.c, 1000, 5)
+        assert self.mirrors.acquire() is self.b
+        # With one download in flight b is only expected to be half as fast
+        assert self.mirrors.acquire() is self.b
+        assert self.mirrors.acquire() is self.c
+
+    def test_failing_mirror_backoff(self):
+        for _ in range(MAX_CONSECUTIVE_FAILURES):
+            self.mirrors.failed(self.a)
+        assert self.a not in [self.mirrors.acquire() for _ in range(4)]
+        self.clock.advance(60)
+        assert self.mirrors.available(self.a)
+
+
+class TestProbe(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        root = Resource()
+        root.putChild('good', Resource())
+        root.children['good'].putChild('2M', Data('x' * 10, 'application/octet-stream'))
+        self.port = yield reactor.listenTCP(0, Site(root), interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:{}/'.format(self.port.getHost().port)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_probe(self):
+        mirrors = MirrorSet([self.url + 'good/', self.url + 'missing/'], reactor)
+        yield mirrors.probe(Agent(reactor), '2M')
+        good, missing = mirrors.mirrors
+        assert good.latency is not None
+        assert mirrors.available(good)
+        assert not mirrors.available(missing)
+
+
+class TestMirrorBias(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_mirror_bias(self):
+        results = []
+        for relay, bw in [('A', 1000), ('B', 3000)]:
+            results.append({'path': [relay], 'circ_bw': bw, 'mirror': 'fast'})
+            results.append({'path': [relay], 'circ_bw': bw // 2, 'mirror': 'slow'})
+        # Only measured with one mirror, not used for the ratio
+        results.append({'path': ['C'], 'circ_bw': 10, 'mirror': 'slow'})
+        results.append({'path': ['C'], 'failure': 'Timeout', 'mirror': 'slow'})
+        with open(os.path.join(self.tmp, 'results-scan.json'), 'w') as json_file:
+            json.dump(results, json_file)
+
+        stats = mirror_bias([self.tmp])
+        assert stats['fast'] == {'measurements': 2, 'failures': 0, 'bw_ratio': 4 / 3.0}
+        assert stats['slow']['measurements'] == 3
+        assert stats['slow']['failures'] == 1
+        self.assertAlmostEqual(stats['slow']['bw_ratio'], 2 / 3.0)
@@ -0,0 +1,81 @@
+import json
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from bwscanner.measurement import BwScan
+from bwscanner.profiling import MemoryTracer, SpanRecorder
+from bwscanner.simulation import (SIMULATED_BASEURL, SIMULATED_BW_FILES, SimulatedTorState,
+                                  SimulationSink)
+
+
+class TestSpanRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.spans = SpanRecorder(self.clock)
+
+    def test_histogram(self):
+        for duration in [0.0005, 0.3, 0.4, 7, 500]:
+            self.spans.record('stage', duration)
+        histogram = self.spans.histograms()['stage']
+        assert histogram['count'] == 5
+        assert histogram['max_s'] == 500
+        assert histogram['buckets']['0.001'] == 1
+        assert histogram['buckets']['0.5'] == 2
+        assert histogram['buckets']['10'] == 1
+        assert histogram['buckets']['inf'] == 1
+        [line] = self.spans.summary()
+        assert line.startswith('stage') and '>120:1' in line
+
+    def test_span(self):
+        d = defer.Deferred()
+        self.spans.span('stage', d)
+        self.clock.advance(2)
+        d.callback('result')
+        assert self.successResultOf(d) == 'result'
+        assert self.spans.totals['stage'] == 2
+
+    def test_failures_are_not_recorded(self):
+        d = defer.Deferred()
+        self.spans.span('stage', d)
+        d.errback(ValueError())
+        self.failureResultOf(d, ValueError)
+        assert not self.spans.counts
+
+    def test_scan_stages(self):
+        state = SimulatedTorState(50, self.clock, seed=1)
+        scan = BwScan(state, self.clock, None, result_sink=SimulationSink(state.routers),
+                      bw_files=SIMULATED_BW_FILES, baseurl=SIMULATED_BASEURL, spans=self.spans)
+        done = scan.run_scan()
+        while not done.called:
+            self.clock.advance(1)
+        stages = self.spans.histograms()
+        for stage in ['circuit_build', 'first_byte', 'body_transfer', 'hashing',
+                      'control_port']:
+            assert stages[stage]['count'] > 0, stage
+
+
+class TestMemoryTracer(unittest.TestCase):
+
+    def test_snapshots(self):
+        clock = task.Clock()
+        tracer = MemoryTracer(clock, interval=10)
+        tracer.start()
+        self.addCleanup(tracer.stop)
+        garbage = [set() for _ in range(1000)]
+        clock.advance(10)
+        clock.advance(10)
+        assert len(tracer.snapshots) == 2
+        assert len(tracer.snapshots[0]['growth']) == 10
+        assert tracer.snapshots[0]['max_rss_kb'] > 0
+        del garbage
+
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        tracer.save(os.path.join(tmpdir, 'memory.json'))
+        with open(os.path.join(tmpdir, 'memory.json')) as memory_file:
+            assert len(json.load(memory_file)) == 2
@@ -0,0 +1,92 @@
+import os
+import pickle
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from bwscanner.aggregate import write_aggregate_data
+from bwscanner.circuit import TwoHop
+from bwscanner.measurement import BwScan
+from bwscanner.relays import RELAYS_FILE, Relay, RelayTable, build_relay_table
+from bwscanner.simulation import (SIMULATED_BASEURL, SIMULATED_BW_FILES, SimulatedTorState,
+                                  SimulationSink, desc_entry, ns_entry)
+from bwscanner.writer import write_results
+
+RELAY_A = '$' + 'A' * 40
+RELAY_B = '$' + 'B' * 40
+
+
+def network_status():
+    return '\n'.join([
+        ns_entry(RELAY_A, 'a', 100, ['exit', 'fast', 'running']),
+        'p accept 80,443',
+        ns_entry(RELAY_B, 'b', 20).replace('Bandwidth=20', 'Bandwidth=20 Unmeasured=1'),
+    ])
+
+
+class TestRelayTable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.table = RelayTable.from_network_status(network_status(),
+                                                    desc_entry(RELAY_A, 'a', 102400))
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_parse(self):
+        assert self.table.routers == {
+            RELAY_A: Relay(RELAY_A, 'a', 100, False, (102400, 102400, 102400),
+                           frozenset(['exit', 'fast', 'running']), 'accept 80,443'),
+            RELAY_B: Relay(RELAY_B, 'b', 20, True, None,
+                           frozenset(['fast', 'running', 'valid']), ''),
+        }
+        assert self.table.relay_info() == {RELAY_A: ('a', 102400, 100)}
+
+    def test_pickle_and_save(self):
+        assert pickle.loads(pickle.dumps(self.table, 2)).routers == self.table.routers
+        path = os.path.join(self.tmpdir, RELAYS_FILE)
+        self.table.save(path)
+        assert RelayTable.load(path).routers == self.table.routers
+
+    def test_aggregate_from_stored_table(self):
+        scan_dir = os.path.join(self.tmpdir, '1525190400')
+        os.mkdir(scan_dir)
+        self.table.save(os.path.join(scan_dir, RELAYS_FILE))
+        write_results(scan_dir, 'results.json',
+                      [{'path': [RELAY_A, RELAY_B], 'circ_bw': 1000}] * 2)
+        # There is no Tor connection to ask for the relay bandwidths
+        self.successResultOf(write_aggregate_data(None, [scan_dir]))
+        with open(os.path.join(scan_dir, 'aggregate_measurements')) as bw_file:
+            lines = bw_file.readlines()
+        assert len(lines) == 3
+        assert lines[2].startswith('node_id={} nick=a '.format(RELAY_A))
+        assert lines[2].endswith(' desc_bw=102400 ns_bw=100\n')
+
+
+class TestSimulatedRelayTable(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.clock = task.Clock()
+        self.state = SimulatedTorState(50, self.clock, seed=5)
+        self.table = yield build_relay_table(self.state.protocol)
+
+    def test_same_circuits(self):
+        assert len(self.table) == 50
+        from_state, from_table = TwoHop(self.state), TwoHop(self.table)
+        assert [r.id_hex for r in from_state.relays] == [r.id_hex for r in from_table.relays]
+        assert [r.id_hex for r in from_state.exits] == [r.id_hex for r in from_table.exits]
+        assert [r.bandwidth for r in from_state.exits] == [r.bandwidth for r in from_table.exits]
+
+    def test_scan_without_bandwidth_requests(self):
+        scan = BwScan(self.state, self.clock, None, result_sink=SimulationSink(self.state.routers),
+                      bw_files=SIMULATED_BW_FILES, baseurl=SIMULATED_BASEURL,
+                      relay_table=self.table)
+        done = scan.run_scan()
+        while not done.called:
+            self.clock.advance(1)
+        assert scan.result_sink.measurements > 0
+        assert scan.bw_cache.requests == 0
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.trial import unittest
+
+import bwscanner
+
+# Trial changes to its temporary directory after importing the tests
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(bwscanner.__file__)))
+
+
+class TestReactor(unittest.TestCase):
+
+    def test_cli_does_not_import_tor(self):
+        # Run in a new interpreter, the test runner has already imported all
+        # of these.
+        env = dict(os.environ, PYTHONPATH=PACKAGE_ROOT)
+        loaded = subprocess.check_output([sys.executable, '-c', (
+            "import sys, bwscanner.scanner; "
+            "print(' '.join(name for name in ('twisted.internet.reactor', 'txtorcon', "
+            "'bwscanner.measurement') if name in sys.modules))")], env=env)
+        assert loaded.strip() == b''
+
+    def test_install_reactor(self):
+        env = dict(os.environ, PYTHONPATH=PACKAGE_ROOT)
+        reactor = subprocess.check_output([sys.executable, '-c', (
+            "from bwscanner.scanner import install_reactor; install_reactor('poll'); "
+            "from twisted.internet import reactor; print(type(reactor).__name__)")], env=env)
+        assert reactor.strip() == b'PollReactor'
+
+
+class TestAggregate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_no_completed_scan(self):
+        env = dict(os.environ, PYTHONPATH=PACKAGE_ROOT)
+        process = subprocess.Popen([sys.executable, '-c', (
+            "from bwscanner.scanner import cli; cli()"), '--data-dir', self.tmp, 'aggregate'],
+            env=env, cwd=self.tmp, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        assert process.returncode == 255
+        assert b'Could not find any completed scan data.' in output
+        assert b'Traceback' not in output
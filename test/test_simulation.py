@@ -0,0 +1,27 @@
+from twisted.trial import unittest
+
+from bwscanner.simulation import run_simulation
+
+
+class TestSimulation(unittest.TestCase):
+
+    def test_every_relay_is_measured_or_failed(self):
+        summary = run_simulation(200, seed=1, request_timeout=60)
+        assert summary['measurements'] > 150
+        # Each relay is measured once, failed relays get up to two retries
+        attempts = summary['measurements'] + sum(summary['failures'].values())
+        assert 200 <= attempts <= 600
+        assert 0 < summary['median_bw_ratio'] <= 1.5
+        # A scan of 200 relays launched every 0.2s takes simulated minutes
+        assert summary['simulated_s'] > 40
+
+    def test_reproducible(self):
+        first = run_simulation(100, seed=3)
+        second = run_simulation(100, seed=3)
+        for key in ('measurements', 'failures', 'simulated_s'):
+            assert first[key] == second[key]
+
+    def test_no_failures(self):
+        summary = run_simulation(100, state_options={'flaky_fraction': 0,
+                                                     'stream_failure_rate': 0})
+        assert summary['failures'].get('stream', 0) == 0
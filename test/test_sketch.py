@@ -0,0 +1,87 @@
+import json
+import os
+import random
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.trial import unittest
+
+from bwscanner.aggregate import SKETCHES_FILE, aggregate_lines, load_sketches
+from bwscanner.sketch import TDigest
+
+
+class TestTDigest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.samples = [random.lognormvariate(10, 1) for _ in range(20000)]
+        self.sorted_samples = sorted(self.samples)
+
+    def assert_close(self, digest, q):
+        exact = self.sorted_samples[int(q * len(self.samples))]
+        assert abs(digest.quantile(q) - exact) / exact < 0.02, (q, digest.quantile(q), exact)
+
+    def test_small(self):
+        digest = TDigest()
+        assert digest.quantile(0.5) is None
+        for sample in [4, 1, 3, 2]:
+            digest.add(sample)
+        assert digest.quantile(0) == 1
+        assert digest.quantile(0.5) == 2.5
+        assert digest.quantile(1) == 4
+
+    def test_quantiles(self):
+        digest = TDigest()
+        for sample in self.samples:
+            digest.add(sample)
+        for q in [0.01, 0.1, 0.5, 0.9, 0.99]:
+            self.assert_close(digest, q)
+        # The size is bounded by the compression, not the number of samples
+        assert len(digest.centroids) <= digest.compression
+
+    def test_merge_serialized(self):
+        digests = [TDigest() for _ in range(8)]
+        for i, sample in enumerate(self.samples):
+            digests[i % len(digests)].add(sample)
+        merged = TDigest()
+        for digest in digests:
+            merged.merge(TDigest.from_dict(json.loads(json.dumps(digest.to_dict()))))
+        assert merged.count == len(self.samples)
+        assert merged.min == self.sorted_samples[0]
+        for q in [0.1, 0.5, 0.9]:
+            self.assert_close(merged, q)
+
+
+class TestScanSketches(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.scan_dirs = []
+        for scan_time, bws in [('2000', [100, 200]), ('1000', [300, 1000])]:
+            scan_dir = os.path.join(self.tmpdir, scan_time)
+            os.makedirs(scan_dir)
+            results = [{'path': ['$A', '$X'], 'circ_bw': bw} for bw in bws]
+            results.append({'path': ['$A', '$X'], 'failure': 'timeout'})
+            with open(os.path.join(scan_dir, '0.json'), 'w') as result_file:
+                json.dump(results, result_file)
+            self.scan_dirs.append(scan_dir)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_load_sketches(self):
+        sketches = load_sketches(self.scan_dirs)
+        assert sketches['$A'].count == 4
+        assert sketches['$A'].quantile(0.5) == 250
+        for scan_dir in self.scan_dirs:
+            assert os.path.exists(os.path.join(scan_dir, SKETCHES_FILE))
+
+        # The saved digests are used instead of the results
+        os.remove(os.path.join(self.scan_dirs[0], '0.json'))
+        assert load_sketches(self.scan_dirs)['$X'].count == 4
+
+    def test_quantile_lines(self):
+        measurements = {'$A': [100, 200, 300, 1000]}
+        relay_info = {'$A': ('a', 1000, 900)}
+        [line] = aggregate_lines(measurements, {}, relay_info, load_sketches(self.scan_dirs))
+        assert line.endswith(" ns_bw=900 median_bw=250 p90_bw=1000\n")
@@ -0,0 +1,75 @@
+import os
+import sys
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+from bwscanner.relays import RELAYS_FILE, Relay, RelayTable, load_relay_table
+from bwscanner.workers import merge_worker_results, run_workers, worker_partition
+from bwscanner.writer import relay_results, write_results
+
+
+class TestWorkerPartitions(unittest.TestCase):
+
+    def relay_subset(self, partitions, this_partition, num_relays=100):
+        # The relay indexes TwoHop chooses from for this partition
+        return set(range(this_partition - 1, num_relays, partitions))
+
+    def test_workers_cover_partition(self):
+        for partitions, current_partition, workers in [(1, 1, 3), (4, 2, 3), (3, 3, 1)]:
+            subsets = [self.relay_subset(*worker_partition(partitions, current_partition,
+                                                           workers, worker))
+                       for worker in range(workers)]
+            assert set.union(*subsets) == self.relay_subset(partitions, current_partition)
+            assert sum(len(subset) for subset in subsets) == len(set.union(*subsets))
+
+
+class TestRunWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def write_command(self, worker_dir, exit_code=0):
+        script = ("import json, sys; json.dump([{{'worker': {0!r}}}], "
+                  "open({1!r}, 'w')); sys.exit({2})").format(
+                      worker_dir, os.path.join(worker_dir, 'results-scan.json'), exit_code)
+        return [sys.executable, '-c', script]
+
+    @defer.inlineCallbacks
+    def test_run_and_merge(self):
+        worker_dirs = [os.path.join(self.tmp, 'worker-{}'.format(i)) for i in range(3)]
+        for worker_dir in worker_dirs:
+            os.mkdir(worker_dir)
+        commands = [self.write_command(worker_dir, exit_code=int(i == 2))
+                    for i, worker_dir in enumerate(worker_dirs)]
+
+        exit_codes = yield run_workers(reactor, commands)
+        assert exit_codes == [0, 0, 1]
+
+        merge_worker_results(self.tmp, worker_dirs)
+        assert sorted(os.listdir(self.tmp)) == ['worker-0-results-scan.json',
+                                                'worker-1-results-scan.json',
+                                                'worker-2-results-scan.json']
+
+    def test_merge_index(self):
+        worker_dirs = [os.path.join(self.tmp, 'worker-{}'.format(i)) for i in range(2)]
+        for i, worker_dir in enumerate(worker_dirs):
+            os.mkdir(worker_dir)
+            write_results(worker_dir, 'results-scan.json', [{'path': ['$A', '$X'], 'circ_bw': i}])
+        merge_worker_results(self.tmp, worker_dirs)
+        assert [result['circ_bw'] for result in relay_results(self.tmp, '$A')] == [0, 1]
+
+    def test_merge_relay_tables(self):
+        worker_dirs = [os.path.join(self.tmp, 'worker-{}'.format(i)) for i in range(2)]
+        for relay, worker_dir in zip(['$A', '$B'], worker_dirs):
+            os.mkdir(worker_dir)
+            RelayTable([Relay(relay, 'nick', 1, False, None, frozenset(), '')]).save(
+                os.path.join(worker_dir, RELAYS_FILE))
+        merge_worker_results(self.tmp, worker_dirs)
+        assert sorted(load_relay_table(self.tmp).routers) == ['$A', '$B']
+        assert os.listdir(self.tmp) == [RELAYS_FILE]
@@ -1,4 +1,5 @@
 import json
+import os
 from shutil import rmtree
 from os.path import walk, join
 from tempfile import mkdtemp
@@ -6,7 +7,8 @@ from tempfile import mkdtemp
 from twisted.trial import unittest
 from twisted.internet import defer
 
-from bwscanner.writer import ResultSink
+from bwscanner.writer import (INDEX_FILE, ResultSink, measured_relays, read_results,
+                              read_scan_info, relay_results, write_scan_info)
 from random import randint
 
 
@@ -82,8 +84,81 @@ class TestResultSink(unittest.TestCase):
         dl.addCallback(lambda results: walk(self.tmpdir, validate, None))
         return dl
 
+    @defer.inlineCallbacks
+    def test_backlog(self):
+        self.tmpdir = mkdtemp()
+        self.result_sink = ResultSink(self.tmpdir, chunk_size=10)
+        for _ in xrange(25):
+            self.result_sink.send({'test_method': 'test_backlog'})
+        assert self.result_sink.backlog == 25
+        yield self.result_sink.end_flush()
+        assert self.result_sink.backlog == 0
+
     def tearDown(self):
         def remove_tree(result):
             rmtree(self.tmpdir)
             return result
         return self.result_sink.current_task.addCallback(remove_tree)
+
+
+class TestResumeScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        results = [{'path': ['$A', '$X'], 'circ_bw': 100},
+                   {'path': ['$B', '$X'], 'failure': 'timeout'},
+                   {'path': ['$C', '$X'], 'circ_bw': 200}]
+        with open(join(self.tmpdir, 'complete-scan.json'), 'w') as json_file:
+            json.dump(results, json_file, sort_keys=True)
+        # Writing the last file was interrupted in the middle of a result
+        data = json.dumps(results[:2] + [{'path': ['$D', '$X'], 'circ_bw': 300}],
+                          sort_keys=True)
+        with open(join(self.tmpdir, 'truncated-scan.json'), 'w') as json_file:
+            json_file.write(data[:-20])
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_read_truncated_results(self):
+        results = read_results(join(self.tmpdir, 'truncated-scan.json'))
+        assert [result['path'][0] for result in results] == ['$A', '$B']
+
+    def test_measured_relays(self):
+        assert measured_relays(self.tmpdir) == set(['$A', '$C'])
+
+    def test_scan_info(self):
+        assert read_scan_info(self.tmpdir) is None
+        write_scan_info(self.tmpdir, partitions=4, current_partition=2)
+        assert read_scan_info(self.tmpdir) == {'partitions': 4, 'current_partition': 2}
+        # The scan info isn't read as a result file
+        assert measured_relays(self.tmpdir) == set(['$A', '$C'])
+
+
+class TestFingerprintIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.results = [{'path': ['$A', '$X'], 'circ_bw': 100, 'time_end': 10},
+                        {'path': ['$B', '$X'], 'failure': 'timeout', 'time_end': 20},
+                        {'path': ['$A', '$Y'], 'circ_bw': 200, 'time_end': 30,
+                         'url': u'http://example/\xe9'}]
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    @defer.inlineCallbacks
+    def test_sink_index(self):
+        sink = ResultSink(self.tmpdir, chunk_size=2)
+        for result in self.results:
+            sink.send(result)
+        yield sink.end_flush()
+        assert list(relay_results(self.tmpdir, '$A')) == [self.results[0], self.results[2]]
+        assert list(relay_results(self.tmpdir, '$X')) == self.results[:2]
+        assert list(relay_results(self.tmpdir, '$A', since=20)) == [self.results[2]]
+        assert list(relay_results(self.tmpdir, '$Z')) == []
+
+    def test_unindexed_scan(self):
+        with open(join(self.tmpdir, 'old-scan.json'), 'w') as json_file:
+            json.dump(self.results, json_file, sort_keys=True)
+        assert list(relay_results(self.tmpdir, '$Y')) == [self.results[2]]
+        assert os.path.exists(join(self.tmpdir, INDEX_FILE))